@@ -2,19 +2,27 @@ import logging
 import sys
 import os
 from datetime import datetime
-import torch
 import subprocess
 import gc
 import json
 import argparse
 import base64
+import hashlib
+import tempfile
+import time
+from importlib import metadata
 from io import BytesIO
+from multiprocessing.connection import Listener
 from pathlib import Path
-from diffusers import StableDiffusionPipeline
+from typing import List, Optional
 
-# Set PyTorch memory allocation configuration for WSL2
+from prompt_embed_cache import PromptEmbedCache
+
+# torch, diffusers and transformers are imported inside the functions that need
+# them so --help, --profile-startup and worker bookkeeping start instantly.
+
+# Set PyTorch memory allocation configuration for WSL2 (read when torch is first imported)
 os.environ["PYTORCH_CUDA_ALLOC_CONF"] = "max_split_size_mb:512"
-torch.cuda.set_per_process_memory_fraction(0.95)  # Use 95% of available GPU memory
 
 # Configure logging
 logging.basicConfig(
@@ -27,15 +35,100 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-def check_dependencies():
-    """Check and install required dependencies."""
+# Minimum versions of the packages the pipeline needs
+REQUIRED_PACKAGES = {
+    "torch": None,
+    # callback_on_step_end and a public encode_prompt() arrived in 0.22
+    "diffusers": "0.22.0",
+    "transformers": "4.25.1",
+    "accelerate": "0.21.0",
+    "safetensors": "0.3.1",
+}
+
+DEPENDENCY_CACHE_FILE = os.path.join(
+    os.path.expanduser("~"), ".cache", "village-ai",
+    f"deps-{hashlib.sha1(sys.executable.encode()).hexdigest()[:12]}.json"
+)
+
+def _site_packages_mtime() -> float:
+    """Latest mtime of the site-packages directories; changes whenever a package is (un)installed."""
+    mtimes = [os.path.getmtime(p) for p in sys.path if p.endswith("-packages") and os.path.isdir(p)]
+    return max(mtimes) if mtimes else 0.0
+
+def _version_tuple(version: str) -> tuple:
+    parts = []
+    for piece in version.split("+")[0].split("."):
+        digits = "".join(ch for ch in piece if ch.isdigit())
+        parts.append(int(digits) if digits else 0)
+    return tuple(parts)
+
+def resolve_dependencies() -> dict:
+    """Look up installed versions from package metadata without importing anything.
+
+    Returns a mapping of package name to version for satisfied requirements and
+    raises RuntimeError listing every missing or too-old package.
+    """
+    versions = {}
+    problems = []
+    for package, minimum in REQUIRED_PACKAGES.items():
+        try:
+            version = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            problems.append(f"{package} is not installed")
+            continue
+        if minimum and _version_tuple(version) < _version_tuple(minimum):
+            problems.append(f"{package} {version} is older than required {minimum}")
+            continue
+        versions[package] = version
+    if problems:
+        raise RuntimeError("Missing dependencies: " + "; ".join(problems))
+    return versions
+
+def check_dependencies(install: bool = False):
+    """Check required dependencies from installed metadata, caching the result on disk.
+
+    The cache is keyed by interpreter and invalidated whenever site-packages
+    changes, so repeated launches skip even the metadata scan. Nothing is
+    installed unless `install` is set (the old pip-at-runtime behaviour).
+    """
+    site_mtime = _site_packages_mtime()
+    try:
+        with open(DEPENDENCY_CACHE_FILE, "r") as f:
+            cached = json.load(f)
+        if cached.get("executable") == sys.executable and cached.get("site_mtime") == site_mtime:
+            logger.info("Dependencies satisfied (cached)")
+            return True
+    except (OSError, ValueError):
+        pass
+
+    try:
+        versions = resolve_dependencies()
+    except RuntimeError as e:
+        if not install:
+            logger.error(f"{str(e)}. Install them with: pip install -r requirements.txt (or rerun with --install_deps)")
+            raise
+        logger.warning(f"{str(e)}. Installing...")
+        install_dependencies()
+        versions = resolve_dependencies()
+
+    logger.info("Dependencies satisfied: " + ", ".join(f"{k}=={v}" for k, v in versions.items()))
+    try:
+        os.makedirs(os.path.dirname(DEPENDENCY_CACHE_FILE), exist_ok=True)
+        with open(DEPENDENCY_CACHE_FILE, "w") as f:
+            json.dump({"executable": sys.executable, "site_mtime": site_mtime, "versions": versions}, f)
+    except OSError as e:
+        logger.warning(f"Could not write dependency cache: {str(e)}")
+    return True
+
+def install_dependencies():
+    """Install required dependencies with pip (only used with --install_deps)."""
     try:
         logger.info("Installing PyTorch...")
         subprocess.check_call([sys.executable, "-m", "pip", "install", "--no-cache-dir", "torch", "torchvision", "torchaudio", "--index-url", "https://download.pytorch.org/whl/cu118"])
 
         logger.info("Installing other dependencies...")
         required_packages = [
-            "diffusers[torch]>=0.21.0",
+            "diffusers[torch]>=0.22.0",
             "transformers>=4.25.1",
             "accelerate>=0.21.0",
             "safetensors>=0.3.1"
@@ -48,36 +141,92 @@ def check_dependencies():
                 logger.error(f"Failed to install {package}: {str(e)}")
                 raise
 
-        # Verify imports
-        import diffusers
-        import transformers
-        import accelerate
         logger.info("All dependencies installed successfully")
         return True
 
     except Exception as e:
-        logger.error(f"Error checking/installing dependencies: {str(e)}")
+        logger.error(f"Error installing dependencies: {str(e)}")
         raise
 
+# Heavy modules reported by --profile-startup
+PROFILED_MODULES = ["torch", "transformers", "diffusers"]
+
+def profile_startup(modules=None, top: int = 15):
+    """Report per-module import time for the heavy dependencies.
+
+    Runs the imports in a fresh interpreter with `-X importtime` so the numbers
+    reflect a cold start, then prints each requested module's cumulative time
+    and the slowest individual modules by self time.
+    """
+    modules = modules or PROFILED_MODULES
+    code = "; ".join(f"import {m}" for m in modules)
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True)
+    wall_time = time.perf_counter() - start
+
+    entries = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = [part.strip() for part in line[len("import time:"):].split("|")]
+        entries.append((name, int(self_us), int(cumulative_us)))
+
+    print(f"\nStartup profile ({sys.executable})")
+    print("-" * 62)
+    print(f"{'module':<50}{'cumulative':>12}")
+    for module in modules:
+        cumulative = next((c for name, _, c in entries if name == module), None)
+        shown = f"{cumulative / 1e6:.3f}s" if cumulative is not None else "failed"
+        print(f"{module:<50}{shown:>12}")
+    print(f"{'total (wall, incl. interpreter)':<50}{wall_time:>11.3f}s")
+
+    print(f"\nTop {top} modules by self time")
+    print("-" * 62)
+    for name, self_us, cumulative_us in sorted(entries, key=lambda e: e[1], reverse=True)[:top]:
+        print(f"{name.strip():<50}{self_us / 1e6:>11.3f}s")
+
+    if result.returncode != 0:
+        print(f"\nImport failed:\n{result.stderr.splitlines()[-1] if result.stderr else ''}")
+    return entries
+
 def clear_gpu_memory():
     """Clear GPU memory and run garbage collection."""
+    if "torch" not in sys.modules:
+        # Nothing was ever loaded on the GPU; don't pay for the import just to clean up
+        gc.collect()
+        return
+    import torch
     if torch.cuda.is_available():
         torch.cuda.empty_cache()
         torch.cuda.ipc_collect()
     gc.collect()
     logger.info("GPU memory cleared")
 
-def setup_pipeline(model_id: str):
+def setup_pipeline(model_id: str, device: str = "cuda"):
     """Setup the pipeline with optimizations for WSL2 environment."""
     import torch
     from diffusers import StableDiffusionPipeline
 
     logger.info("Setting up pipeline...")
     try:
+        if device == "cpu":
+            # CPU fallback: full precision, no CUDA-only tuning
+            pipe = StableDiffusionPipeline.from_pretrained(
+                model_id,
+                torch_dtype=torch.float32,
+                safety_checker=None,
+                requires_safety_checker=False
+            ).to("cpu")
+            pipe.enable_attention_slicing(slice_size="auto")
+            logger.info("Pipeline setup completed successfully on CPU")
+            return pipe
+
         # Check CUDA availability
         if not torch.cuda.is_available():
             raise RuntimeError("CUDA is not available")
 
+        torch.cuda.set_per_process_memory_fraction(0.95)  # Use 95% of available GPU memory
+
         # Clear GPU memory before loading model
         clear_gpu_memory()
 
@@ -93,7 +242,7 @@ def setup_pipeline(model_id: str):
 
         # Load smaller model with optimizations
         pipe = StableDiffusionPipeline.from_pretrained(
-            "CompVis/stable-diffusion-v1-4",  # Smaller model than SDXL
+            model_id,  # CompVis/stable-diffusion-v1-4 is smaller than SDXL
             torch_dtype=torch.float16,
             revision="fp16",
             safety_checker=None,
@@ -111,32 +260,178 @@ def setup_pipeline(model_id: str):
         logger.error(f"Error setting up pipeline: {str(e)}")
         raise
 
+def build_tiny_pipeline(seed: int = 0):
+    """Build a tiny random-weight Stable Diffusion pipeline for CPU testing.
+
+    Nothing is downloaded: the tokenizer vocabulary is written to a temporary
+    directory and every model is randomly initialised with a very small config.
+    Outputs are noise, but the full pipeline code path is exercised.
+    """
+    import torch
+    from diffusers import AutoencoderKL, PNDMScheduler, StableDiffusionPipeline, UNet2DConditionModel
+    from transformers import CLIPTextConfig, CLIPTextModel, CLIPTokenizer
+
+    logger.info("Building tiny random-weight pipeline for CPU testing...")
+    torch.manual_seed(seed)
+
+    # Minimal CLIP vocabulary: special tokens plus single characters
+    vocab_dir = tempfile.mkdtemp(prefix="tiny-clip-tokenizer-")
+    vocab = {"<|startoftext|>": 0, "<|endoftext|>": 1, "!": 2}
+    for char in "abcdefghijklmnopqrstuvwxyz0123456789,.":
+        vocab[char] = len(vocab)
+        vocab[char + "</w>"] = len(vocab)
+    with open(os.path.join(vocab_dir, "vocab.json"), "w", encoding="utf-8") as f:
+        json.dump(vocab, f)
+    with open(os.path.join(vocab_dir, "merges.txt"), "w", encoding="utf-8") as f:
+        f.write("#version: 0.2\n")
+    tokenizer = CLIPTokenizer(
+        os.path.join(vocab_dir, "vocab.json"),
+        os.path.join(vocab_dir, "merges.txt"),
+        pad_token="!",
+        model_max_length=77
+    )
+
+    text_encoder = CLIPTextModel(CLIPTextConfig(
+        bos_token_id=0,
+        eos_token_id=1,
+        pad_token_id=2,
+        hidden_size=32,
+        intermediate_size=37,
+        num_attention_heads=4,
+        num_hidden_layers=2,
+        vocab_size=len(vocab),
+        max_position_embeddings=77
+    ))
+    unet = UNet2DConditionModel(
+        block_out_channels=(32, 64),
+        layers_per_block=1,
+        sample_size=32,
+        in_channels=4,
+        out_channels=4,
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+        up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        cross_attention_dim=32,
+        norm_num_groups=32
+    )
+    vae = AutoencoderKL(
+        block_out_channels=(32, 64),
+        in_channels=3,
+        out_channels=3,
+        down_block_types=("DownEncoderBlock2D", "DownEncoderBlock2D"),
+        up_block_types=("UpDecoderBlock2D", "UpDecoderBlock2D"),
+        latent_channels=4,
+        norm_num_groups=32
+    )
+    scheduler = PNDMScheduler(skip_prk_steps=True, steps_offset=1)
+
+    pipe = StableDiffusionPipeline(
+        vae=vae,
+        text_encoder=text_encoder,
+        tokenizer=tokenizer,
+        unet=unet,
+        scheduler=scheduler,
+        safety_checker=None,
+        feature_extractor=None,
+        requires_safety_checker=False
+    ).to("cpu")
+    pipe.set_progress_bar_config(disable=True)
+    logger.info("Tiny pipeline ready")
+    return pipe
+
+def warmup_pipeline(pipe, size: tuple = (512, 512)):
+    """Run one throwaway single-step inference so the first real job pays no warm-up cost."""
+    import torch
+
+    logger.info(f"Warming up pipeline at {size} resolution...")
+    start = datetime.now()
+    with torch.inference_mode():
+        pipe(
+            prompt="warmup",
+            negative_prompt="",
+            num_inference_steps=1,
+            guidance_scale=7.5,
+            height=size[0],
+            width=size[1]
+        )
+    logger.info(f"Warm-up finished in {(datetime.now() - start).total_seconds():.2f}s")
+
+# Shared by the CLI, the batch generator and the server's request model, so its
+# text-encoder output is almost always served from the prompt embedding cache
+DEFAULT_NEGATIVE_PROMPT = "blurry, low quality, distorted, deformed, disfigured, bad anatomy, ugly, duplicate, error"
+
+# Encodings the worker and CLI can hand back, mapped to PIL format names
+IMAGE_FORMATS = {"png": "PNG", "webp": "WEBP"}
+
+def encode_image(image, image_format: str = "png") -> bytes:
+    """Encode a PIL image once into PNG or WebP bytes."""
+    if image_format not in IMAGE_FORMATS:
+        raise ValueError(f"Unsupported image format: {image_format}")
+    buffered = BytesIO()
+    if image_format == "webp":
+        image.save(buffered, format="WEBP", quality=90, method=4)
+    else:
+        image.save(buffered, format="PNG")
+    return buffered.getvalue()
+
+def save_encoded_image(output_file: str, image_bytes: bytes):
+    """Write already-encoded image bytes, creating the output directory if needed."""
+    output_dir = os.path.dirname(output_file)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    with open(output_file, "wb") as f:
+        f.write(image_bytes)
+    logger.info(f"Image saved successfully to {output_file}")
+
 def generate_image(
     pipe,
     prompt: str,
     negative_prompt: str,
-    output_file: str,
+    output_file: Optional[str],
     num_steps: int = 30,
     guidance_scale: float = 7.5,
     size: tuple = (768, 512),
-    return_base64: bool = False
+    return_base64: bool = False,
+    return_bytes: bool = False,
+    image_format: str = "png",
+    progress_callback=None,
+    embed_cache: Optional[PromptEmbedCache] = None
 ):
-    """Generate image with error handling and progress logging."""
+    """Generate image with error handling and progress logging.
+
+    The image is encoded exactly once; the same bytes are written to
+    `output_file` (if given) and returned raw (`return_bytes`) or as base64
+    (`return_base64`, kept for compatibility). `progress_callback(step, num_steps)`
+    is called after every denoising step. With an `embed_cache` the prompts
+    are passed to the pipeline as cached text-encoder embeddings.
+    """
+    import torch
+
     try:
         logger.info("Starting image generation...")
         logger.info(f"Prompt: {prompt}")
         logger.info(f"Settings: {num_steps} steps, {guidance_scale} guidance scale, {size} resolution")
         logger.info(f"Output file: {output_file}")
 
+        step_kwargs = {}
+        if progress_callback is not None:
+            def on_step_end(pipeline, step, timestep, callback_kwargs):
+                progress_callback(step + 1, getattr(pipeline, "num_timesteps", num_steps))
+                return callback_kwargs
+            step_kwargs["callback_on_step_end"] = on_step_end
+
         # Generate image with optimized settings
         with torch.inference_mode():
+            if embed_cache is not None:
+                prompt_kwargs = embed_cache.pipeline_kwargs(pipe, [prompt], [negative_prompt])
+            else:
+                prompt_kwargs = {"prompt": prompt, "negative_prompt": negative_prompt}
             result = pipe(
-                prompt=prompt,
-                negative_prompt=negative_prompt,
+                **prompt_kwargs,
                 num_inference_steps=num_steps,
                 guidance_scale=guidance_scale,
                 height=size[0],
-                width=size[1]
+                width=size[1],
+                **step_kwargs
             )
 
             if not result.images:
@@ -144,20 +439,18 @@ def generate_image(
 
             image = result.images[0]
 
-        # Create output directory if it doesn't exist
-        output_dir = os.path.dirname(output_file)
-        if output_dir:
-            os.makedirs(output_dir, exist_ok=True)
+        image_bytes = encode_image(image, image_format)
+        logger.info(f"Image encoded as {image_format} ({len(image_bytes)} bytes)")
+
+        if output_file:
+            save_encoded_image(output_file, image_bytes)
 
-        # Save the image to file
-        image.save(output_file)
-        logger.info(f"Image saved successfully to {output_file}")
+        if return_bytes:
+            return output_file, image_bytes
 
         # If base64 is requested, convert the image to base64
         if return_base64:
-            buffered = BytesIO()
-            image.save(buffered, format="PNG")
-            img_base64 = base64.b64encode(buffered.getvalue()).decode('utf-8')
+            img_base64 = base64.b64encode(image_bytes).decode('utf-8')
             logger.info("Image converted to base64")
             return output_file, img_base64
 
@@ -167,6 +460,89 @@ def generate_image(
         logger.error(f"Error generating image: {str(e)}")
         raise
 
+def generate_image_batch(
+    pipe,
+    jobs: List[dict],
+    num_steps: int = 30,
+    guidance_scale: float = 7.5,
+    size: tuple = (768, 512),
+    progress_callback=None,
+    embed_cache: Optional[PromptEmbedCache] = None
+) -> List[dict]:
+    """Generate images for several prompts in one batched pipeline call.
+
+    All jobs share resolution, step count and guidance scale; each one brings
+    its own `prompt`, `negative_prompt`, optional `seed`, `output_file` and
+    `image_format`. Every image gets its own generator, so a seeded job
+    produces a visually identical image whether it runs alone or in a batch
+    (batched kernels can differ at float level, so the bytes may not match
+    exactly). Returns one
+    dict per job, in order, with the output file, format, seed used and the
+    encoded image bytes. With an `embed_cache` only prompts not seen before
+    go through the text encoder.
+    """
+    import torch
+
+    try:
+        logger.info(f"Starting batched image generation ({len(jobs)} prompts)...")
+        logger.info(f"Settings: {num_steps} steps, {guidance_scale} guidance scale, {size} resolution")
+
+        generators = []
+        for job in jobs:
+            generator = torch.Generator(device=pipe.device)
+            if job.get("seed") is None:
+                job_seed = generator.seed()  # Non-deterministic, but reported back
+            else:
+                job_seed = generator.manual_seed(int(job["seed"])).initial_seed()
+            generators.append(generator)
+            job["seed"] = job_seed
+
+        step_kwargs = {}
+        if progress_callback is not None:
+            def on_step_end(pipeline, step, timestep, callback_kwargs):
+                progress_callback(step + 1, getattr(pipeline, "num_timesteps", num_steps))
+                return callback_kwargs
+            step_kwargs["callback_on_step_end"] = on_step_end
+
+        prompts = [job["prompt"] for job in jobs]
+        negative_prompts = [job["negative_prompt"] for job in jobs]
+        with torch.inference_mode():
+            if embed_cache is not None:
+                prompt_kwargs = embed_cache.pipeline_kwargs(pipe, prompts, negative_prompts)
+            else:
+                prompt_kwargs = {"prompt": prompts, "negative_prompt": negative_prompts}
+            result = pipe(
+                **prompt_kwargs,
+                num_inference_steps=num_steps,
+                guidance_scale=guidance_scale,
+                height=size[0],
+                width=size[1],
+                generator=generators,
+                **step_kwargs
+            )
+
+        if len(result.images) != len(jobs):
+            raise RuntimeError(f"Expected {len(jobs)} images, got {len(result.images)}")
+
+        outputs = []
+        for job, image in zip(jobs, result.images):
+            image_format = job.get("image_format", "png")
+            image_bytes = encode_image(image, image_format)
+            if job.get("output_file"):
+                save_encoded_image(job["output_file"], image_bytes)
+            outputs.append({
+                "output_file": job.get("output_file"),
+                "format": image_format,
+                "seed": job["seed"],
+                "image_bytes": image_bytes
+            })
+        logger.info(f"Batch of {len(jobs)} images encoded ({sum(len(o['image_bytes']) for o in outputs)} bytes)")
+        return outputs
+
+    except Exception as e:
+        logger.error(f"Error generating image batch: {str(e)}")
+        raise
+
 def load_response_data(json_file: str):
     """Load and parse response data from JSON file."""
     try:
@@ -223,12 +599,15 @@ def create_prompt_from_response(response: str) -> str:
 
 def batch_generate_images(response_dir: str, output_dir: str = "outputs/generated_images"):
     """Generate images for all JSON files in the response directory."""
+    import torch
+
     try:
         # Create output directory
         os.makedirs(output_dir, exist_ok=True)
 
         # Setup pipeline once for all generations
         pipe = setup_pipeline("CompVis/stable-diffusion-v1-4")  # Using smaller model
+        embed_cache = PromptEmbedCache.from_env()
 
         # Get all JSON files in the directory
         json_files = sorted([f for f in os.listdir(response_dir) if f.endswith('.json')])
@@ -283,7 +662,7 @@ def batch_generate_images(response_dir: str, output_dir: str = "outputs/generate
 
                     logger.info(f"Generating image: {output_file}")
 
-                    negative_prompt = "blurry, low quality, distorted, deformed, disfigured, bad anatomy, ugly, duplicate, error"
+                    negative_prompt = DEFAULT_NEGATIVE_PROMPT
 
                     generate_image(
                         pipe=pipe,
@@ -293,7 +672,8 @@ def batch_generate_images(response_dir: str, output_dir: str = "outputs/generate
                         num_steps=30,  # Reduced steps
                         guidance_scale=7.5,  # Standard guidance
                         size=(768, 512),  # Smaller size
-                        return_base64=False
+                        return_base64=False,
+                        embed_cache=embed_cache
                     )
 
                     logger.info(f"Completed response {idx}/{total_responses} from {json_file}")
@@ -308,18 +688,154 @@ def batch_generate_images(response_dir: str, output_dir: str = "outputs/generate
                 logger.error(f"Error processing file {json_file}: {str(e)}")
                 continue
 
+        if embed_cache is not None:
+            logger.info(f"Prompt embedding cache: {embed_cache.stats()}")
+
     except Exception as e:
         logger.error(f"Error in batch generation: {str(e)}")
         raise
     finally:
         clear_gpu_memory()
 
+def parse_worker_address(address: str):
+    """Turn a `host:port` string into a TCP address; anything else is a Unix socket path."""
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit():
+        return (host or "127.0.0.1", int(port))
+    return address
+
+def serve_worker(address: str, model_id: str, device: str = "cuda", tiny: bool = False):
+    """Keep one pipeline resident and serve generation jobs over a local IPC channel.
+
+    The pipeline is loaded and warmed up before the listener opens, so a client
+    that manages to connect knows the worker is ready. Messages are dicts:
+    `{"op": "ping"}`, `{"op": "generate", "job": {...}}`,
+    `{"op": "generate_batch", "batch": {...}}` and `{"op": "shutdown"}`; every
+    request gets exactly one `{"ok": bool, ...}` reply. While a job runs,
+    `{"event": "progress", "step": i, "num_steps": n}` messages may precede
+    its reply. A successful generate reply with `"payload": True` is followed
+    by one raw message holding the encoded image bytes (sent with send_bytes,
+    never pickled or base64-encoded); a generate_batch reply lists its
+    `outputs` and is followed by one raw message per output, in order.
+    Generate replies also carry the prompt embedding cache statistics.
+    """
+    import torch
+
+    authkey = os.environ.get("IMAGE_WORKER_AUTHKEY", "").encode() or None
+
+    if tiny:
+        pipe = build_tiny_pipeline()
+        warmup_pipeline(pipe, size=(64, 64))
+    else:
+        pipe = setup_pipeline(model_id, device=device)
+        warmup_pipeline(pipe)
+    embed_cache = PromptEmbedCache.from_env()
+    cache_stats = embed_cache.stats if embed_cache is not None else (lambda: None)
+
+    worker_address = parse_worker_address(address)
+    if isinstance(worker_address, str) and os.path.exists(worker_address):
+        os.remove(worker_address)  # Stale socket from a crashed worker
+
+    with Listener(worker_address, authkey=authkey) as listener:
+        logger.info(f"Image worker ready on {address}")
+        print("WORKER_READY", flush=True)
+        while True:
+            conn = listener.accept()
+            logger.info("Client connected to image worker")
+            try:
+                while True:
+                    try:
+                        message = conn.recv()
+                    except EOFError:
+                        logger.info("Client disconnected from image worker")
+                        break
+
+                    op = message.get("op")
+                    if op == "ping":
+                        conn.send({
+                            "ok": True,
+                            "model_id": "tiny" if tiny else model_id,
+                            "device": "cpu" if tiny else device,
+                            "scheduler": type(pipe.scheduler).__name__
+                        })
+                    elif op == "shutdown":
+                        conn.send({"ok": True})
+                        logger.info("Image worker shutting down")
+                        return
+                    elif op == "generate":
+                        job = message["job"]
+                        try:
+                            # A batch of one, so the job's seed is honoured exactly as in generate_batch
+                            output = generate_image_batch(
+                                pipe=pipe,
+                                jobs=[{
+                                    "prompt": job["prompt"],
+                                    "negative_prompt": job["negative_prompt"],
+                                    "seed": job.get("seed"),
+                                    "output_file": job.get("output_file"),
+                                    "image_format": job.get("image_format", "png"),
+                                }],
+                                num_steps=job["num_steps"],
+                                guidance_scale=job["guidance_scale"],
+                                size=(job["height"], job["width"]),
+                                progress_callback=lambda step, total: conn.send(
+                                    {"event": "progress", "step": step, "num_steps": total}
+                                ),
+                                embed_cache=embed_cache
+                            )[0]
+                            conn.send({
+                                "ok": True,
+                                "output_file": output["output_file"],
+                                "format": output["format"],
+                                "seed": output["seed"],
+                                "payload": True,
+                                "embed_cache": cache_stats()
+                            })
+                            conn.send_bytes(output["image_bytes"])
+                        except Exception as e:
+                            logger.error(f"Worker job failed: {str(e)}")
+                            conn.send({"ok": False, "error": str(e)})
+                        finally:
+                            if torch.cuda.is_available():
+                                torch.cuda.empty_cache()
+                    elif op == "generate_batch":
+                        batch = message["batch"]
+                        try:
+                            outputs = generate_image_batch(
+                                pipe=pipe,
+                                jobs=batch["jobs"],
+                                num_steps=batch["num_steps"],
+                                guidance_scale=batch["guidance_scale"],
+                                size=(batch["height"], batch["width"]),
+                                progress_callback=lambda step, total: conn.send(
+                                    {"event": "progress", "step": step, "num_steps": total}
+                                ),
+                                embed_cache=embed_cache
+                            )
+                            conn.send({
+                                "ok": True,
+                                "outputs": [{k: v for k, v in o.items() if k != "image_bytes"} for o in outputs],
+                                "embed_cache": cache_stats()
+                            })
+                            for output in outputs:
+                                conn.send_bytes(output["image_bytes"])
+                        except Exception as e:
+                            logger.error(f"Worker batch failed: {str(e)}")
+                            conn.send({"ok": False, "error": str(e)})
+                        finally:
+                            if torch.cuda.is_available():
+                                torch.cuda.empty_cache()
+                    else:
+                        conn.send({"ok": False, "error": f"Unknown op: {op}"})
+            finally:
+                conn.close()
+
 def parse_args():
     """Parse command line arguments"""
     parser = argparse.ArgumentParser(description="Generate images using Stable Diffusion")
     parser.add_argument("--single_image", action="store_true", help="Generate a single image")
     parser.add_argument("--prompt", type=str, help="Text prompt for image generation")
-    parser.add_argument("--negative_prompt", type=str, default="blurry, low quality, distorted, deformed, disfigured, bad anatomy, ugly, duplicate, error",
+    parser.add_argument("--negative_prompt", type=str, default=DEFAULT_NEGATIVE_PROMPT,
                       help="Negative prompt for image generation")
     parser.add_argument("--num_steps", type=int, default=30, help="Number of inference steps")
     parser.add_argument("--guidance_scale", type=float, default=7.5, help="Guidance scale")
@@ -327,26 +843,50 @@ def parse_args():
     parser.add_argument("--width", type=int, default=512, help="Image width")
     parser.add_argument("--output_file", type=str, help="Output file path")
     parser.add_argument("--return_base64", action="store_true", help="Return base64 encoded image")
+    parser.add_argument("--output_fd", type=int, default=None,
+                      help="Write the raw encoded image bytes to this inherited file descriptor")
+    parser.add_argument("--image_format", type=str, default="png", choices=sorted(IMAGE_FORMATS),
+                      help="Encoding for the saved and handed-off image")
+    parser.add_argument("--serve", action="store_true", help="Run as a resident worker serving jobs over IPC")
+    parser.add_argument("--worker_address", type=str, default=os.path.join(tempfile.gettempdir(), "image-worker.sock"),
+                      help="Unix socket path or host:port the worker listens on")
+    parser.add_argument("--model_id", type=str, default="CompVis/stable-diffusion-v1-4", help="Diffusers model id")
+    parser.add_argument("--device", type=str, default="cuda", choices=["cuda", "cpu"], help="Device to run the pipeline on")
+    parser.add_argument("--tiny_pipeline", action="store_true",
+                      help="Use a tiny random-weight pipeline on CPU (testing only)")
+    parser.add_argument("--install_deps", action="store_true",
+                      help="pip install missing dependencies instead of failing")
+    parser.add_argument("--profile-startup", dest="profile_startup", action="store_true",
+                      help="Print per-module import times for torch/transformers/diffusers and exit")
     return parser.parse_args()
 
 if __name__ == "__main__":
     try:
         args = parse_args()
 
+        if args.profile_startup:
+            profile_startup()
+            sys.exit(0)
+
         # Check dependencies
-        check_dependencies()
+        check_dependencies(install=args.install_deps)
 
-        if args.single_image:
+        if args.serve:
+            serve_worker(args.worker_address, args.model_id, device=args.device, tiny=args.tiny_pipeline)
+        elif args.single_image:
             if not args.prompt:
                 logger.error("Prompt is required for single image generation")
                 sys.exit(1)
 
             # Setup pipeline
-            pipe = setup_pipeline("CompVis/stable-diffusion-v1-4")
+            if args.tiny_pipeline:
+                pipe = build_tiny_pipeline()
+            else:
+                pipe = setup_pipeline(args.model_id, device=args.device)
 
             try:
                 # Generate the image
-                output_path, base64_image = generate_image(
+                output_path, image_bytes = generate_image(
                     pipe=pipe,
                     prompt=args.prompt,
                     negative_prompt=args.negative_prompt,
@@ -354,11 +894,17 @@ if __name__ == "__main__":
                     num_steps=args.num_steps,
                     guidance_scale=args.guidance_scale,
                     size=(args.height, args.width),
-                    return_base64=args.return_base64
+                    return_bytes=True,
+                    image_format=args.image_format
                 )
                 print(f"Image generated successfully: {output_path}")
-                if base64_image:
-                    print(f"BASE64:{base64_image}")
+                if args.output_fd is not None:
+                    # Raw bytes straight to the caller's pipe, no text encoding
+                    with os.fdopen(args.output_fd, "wb", closefd=True) as handoff:
+                        handoff.write(image_bytes)
+                    logger.info(f"Wrote {len(image_bytes)} bytes to fd {args.output_fd}")
+                if args.return_base64:
+                    print(f"BASE64:{base64.b64encode(image_bytes).decode('utf-8')}")
             finally:
                 clear_gpu_memory()
         else:
@@ -0,0 +1,126 @@
+"""LRU cache of CLIP text-encoder outputs for Stable Diffusion prompts.
+
+Every generation runs the text encoder on its prompt and on its negative
+prompt, and the negative prompt is almost always the same default string.
+`PromptEmbedCache` keeps the encoded `prompt_embeds` tensors keyed by the
+tokenizer / text-encoder identity plus the exact text, so repeated prompts
+skip the encoder and the pipeline is called with `prompt_embeds` and
+`negative_prompt_embeds` instead of strings. Cache misses within one call are
+encoded together in a single batched encoder pass. The cache is bounded by
+the total tensor size and evicts least recently used entries first.
+"""
+import logging
+import os
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def _env_flag(name: str, default: str = "0") -> bool:
+    return os.environ.get(name, default).strip().lower() in ("1", "true", "yes", "on")
+
+
+def model_identity(pipe) -> str:
+    """Identify the tokenizer and text encoder whose outputs are being cached."""
+    tokenizer = pipe.tokenizer
+    text_encoder = pipe.text_encoder
+    # id() separates pipelines loaded from the same checkpoint with different weights (e.g. the tiny test pipeline)
+    return "|".join([
+        str(getattr(tokenizer, "name_or_path", "")),
+        str(getattr(text_encoder.config, "_name_or_path", "")),
+        str(text_encoder.dtype),
+        str(text_encoder.device),
+        str(id(text_encoder)),
+    ])
+
+
+class PromptEmbedCache:
+    """LRU cache mapping (text-encoder identity, text) to a [1, seq, dim] embedding tensor."""
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, max_entries: int = 1024):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        # (identity, text) -> (size_in_bytes, tensor)
+        self._entries: "OrderedDict[Tuple[str, str], tuple]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.encoder_passes = 0
+
+    @classmethod
+    def from_env(cls) -> Optional["PromptEmbedCache"]:
+        """Build the cache from PROMPT_EMBED_CACHE_* environment variables, or None if disabled."""
+        if not _env_flag("PROMPT_EMBED_CACHE_ENABLED", "1"):
+            return None
+        return cls(
+            max_bytes=int(os.environ.get("PROMPT_EMBED_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+            max_entries=int(os.environ.get("PROMPT_EMBED_CACHE_MAX_ENTRIES", "1024")),
+        )
+
+    def encode(self, pipe, texts: List[str]):
+        """Return the embeddings for `texts` stacked into one [len(texts), seq, dim] tensor."""
+        import torch
+
+        identity = model_identity(pipe)
+        found: Dict[str, Any] = {}
+        missing: List[str] = []
+        for text in texts:
+            if text in found or text in missing:
+                continue
+            entry = self._entries.get((identity, text))
+            if entry is None:
+                self.misses += 1
+                missing.append(text)
+            else:
+                self.hits += 1
+                self._entries.move_to_end((identity, text))
+                found[text] = entry[1]
+
+        if missing:
+            # One batched encoder pass for everything not cached
+            embeds, _ = pipe.encode_prompt(missing, pipe.device, 1, False)
+            self.encoder_passes += 1
+            for text, embed in zip(missing, embeds):
+                embed = embed.unsqueeze(0)
+                found[text] = embed
+                self._put((identity, text), embed)
+
+        return torch.cat([found[text] for text in texts], dim=0)
+
+    def pipeline_kwargs(self, pipe, prompts: List[str], negative_prompts: List[str]) -> Dict[str, Any]:
+        """Keyword arguments that replace `prompt` / `negative_prompt` in a pipeline call."""
+        return {
+            "prompt_embeds": self.encode(pipe, prompts),
+            "negative_prompt_embeds": self.encode(pipe, negative_prompts),
+        }
+
+    def _put(self, key: Tuple[str, str], embed) -> None:
+        size = embed.element_size() * embed.nelement()
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (size, embed)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            _, (evicted_size, _) = self._entries.popitem(last=False)
+            self._bytes -= evicted_size
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "encoder_passes": self.encoder_passes,
+        }
@@ -1,8 +1,9 @@
-from typing import List, Optional
+from typing import List, Optional, Tuple
+import argparse
+import asyncio
+import hashlib
 import logging
 import sys
-import torch
-from transformers import pipeline, AutoTokenizer, AutoModelForCausalLM
 import time
 from datetime import datetime
 import os
@@ -61,6 +62,22 @@ style_library = [
     "Haiku-like brevity with vivid nature imagery"
 ]
 
+user_prompts = [
+    "Give me a description of coludy village",
+    "Describe the most unique architectural feature village of the dead",
+    "How do people here make their living in this great town?",
+    "What are the most important cultural traditions here?",
+    "Describe a typical festival or celebration in this society",
+    "Storm willage with faries"
+    "How do they handle resource distribution and trade?",
+    "What are their relationships with neighboring societies like?",
+    "Describe their technological innovations",
+    "What are their spiritual or religious practices?",
+    "How do they educate their young?",
+    "Village sand stone"
+    "Village water sho"
+]
+
 def build_system_message(
     base_instruction: str,
     examples: Optional[List[str]] = None,
@@ -87,6 +104,7 @@ def setup_environment():
     """Setup CUDA and environment variables."""
     try:
         os.environ["PYTORCH_CUDA_ALLOC_CONF"] = "max_split_size_mb:128,expandable_segments:True"
+        import torch
         if not torch.cuda.is_available():
             logger.warning("CUDA is not available. Using CPU (this will be slow)")
             return "cpu"
@@ -148,10 +166,13 @@ def generate_response(
     temperature: float = 0.85,
     max_tokens: int = 512,
     generator=None,
-    tokenizer=None
+    tokenizer=None,
+    prefix_cache=None
 ) -> Optional[str]:
     """
     Generate a response using the Hugging Face transformers pipeline.
+    With a prefix_cache, decoding starts from the cached key/values of the
+    shared prompt header instead of prefilling it again.
     Returns None if generation fails.
     """
     try:
@@ -165,94 +186,85 @@ def generate_response(
         logger.info("Generating response")
         start_time = time.time()
 
-        output = generator(
-            formatted_prompt,
+        sampling = dict(
             do_sample=True,
             temperature=temperature,
             top_p=0.95,
             top_k=40,
             max_new_tokens=max_tokens,
-            num_return_sequences=1,
             repetition_penalty=1.15,
             pad_token_id=tokenizer.eos_token_id,
             eos_token_id=tokenizer.eos_token_id,
-            return_full_text=False,
             length_penalty=1.2,
             no_repeat_ngram_size=4
         )
 
+        if prefix_cache is not None:
+            response_text = prefix_cache.generate(formatted_prompt, **sampling)[0].strip()
+        else:
+            output = generator(
+                formatted_prompt,
+                num_return_sequences=1,
+                return_full_text=False,
+                **sampling
+            )
+            response_text = output[0]['generated_text'].strip()
+
         generation_time = time.time() - start_time
         logger.info(f"Response generated in {generation_time:.2f} seconds")
 
-        response_text = output[0]['generated_text'].strip()
         return response_text
 
     except Exception as e:
         logger.error(f"Error during generation: {str(e)}")
         return None
 
-def generate_random_system_message():
-    """Generate a random combination of prompts."""
-    biome = random.choice(list(biome_prompts.keys()))
-    base_instruction = biome_prompts[biome]
-
-    # Randomly select 1-2 feature prompts
-    num_features = random.randint(1, 2)
-    examples = random.sample(feature_prompts, num_features)
-
-    # Randomly select 1-2 culture constraints
-    num_cultures = random.randint(1, 2)
-    culture_types = random.sample(list(culture_prompts.keys()), num_cultures)
-    constraints = [culture_prompts[c] for c in culture_types]
-
-    # Random style
-    style = random.choice(style_library)
-
+def build_system_data(biome: str, features: List[str], cultures: List[str], style: str) -> dict:
+    """System message and its components for one combination of biome, features, cultures and style."""
     return {
         "biome": biome,
-        "features": examples,
-        "cultures": culture_types,
+        "features": list(features),
+        "cultures": list(cultures),
         "style": style,
         "message": build_system_message(
-            base_instruction=base_instruction,
-            examples=examples,
-            constraints=constraints,
+            base_instruction=biome_prompts[biome],
+            examples=list(features),
+            constraints=[culture_prompts[c] for c in cultures],
             style=style
         )
     }
 
-def generate_random_user_prompt():
-    """Generate a random user prompt."""
-    prompts = [
-        "Give me a description of coludy village",
-        "Describe the most unique architectural feature village of the dead",
-        "How do people here make their living in this great town?",
-        "What are the most important cultural traditions here?",
-        "Describe a typical festival or celebration in this society",
-        "Storm willage with faries"
-        "How do they handle resource distribution and trade?",
-        "What are their relationships with neighboring societies like?",
-        "Describe their technological innovations",
-        "What are their spiritual or religious practices?",
-        "How do they educate their young?",
-        "Village sand stone"
-        "Village water sho"
-    ]
-    return random.choice(prompts)
+def generate_random_system_message(rng=random):
+    """Generate a random combination of prompts, drawing from `rng` (a random.Random for reproducible runs)."""
+    biome = rng.choice(list(biome_prompts.keys()))
 
-def save_results_to_json(results: dict, is_final: bool = False) -> str:
-    """
-    Save results to a JSON file with timestamp in the filename.
-    Returns the filename that was used.
-    """
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    status = "final" if is_final else "intermediate"
-    filename = f"response-agent_{timestamp}_{status}.json"
+    # Randomly select 1-2 feature prompts
+    num_features = rng.randint(1, 2)
+    examples = rng.sample(feature_prompts, num_features)
 
-    with open(filename, "w", encoding="utf-8") as f:
-        json.dump(results, f, indent=2, ensure_ascii=False)
+    # Randomly select 1-2 culture constraints
+    num_cultures = rng.randint(1, 2)
+    culture_types = rng.sample(list(culture_prompts.keys()), num_cultures)
 
-    return filename
+    # Random style
+    style = rng.choice(style_library)
+
+    return build_system_data(biome, examples, culture_types, style)
+
+def generate_random_user_prompt(rng=random):
+    """Generate a random user prompt."""
+    return rng.choice(user_prompts)
+
+def scenario_space():
+    """The combination space the random generators above draw from."""
+    from scenario_scheduler import ScenarioSpace
+    return ScenarioSpace(
+        biomes=list(biome_prompts.keys()),
+        features=feature_prompts,
+        cultures=list(culture_prompts.keys()),
+        styles=style_library,
+        user_prompts=user_prompts
+    )
 
 def test_prompt_generation():
     """Test function to demonstrate full prompt generation with all components."""
@@ -298,141 +310,337 @@ def test_prompt_generation():
     )
     print(final_prompt)
 
-if __name__ == "__main__":
-    # Add test before main execution
-    print("\nTesting Prompt Generation:")
-    print("=" * 50)
-    test_prompt_generation()
-    print("=" * 50)
-    print("\nStarting Main Generation:")
+def scenario_seed(master_seed: int, index: int) -> Tuple[int, str]:
+    """Stable (seed, scenario_id) for scenario `index` of a run started with `master_seed`."""
+    digest = hashlib.sha256(f"{master_seed}:{index}".encode("utf-8")).hexdigest()
+    return int(digest[:8], 16), digest[:12]
 
-    start_timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    results = {
-        "timestamp": datetime.now().isoformat(),
-        "total_attempts": 10,
-        "successful_generations": 0,
-        "failed_generations": 0,
-        "generations": []
+def build_scenario(master_seed: int, index: int, choice: Optional[dict] = None) -> dict:
+    """Scenario `index` of the run; the same master seed always yields the same scenario.
+
+    `choice` is a scheduled combination from CoverageScheduler; without one the
+    combination is drawn at random from the scenario's seed.
+    """
+    seed, scenario_id = scenario_seed(master_seed, index)
+    if choice is not None:
+        system_data = build_system_data(choice["biome"], choice["features"], choice["cultures"], choice["style"])
+        user_prompt = choice["user_prompt"]
+    else:
+        rng = random.Random(seed)
+        system_data = generate_random_system_message(rng)
+        user_prompt = generate_random_user_prompt(rng)
+    return {
+        "index": index,
+        "scenario_id": scenario_id,
+        "seed": seed,
+        "system_data": system_data,
+        "user_prompt": user_prompt,
+        "formatted_prompt": build_prompt(
+            system_msg=system_data["message"],
+            user_prompt=user_prompt
+        )
     }
 
-    num_generations = 10
-    logger.info(f"Attempting {num_generations} different scenarios")
+def build_scenarios(num_scenarios: int, master_seed: int, completed=frozenset(), scheduler=None) -> List[dict]:
+    """Scenarios 0..num_scenarios-1 of the run, leaving out the scenario ids in `completed`.
 
+    With a scheduler, scenario i is its i-th combination, so a resumed run
+    with the same seed and exclusions maps every index to the same scenario.
+    """
+    choices = iter(scheduler) if scheduler is not None else None
+    scenarios = []
+    for index in range(num_scenarios):
+        choice = next(choices, None) if choices is not None else None
+        if choices is not None and choice is None:
+            logger.warning(f"Scenario space exhausted after {index} unseen combinations")
+            break
+        if scenario_seed(master_seed, index)[1] in completed:
+            continue
+        scenarios.append(build_scenario(master_seed, index, choice))
+    return scenarios
+
+def scenario_record(result) -> dict:
+    """Turn a ScenarioResult into the record appended to the run file."""
+    system_data = result.scenario["system_data"]
+    record = {
+        "system_data": {
+            "biome": system_data["biome"],
+            "features": system_data["features"],
+            "cultures": system_data["cultures"],
+            "style": system_data["style"],
+            "full_message": system_data["message"]
+        },
+        "user_prompt": result.scenario["user_prompt"],
+        "formatted_prompt": result.scenario["formatted_prompt"],
+        "response": result.response if result.success else "Generation failed",
+        "generation_number": result.scenario["index"] + 1,
+        "scenario_id": result.scenario["scenario_id"],
+        "seed": result.scenario["seed"],
+        "generation_time": f"{result.latency or 0.0:.2f}s",
+        "tokens": result.tokens,
+        "success": result.success
+    }
+    if result.error:
+        record["error"] = result.error
+    return record
+
+def parse_args():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description="Generate village scenarios with Llama 2 chat")
+    parser.add_argument("--prompt_test_only", action="store_true",
+                        help="Only run the prompt-building test (no model, torch is never imported)")
+    parser.add_argument("--no_prefix_cache", action="store_true",
+                        help="Prefill the full prompt every time instead of reusing the shared header's KV cache")
+    parser.add_argument("--backend", type=str, choices=["hf", "ollama"], default="hf",
+                        help="In-process transformers model or an Ollama-compatible HTTP endpoint")
+    parser.add_argument("--num_scenarios", type=int, default=10, help="Number of scenarios to generate")
+    parser.add_argument("--concurrency", type=int, default=4, help="Maximum scenarios in flight")
+    parser.add_argument("--rate_limit", type=float, default=None, help="Maximum scenario starts per second")
+    parser.add_argument("--timeout", type=float, default=None, help="Per-scenario timeout in seconds")
+    parser.add_argument("--ollama_url", type=str, default=os.environ.get("OLLAMA_URL", "http://localhost:11434"))
+    parser.add_argument("--ollama_model", type=str, default="llama2")
+    parser.add_argument("--stub_ollama", action="store_true",
+                        help="Serve the Ollama backend from the local stand-in in stub_ollama.py")
+    parser.add_argument("--stub_latency", type=float, default=0.5, help="Seconds per stand-in generation")
+    parser.add_argument("--output", type=str, default=None,
+                        help="JSONL run file (default: response-agent_<timestamp>.jsonl)")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="Master seed; scenario i always gets the same prompt and sampling seed (default: random)")
+    parser.add_argument("--resume", type=str, default=None, metavar="RUN_FILE",
+                        help="Continue an interrupted run: reuse its seed and generate only the scenarios it is missing")
+    parser.add_argument("--schedule", type=str, choices=["random", "unique", "stratified"], default="random",
+                        help="random: independent draws (duplicates possible); unique: sample the combination space "
+                             "without replacement; stratified: unique, round-robin over --strata")
+    parser.add_argument("--strata", type=str, default="biome,style",
+                        help="Comma-separated dimensions covered first by --schedule stratified "
+                             "(biome, features, cultures, style, user_prompt)")
+    parser.add_argument("--skip_seen", type=str, nargs="*", default=[], metavar="RESULT_FILE",
+                        help="Result files (.jsonl run files or results JSON) whose combinations are not generated again")
+    parser.add_argument("--no_export_json", action="store_true",
+                        help="Skip writing the legacy results JSON next to the run file at the end")
+    return parser.parse_args()
+
+async def run_scenarios(args, scenarios: List[dict], backend, on_result):
+    """Run the scenarios on `backend` (None: the Ollama backend) and return (runner, results)."""
+    from scenario_runner import OllamaBackend, ScenarioRunner
+
+    stub = None
     try:
-        # Initialize model and tokenizer once, outside the loop
-        logger.info("Setting up environment")
-        device = setup_environment()
-
-        logger.info("Loading model and tokenizer")
-        model_name = "NousResearch/Llama-2-7b-chat-hf"
-
-        tokenizer = AutoTokenizer.from_pretrained(
-            model_name,
-            trust_remote_code=True,
-            use_fast=True
+        if backend is None:
+            from ollama_client import OllamaClient
+            ollama_url = args.ollama_url
+            if args.stub_ollama:
+                from stub_ollama import start_stub
+                stub, ollama_url = await start_stub(latency=args.stub_latency)
+                logger.info(f"Started stand-in Ollama at {ollama_url}")
+            backend = OllamaBackend(OllamaClient(ollama_url, pool_size=args.concurrency), model=args.ollama_model)
+
+        runner = ScenarioRunner(
+            backend,
+            concurrency=args.concurrency,
+            rate_limit=args.rate_limit,
+            timeout=args.timeout,
+            on_result=on_result,
+            keep_outputs=False
         )
+        return runner, await runner.run(scenarios)
+    finally:
+        if stub is not None:
+            await stub.cleanup()
 
-        model = AutoModelForCausalLM.from_pretrained(
-            model_name,
-            torch_dtype=torch.float16,
-            device_map="auto",
-            load_in_4bit=True,
-            bnb_4bit_quant_type="nf4",
-            bnb_4bit_compute_dtype=torch.float16,
-            low_cpu_mem_usage=True
-        )
+if __name__ == "__main__":
+    args = parse_args()
 
-        generator = pipeline(
-            "text-generation",
-            model=model,
-            tokenizer=tokenizer,
-            device_map="auto"
-        )
+    # Add test before main execution
+    print("\nTesting Prompt Generation:")
+    print("=" * 50)
+    test_prompt_generation()
+    print("=" * 50)
+    if args.prompt_test_only:
+        sys.exit(0)
+    print("\nStarting Main Generation:")
+
+    # Shared modules live one directory up, next to server.py
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-        for i in range(num_generations):
-            generation_start_time = time.time()
-            logger.info(f"Generating scenario {i+1}/{num_generations}")
+    from result_sink import JsonlResultSink, convert_to_json, read_summary
 
-            try:
-                # Generate random system message
-                system_data = generate_random_system_message()
-                user_prompt = generate_random_user_prompt()
+    start_timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    num_generations = args.num_scenarios
+    master_seed = args.seed if args.seed is not None else random.SystemRandom().randrange(2 ** 32)
+    run_file = args.output or f"response-agent_{start_timestamp}.jsonl"
+
+    if args.resume:
+        # The run file is the checkpoint: its sidecar holds the seed, its records the finished scenarios
+        run_file = args.resume
+        checkpoint = read_summary(run_file)
+        if checkpoint is None or "seed" not in checkpoint:
+            logger.error(f"No checkpoint found for {run_file}; cannot resume")
+            sys.exit(1)
+        if args.seed is not None and args.seed != checkpoint["seed"]:
+            logger.warning(f"Ignoring --seed {args.seed}: resuming with the run's seed {checkpoint['seed']}")
+        master_seed = checkpoint["seed"]
+        num_generations = checkpoint.get("total_attempts", num_generations)
+        # The schedule must match the interrupted run for indexes to map to the same scenarios
+        args.schedule = checkpoint.get("schedule", "random")
+        args.strata = ",".join(checkpoint.get("strata", [])) or args.strata
+        args.skip_seen = checkpoint.get("skip_seen", [])
+
+    # Results are appended to the run file as they finish; only counters and finished ids stay in memory
+    strata = [dim.strip() for dim in args.strata.split(",") if dim.strip()]
+    sink = JsonlResultSink(run_file, metadata={
+        "total_attempts": num_generations,
+        "seed": master_seed,
+        "schedule": args.schedule,
+        "strata": strata if args.schedule == "stratified" else [],
+        "skip_seen": args.skip_seen
+    })
+
+    logger.info(f"Attempting {num_generations} different scenarios (seed {master_seed})")
+    prefix_cache = None
+    runner = None
+    scenario_results = []
+
+    def on_result(result):
+        sink.write(scenario_record(result))
+        status = "Success" if result.success else "Failed"
+
+        system_data = result.scenario["system_data"]
+        print(f"\nScenario {result.scenario['index'] + 1} completed ({status})")
+        print("-" * 50)
+        print(f"Biome: {system_data['biome']}")
+        print(f"Style: {system_data['style']}")
+        print(f"Prompt: {result.scenario['user_prompt']}")
+        print(f"Time taken: {result.latency:.2f}s")
 
-                # Generate response using the new format
-                response_text = generate_response(
-                    system_msg=system_data["message"],
-                    prompt=user_prompt,
+    try:
+        space = scenario_space()
+        seen = set()
+        scheduler = None
+        if args.skip_seen:
+            from scenario_scheduler import load_seen
+            seen = load_seen(space, [path for path in args.skip_seen if os.path.abspath(path) != os.path.abspath(run_file)])
+        if args.schedule != "random":
+            from scenario_scheduler import CoverageScheduler
+            scheduler = CoverageScheduler(
+                space,
+                seed=master_seed,
+                strata=strata if args.schedule == "stratified" else (),
+                seen=seen
+            )
+
+        scenarios = build_scenarios(num_generations, master_seed, completed=sink.completed, scheduler=scheduler)
+        if args.resume:
+            logger.info(f"Resuming {run_file}: {len(sink.completed)} scenarios done, {len(scenarios)} to generate")
+        backend = None
+
+        if args.backend == "hf":
+            from scenario_runner import HFBackend
+
+            # Heavy imports are deferred until a model is actually needed
+            import torch
+            from transformers import pipeline, AutoTokenizer, set_seed
+            from model_snapshots import bnb_4bit_config, load_model
+
+            # Initialize model and tokenizer once, before any scenario runs
+            logger.info("Setting up environment")
+            device = setup_environment()
+
+            logger.info("Loading model and tokenizer")
+            model_name = "NousResearch/Llama-2-7b-chat-hf"
+
+            tokenizer = AutoTokenizer.from_pretrained(
+                model_name,
+                trust_remote_code=True,
+                use_fast=True
+            )
+
+            # Pre-quantized snapshot when one exists, otherwise quantize and save one
+            model = load_model(
+                model_name,
+                torch_dtype=torch.float16,
+                quantization_config=bnb_4bit_config(),
+                device_map="auto",
+                low_cpu_mem_usage=True
+            )
+
+            generator = pipeline(
+                "text-generation",
+                model=model,
+                tokenizer=tokenizer,
+                device_map="auto"
+            )
+
+            if not args.no_prefix_cache:
+                from prefix_cache import PrefixCache
+                prefix_cache = PrefixCache(model, tokenizer)
+
+            def generate_scenario(scenario):
+                # Seed sampling per scenario so a resumed run regenerates the same text
+                set_seed(scenario["seed"])
+                return generate_response(
+                    system_msg=scenario["system_data"]["message"],
+                    prompt=scenario["user_prompt"],
                     generator=generator,
-                    tokenizer=tokenizer
+                    tokenizer=tokenizer,
+                    prefix_cache=prefix_cache
                 )
 
-                generation_time = time.time() - generation_start_time
-
-                # Store results
-                generation_result = {
-                    "system_data": {
-                        "biome": system_data["biome"],
-                        "features": system_data["features"],
-                        "cultures": system_data["cultures"],
-                        "style": system_data["style"],
-                        "full_message": system_data["message"]
-                    },
-                    "user_prompt": user_prompt,
-                    "formatted_prompt": build_prompt(
-                        system_msg=system_data["message"],
-                        user_prompt=user_prompt
-                    ),
-                    "response": response_text if response_text else "Generation failed",
-                    "generation_number": i + 1,
-                    "generation_time": f"{generation_time:.2f}s",
-                    "success": bool(response_text)
-                }
-
-                results["generations"].append(generation_result)
-
-                if response_text:
-                    results["successful_generations"] += 1
-                    status = "Success"
-                else:
-                    results["failed_generations"] += 1
-                    status = "Failed"
-
-                print(f"\nScenario {i+1} completed ({status})")
-                print("-" * 50)
-                print(f"Biome: {system_data['biome']}")
-                print(f"Style: {system_data['style']}")
-                print(f"Prompt: {user_prompt}")
-                print(f"Time taken: {generation_time:.2f}s")
-
-                # Save intermediate results after each generation
-                filename = save_results_to_json(results)
-                logger.info(f"Saved intermediate results to {filename}")
-
-                # Small delay between generations
-                if i < num_generations - 1:
-                    time.sleep(2)
-
-            except Exception as e:
-                logger.error(f"Error in generation {i+1}: {str(e)}")
-                results["failed_generations"] += 1
-                generation_result = {
-                    "generation_number": i + 1,
-                    "error": str(e),
-                    "success": False
-                }
-                results["generations"].append(generation_result)
-                continue
+            # One model instance: generations run one at a time on a single worker thread
+            backend = HFBackend(generate_scenario, tokenizer=tokenizer)
+
+        runner, scenario_results = asyncio.run(run_scenarios(args, scenarios, backend, on_result))
 
     except Exception as e:
         logger.error(f"Fatal error in main process: {str(e)}")
     finally:
-        # Final save of results with timestamp
-        final_filename = save_results_to_json(results, is_final=True)
+        summary = runner.summarize(scenario_results) if runner is not None else None
+        coverage = None
+        try:
+            from scenario_scheduler import coverage_report, load_seen
+            sink.sync()
+            space = scenario_space()
+            coverage = coverage_report(space, load_seen(space, args.skip_seen + [run_file]), strata or ("biome", "style"))
+        except Exception as e:
+            logger.warning(f"Could not compute coverage: {e}")
+        extra = {}
+        if summary:
+            extra["summary"] = summary
+        if coverage:
+            extra["coverage"] = coverage
+        sink.close(extra)
+        results = sink.summary
+
+        # The image pipeline reads the legacy results JSON
+        final_filename = run_file
+        if not args.no_export_json:
+            final_filename = convert_to_json(run_file, f"{os.path.splitext(run_file)[0]}_final.json")
 
         # Cleanup
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-
+        if "torch" in sys.modules:
+            import torch
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+        if prefix_cache is not None:
+            logger.info(f"Prefix cache: {prefix_cache.stats()}")
+        if coverage:
+            logger.info(
+                f"Coverage: {coverage['unique_combinations']}/{coverage['space_size']} combinations "
+                f"({coverage['coverage']:.2%}), {' x '.join(coverage['strata']['dimensions'])} "
+                f"{coverage['strata']['covered']}/{coverage['strata']['total']}"
+            )
+        if summary:
+            logger.info("=" * 50)
+            logger.info(
+                f"Throughput ({summary['backend']}, concurrency {summary['concurrency']}): "
+                f"{summary['scenarios_per_min']} scenarios/min, {summary['tokens_per_sec']} tokens/sec"
+            )
+            logger.info(
+                f"Latency p50 {summary['latency_p50']}s, p95 {summary['latency_p95']}s, "
+                f"max {summary['latency_max']}s; {summary['timed_out']} timed out"
+            )
+            logger.info("=" * 50)
         logger.info(f"Process completed. Successful generations: {results['successful_generations']}")
         logger.info(f"Failed generations: {results['failed_generations']}")
         logger.info(f"Final results saved to {final_filename}")
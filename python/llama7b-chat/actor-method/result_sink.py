@@ -0,0 +1,253 @@
+"""Append-only JSONL sink for generation run results.
+
+Each finished generation is appended to one run file as a single compact
+JSON line. The file is flushed after every record and fsynced every
+`fsync_every` records or `fsync_interval` seconds. A small
+`<run>.summary.json` sidecar holds the run counters and is replaced
+atomically at each fsync and on close. Memory stays constant and every byte
+is written once, however long the run is.
+
+`convert_to_json()` turns a run file back into the `{"timestamp", ...,
+"generations": [...]}` document the generator used to write, ordered by
+generation number, so `batch_generate_images()` can read it unchanged.
+
+A run file doubles as the checkpoint of a resumable run: reopening it
+rebuilds the set of completed scenario ids from its records, and a scenario
+retried after a failure counts once, with its latest outcome:
+
+    python result_sink.py convert response-agent_20250101_120000.jsonl -o ../actor-method/response_data/run.json
+    python result_sink.py summary response-agent_20250101_120000.jsonl
+"""
+import argparse
+import json
+import logging
+import os
+import time
+from datetime import datetime
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_SUFFIX = ".summary.json"
+
+
+def summary_path(run_path: str) -> str:
+    return run_path + SUMMARY_SUFFIX
+
+
+def _atomic_write_json(path: str, data: Dict[str, Any]) -> None:
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def record_key(record: Dict[str, Any]) -> Any:
+    """Identity of the scenario a record belongs to."""
+    return record.get("scenario_id", record.get("generation_number"))
+
+
+def _ends_with_newline(path: str) -> bool:
+    with open(path, "rb") as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+
+class JsonlResultSink:
+    """Appends one JSON line per generation and keeps a summary sidecar next to the run file."""
+
+    def __init__(
+        self,
+        path: str,
+        metadata: Optional[Dict[str, Any]] = None,
+        fsync_every: int = 20,
+        fsync_interval: float = 5.0,
+    ):
+        self.path = path
+        self.fsync_every = max(1, fsync_every)
+        self.fsync_interval = fsync_interval
+        self.summary: Dict[str, Any] = {
+            "timestamp": datetime.now().isoformat(),
+            "run_file": os.path.basename(path),
+            "records": 0,
+            "successful_generations": 0,
+            "failed_generations": 0,
+            "complete": False,
+        }
+        # Scenario ids whose latest record succeeded / failed
+        self.completed = set()
+        self.failed = set()
+
+        # Appending to an existing run file continues it; the records, not the sidecar, are authoritative
+        previous = read_summary(path)
+        if previous is not None:
+            self.summary["timestamp"] = previous.get("timestamp", self.summary["timestamp"])
+        if os.path.exists(path):
+            for record in iter_records(path):
+                self._count(record)
+        self.summary.update(metadata or {})
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._file = open(path, "a", encoding="utf-8")
+        if self._file.tell() and not _ends_with_newline(path):
+            # Start on a fresh line after a record cut short by a crash
+            self._file.write("\n")
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self._write_summary()
+
+    def write(self, record: Dict[str, Any]) -> None:
+        """Append one generation record."""
+        self._file.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+        self._file.flush()
+        self._count(record)
+        self._unsynced += 1
+        if self._unsynced >= self.fsync_every or time.monotonic() - self._last_sync >= self.fsync_interval:
+            self.sync()
+
+    def _count(self, record: Dict[str, Any]) -> None:
+        key = record_key(record)
+        if record.get("success"):
+            self.completed.add(key)
+            self.failed.discard(key)
+        elif key not in self.completed:
+            self.failed.add(key)
+        self.summary["records"] += 1
+        self.summary["successful_generations"] = len(self.completed)
+        self.summary["failed_generations"] = len(self.failed)
+
+    def sync(self) -> None:
+        """fsync the run file and refresh the summary sidecar."""
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self._write_summary()
+
+    def _write_summary(self) -> None:
+        self.summary["updated_at"] = datetime.now().isoformat()
+        self.summary["bytes"] = self._file.tell()
+        _atomic_write_json(summary_path(self.path), self.summary)
+
+    def close(self, extra: Optional[Dict[str, Any]] = None) -> None:
+        """Final fsync; `extra` (e.g. the throughput summary) is merged into the sidecar."""
+        if self._file.closed:
+            return
+        self.summary.update(extra or {})
+        self.summary["complete"] = True
+        self.sync()
+        self._file.close()
+        logger.info(f"Wrote {self.summary['records']} results to {self.path}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def read_summary(run_path: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(summary_path(run_path), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def iter_records(run_path: str, with_offsets: bool = False) -> Iterator[Any]:
+    """Yield the records of a run file; a line cut short by a crash is skipped with a warning."""
+    with open(run_path, "rb") as f:
+        offset = 0
+        for line_number, line in enumerate(f, 1):
+            start, offset = offset, offset + len(line)
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning(f"Skipping unreadable line {line_number} of {run_path}")
+                continue
+            yield (start, record) if with_offsets else record
+
+
+def _latest_records(run_path: str) -> Dict[Any, Tuple[int, bool, int]]:
+    """scenario id -> (generation number, success, offset) of the record that counts for it."""
+    latest: Dict[Any, Tuple[int, bool, int]] = {}
+    for offset, record in iter_records(run_path, with_offsets=True):
+        key = record_key(record)
+        success = bool(record.get("success"))
+        # A success is never replaced by a later failure of the same scenario
+        if key in latest and latest[key][1] and not success:
+            continue
+        latest[key] = (record.get("generation_number", 0), success, offset)
+    return latest
+
+
+def _count(run_path: str) -> Tuple[int, int]:
+    latest = _latest_records(run_path)
+    successful = sum(1 for _, success, _ in latest.values() if success)
+    return successful, len(latest) - successful
+
+
+def convert_to_json(run_path: str, output_path: Optional[str] = None) -> str:
+    """Write the run as the legacy results document, streaming one generation at a time."""
+    output_path = output_path or os.path.splitext(run_path)[0] + ".json"
+    summary = read_summary(run_path) or {}
+    latest = _latest_records(run_path)
+    successful = sum(1 for _, success, _ in latest.values() if success)
+    failed = len(latest) - successful
+
+    # Completion order differs from scenario order under concurrency: sort an index of offsets
+    index = sorted((number, offset) for number, _, offset in latest.values())
+
+    tmp_path = f"{output_path}.tmp-{os.getpid()}"
+    with open(run_path, "rb") as source, open(tmp_path, "w", encoding="utf-8") as out:
+        header = {
+            "timestamp": summary.get("timestamp", datetime.now().isoformat()),
+            "total_attempts": summary.get("total_attempts", successful + failed),
+            "successful_generations": successful,
+            "failed_generations": failed,
+        }
+        if "summary" in summary:
+            header["summary"] = summary["summary"]
+        out.write(json.dumps(header, indent=2, ensure_ascii=False)[:-2])
+        out.write(',\n  "generations": [')
+        for position, (_, offset) in enumerate(index):
+            source.seek(offset)
+            record = json.loads(source.readline())
+            body = json.dumps(record, indent=2, ensure_ascii=False).replace("\n", "\n    ")
+            out.write(("," if position else "") + "\n    " + body)
+        out.write("\n  ]\n}" if index else "]\n}")
+    os.replace(tmp_path, output_path)
+    logger.info(f"Converted {len(index)} results from {run_path} to {output_path}")
+    return output_path
+
+
+def parse_args():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description="Inspect and convert JSONL generation run files")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    convert = subparsers.add_parser("convert", help="Write the legacy results JSON for a run file")
+    convert.add_argument("run_file", type=str)
+    convert.add_argument("-o", "--output", type=str, default=None, help="Defaults to the run file with .json")
+
+    summary = subparsers.add_parser("summary", help="Print the run's summary sidecar")
+    summary.add_argument("run_file", type=str)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    args = parse_args()
+    if args.command == "convert":
+        print(convert_to_json(args.run_file, args.output))
+    else:
+        summary = read_summary(args.run_file)
+        if summary is None:
+            successful, failed = _count(args.run_file)
+            summary = {"records": successful + failed, "successful_generations": successful,
+                       "failed_generations": failed, "complete": False}
+        print(json.dumps(summary, indent=2, ensure_ascii=False))
@@ -0,0 +1,257 @@
+"""Concurrent runner for actor-method scenario generation.
+
+`ScenarioRunner` executes a list of scenarios against a backend with a bound
+on in-flight requests, an optional start-rate limit and a per-scenario
+timeout, and returns the results in scenario order no matter which finished
+first. Two backends are provided:
+
+* `HFBackend` wraps the in-process transformers generator. One model on one
+  GPU cannot run two `generate()` calls at once, so it executes on a small
+  thread pool (one worker by default) and the runner's concurrency is capped
+  at the number of workers.
+* `OllamaBackend` sends each scenario to an Ollama-compatible HTTP endpoint
+  through the shared `OllamaClient`, where concurrency overlaps requests.
+  `stub_ollama.py` is a local stand-in for running it without a model.
+
+`summarize()` reports scenarios/min, tokens/sec and latency percentiles for
+the run. Latency and the timeout both start when a backend actually begins
+generating, not when the scenario is submitted to it.
+"""
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Sampling settings of generate_response(), in Ollama's option names
+OLLAMA_OPTIONS = {
+    "temperature": 0.85,
+    "top_p": 0.95,
+    "top_k": 40,
+    "num_predict": 512,
+    "repeat_penalty": 1.15,
+}
+
+
+class ScenarioResult:
+    """Outcome of one scenario; `index` is its position in the submitted list."""
+
+    def __init__(self, index: int, scenario: Dict[str, Any]):
+        self.index = index
+        self.scenario = scenario
+        self.response: Optional[str] = None
+        self.tokens = 0
+        self.error: Optional[str] = None
+        self.timed_out = False
+        self.success = False
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    @property
+    def latency(self) -> Optional[float]:
+        if self.started_at is None or self.finished_at is None:
+            return None
+        return self.finished_at - self.started_at
+
+
+class HFBackend:
+    """In-process transformers backend around a blocking `generate_fn(scenario) -> Optional[str]`."""
+
+    name = "hf"
+
+    def __init__(self, generate_fn: Callable[[Dict[str, Any]], Optional[str]], tokenizer=None, workers: int = 1):
+        self.generate_fn = generate_fn
+        self.tokenizer = tokenizer
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="scenario-hf")
+
+    def _count_tokens(self, text: str) -> int:
+        if self.tokenizer is None:
+            return len(text.split())
+        return len(self.tokenizer(text, add_special_tokens=False)["input_ids"])
+
+    def _generate(self, scenario: Dict[str, Any], loop, on_start: Optional[Callable[[], None]]) -> Tuple[Optional[str], int]:
+        if on_start is not None:
+            # Runs on the worker thread, so the start is reported once the scenario leaves the executor queue
+            loop.call_soon_threadsafe(on_start)
+        text = self.generate_fn(scenario)
+        return text, self._count_tokens(text) if text else 0
+
+    async def generate(self, scenario: Dict[str, Any], on_start: Optional[Callable[[], None]] = None) -> Tuple[Optional[str], int]:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._generate, scenario, loop, on_start)
+
+    async def close(self) -> None:
+        # A timed-out generate() cannot be interrupted; let it finish in the background
+        self.executor.shutdown(wait=False)
+
+
+class OllamaBackend:
+    """Ollama-compatible HTTP backend; token counts come from Ollama's `eval_count`."""
+
+    name = "ollama"
+
+    def __init__(self, client, model: str = "llama2", options: Optional[Dict[str, Any]] = None):
+        self.client = client
+        self.model = model
+        self.options = dict(OLLAMA_OPTIONS if options is None else options)
+
+    async def generate(self, scenario: Dict[str, Any], on_start: Optional[Callable[[], None]] = None) -> Tuple[Optional[str], int]:
+        if on_start is not None:
+            on_start()
+        options = self.options
+        if "seed" in scenario:
+            options = dict(options, seed=scenario["seed"])
+        reply = await self.client.generate(scenario["formatted_prompt"], model=self.model, options=options)
+        text = reply.get("response", "").strip()
+        return text or None, int(reply.get("eval_count") or len(text.split()))
+
+    async def close(self) -> None:
+        await self.client.close()
+
+
+class RateLimiter:
+    """Spaces scenario starts at least 1/rate seconds apart (no limit when rate is None or 0)."""
+
+    def __init__(self, rate: Optional[float]):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._next_start = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self) -> None:
+        if not self.interval:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next_start - now
+            self._next_start = max(now, self._next_start) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class ScenarioRunner:
+    """Run scenarios with bounded concurrency, rate limiting and per-scenario timeouts."""
+
+    def __init__(
+        self,
+        backend,
+        concurrency: int = 4,
+        rate_limit: Optional[float] = None,
+        timeout: Optional[float] = None,
+        on_result: Optional[Callable[[ScenarioResult], Optional[Awaitable[None]]]] = None,
+        keep_outputs: bool = True,
+    ):
+        self.backend = backend
+        self.concurrency = max(1, concurrency)
+        workers = getattr(backend, "workers", None)
+        if workers and self.concurrency > workers:
+            # Scenarios beyond the backend's workers would only wait in its queue
+            logger.warning(f"Capping concurrency at {workers}: the {backend.name} backend runs {workers} scenario(s) at a time")
+            self.concurrency = workers
+        self.rate_limiter = RateLimiter(rate_limit)
+        self.timeout = timeout
+        self.on_result = on_result
+        # With keep_outputs=False, responses are dropped once on_result has stored them,
+        # so long runs only hold per-scenario timings in memory
+        self.keep_outputs = keep_outputs
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    async def _run_one(self, result: ScenarioResult, semaphore: asyncio.Semaphore) -> ScenarioResult:
+        async with semaphore:
+            await self.rate_limiter.wait()
+            try:
+                result.response, result.tokens = await self._generate(result)
+                if not result.response:
+                    result.error = "Generation failed"
+            except asyncio.TimeoutError:
+                result.timed_out = True
+                result.error = f"Timed out after {self.timeout}s"
+            except Exception as e:
+                result.error = str(e)
+            result.finished_at = time.monotonic()
+            if result.started_at is None:
+                result.started_at = result.finished_at
+            result.success = result.error is None
+
+        status = "ok" if result.success else f"failed: {result.error}"
+        logger.info(f"Scenario {result.scenario.get('index', result.index) + 1} finished in {result.latency:.2f}s ({status})")
+        if self.on_result is not None:
+            outcome = self.on_result(result)
+            if asyncio.iscoroutine(outcome):
+                await outcome
+        if not self.keep_outputs:
+            result.response = None
+            result.scenario = None
+        return result
+
+    async def _generate(self, result: ScenarioResult) -> Tuple[Optional[str], int]:
+        """Call the backend, timing out `self.timeout` seconds after it starts generating."""
+        started = asyncio.Event()
+
+        def on_start() -> None:
+            result.started_at = time.monotonic()
+            started.set()
+
+        task = asyncio.ensure_future(self.backend.generate(result.scenario, on_start=on_start))
+        if self.timeout is None:
+            return await task
+        waiter = asyncio.ensure_future(started.wait())
+        try:
+            # Time spent queued inside the backend counts towards neither latency nor the timeout
+            await asyncio.wait({task, waiter}, return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        finally:
+            waiter.cancel()
+        if task.done():
+            return task.result()
+        remaining = self.timeout - (time.monotonic() - result.started_at)
+        return await asyncio.wait_for(task, timeout=max(0.0, remaining))
+
+    async def run(self, scenarios: List[Dict[str, Any]]) -> List[ScenarioResult]:
+        """Run every scenario and return the results in the order they were given."""
+        semaphore = asyncio.Semaphore(self.concurrency)
+        logger.info(
+            f"Running {len(scenarios)} scenarios on the {self.backend.name} backend "
+            f"(concurrency={self.concurrency}, timeout={self.timeout}s)"
+        )
+        self.started_at = time.monotonic()
+        results = [ScenarioResult(i, scenario) for i, scenario in enumerate(scenarios)]
+        try:
+            await asyncio.gather(*(self._run_one(result, semaphore) for result in results))
+        finally:
+            self.finished_at = time.monotonic()
+            await self.backend.close()
+        return results
+
+    def summarize(self, results: List[ScenarioResult]) -> Dict[str, Any]:
+        """Throughput and latency of a finished run."""
+        wall = (self.finished_at or time.monotonic()) - (self.started_at or time.monotonic())
+        succeeded = [r for r in results if r.success]
+        latencies = sorted(r.latency for r in results if r.latency is not None)
+        tokens = sum(r.tokens for r in succeeded)
+
+        def pick(q: float) -> Optional[float]:
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(q * len(latencies)))], 3)
+
+        return {
+            "backend": self.backend.name,
+            "scenarios": len(results),
+            "successful": len(succeeded),
+            "failed": len(results) - len(succeeded),
+            "timed_out": sum(1 for r in results if r.timed_out),
+            "wall_seconds": round(wall, 3),
+            "scenarios_per_min": round(len(succeeded) / wall * 60, 2) if wall > 0 else None,
+            "tokens": tokens,
+            "tokens_per_sec": round(tokens / wall, 2) if wall > 0 else None,
+            "latency_p50": pick(0.50),
+            "latency_p95": pick(0.95),
+            "latency_max": round(latencies[-1], 3) if latencies else None,
+            "concurrency": self.concurrency,
+        }
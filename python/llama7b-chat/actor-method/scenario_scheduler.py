@@ -0,0 +1,197 @@
+"""Coverage-driven scheduling over the finite space of scenario combinations.
+
+A scenario is one choice per dimension: biome, a 1-2 element subset of the
+feature prompts, a 1-2 element subset of the culture prompts, style and user
+prompt. `ScenarioSpace` numbers every combination with a mixed-radix index,
+so no combination list is ever materialised. `CoverageScheduler` walks that
+index space without replacement in a seeded pseudo-random order. An affine
+permutation `(a * i + b) mod n` with `gcd(a, n) == 1` visits every index
+exactly once in O(1) memory.
+
+With strata (for example ("biome", "style")) the walk is round-robin: every
+biome x style pair gets one scenario before any pair gets a second one.
+Combinations already present in earlier result files are skipped, and
+`coverage_report()` shows how much of the space, and of each stratum, a set
+of results covers.
+"""
+import itertools
+import json
+import logging
+import math
+import random
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+DIMENSIONS = ("biome", "features", "cultures", "style", "user_prompt")
+
+
+def _subsets(items: Sequence[str], sizes: Sequence[int]) -> List[Tuple[str, ...]]:
+    return [combo for size in sizes for combo in itertools.combinations(items, size)]
+
+
+def _affine_permutation(n: int, rng: random.Random):
+    """A seeded bijection on range(n), evaluated one index at a time."""
+    if n <= 1:
+        return lambda i: i
+    a = rng.randrange(1, n)
+    while math.gcd(a, n) != 1:
+        a = rng.randrange(1, n)
+    b = rng.randrange(n)
+    return lambda i: (a * i + b) % n
+
+
+class ScenarioSpace:
+    """Every combination of the scenario dimensions, addressed by integer index."""
+
+    def __init__(
+        self,
+        biomes: Sequence[str],
+        features: Sequence[str],
+        cultures: Sequence[str],
+        styles: Sequence[str],
+        user_prompts: Sequence[str],
+        subset_sizes: Sequence[int] = (1, 2),
+    ):
+        self.values: Dict[str, list] = {
+            "biome": list(biomes),
+            "features": _subsets(list(features), subset_sizes),
+            "cultures": _subsets(list(cultures), subset_sizes),
+            "style": list(styles),
+            # dict.fromkeys drops repeated prompts but keeps their order
+            "user_prompt": list(dict.fromkeys(user_prompts)),
+        }
+        self._positions = {
+            dim: {self._canonical(dim, value): i for i, value in enumerate(values)}
+            for dim, values in self.values.items()
+        }
+
+    @staticmethod
+    def _canonical(dim: str, value):
+        return tuple(sorted(value)) if dim in ("features", "cultures") else value
+
+    def size(self, dims: Sequence[str] = DIMENSIONS) -> int:
+        total = 1
+        for dim in dims:
+            total *= len(self.values[dim])
+        return total
+
+    def decode(self, dims: Sequence[str], index: int) -> Dict[str, Any]:
+        """Choices for `dims` at mixed-radix position `index` of their sub-space."""
+        choice = {}
+        for dim in reversed(dims):
+            index, position = divmod(index, len(self.values[dim]))
+            choice[dim] = self.values[dim][position]
+        return choice
+
+    def key(self, choice: Dict[str, Any]) -> Optional[Tuple]:
+        """Order-insensitive identity of a combination, or None if it lies outside this space."""
+        key = []
+        for dim in DIMENSIONS:
+            value = choice.get(dim)
+            if value is None:
+                return None
+            canonical = self._canonical(dim, value)
+            if canonical not in self._positions[dim]:
+                return None
+            key.append(canonical)
+        return tuple(key)
+
+    def key_from_record(self, record: Dict[str, Any]) -> Optional[Tuple]:
+        """Combination of a stored generation record (run-file line or legacy JSON entry)."""
+        system_data = record.get("system_data") or {}
+        return self.key({
+            "biome": system_data.get("biome"),
+            "features": system_data.get("features"),
+            "cultures": system_data.get("cultures"),
+            "style": system_data.get("style"),
+            "user_prompt": record.get("user_prompt"),
+        })
+
+
+class CoverageScheduler:
+    """Yields unseen combinations without replacement, optionally round-robin over strata."""
+
+    def __init__(
+        self,
+        space: ScenarioSpace,
+        seed: int,
+        strata: Sequence[str] = (),
+        seen: Iterable[Tuple] = (),
+    ):
+        unknown = [dim for dim in strata if dim not in DIMENSIONS]
+        if unknown:
+            raise ValueError(f"Unknown strata {unknown}; choose from {DIMENSIONS}")
+        self.space = space
+        self.seed = seed
+        self.strata = tuple(strata)
+        self.rest = tuple(dim for dim in DIMENSIONS if dim not in self.strata)
+        self.seen: Set[Tuple] = set(seen)
+        self.skipped_seen = 0
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        rng = random.Random(self.seed)
+        num_strata = self.space.size(self.strata)
+        per_stratum = self.space.size(self.rest)
+        stratum_order = _affine_permutation(num_strata, rng)
+        # Every stratum walks its own sub-space in a different order
+        member_orders = [_affine_permutation(per_stratum, rng) for _ in range(num_strata)]
+
+        for round_index in range(per_stratum):
+            for s in range(num_strata):
+                stratum = stratum_order(s)
+                choice = self.space.decode(self.strata, stratum)
+                choice.update(self.space.decode(self.rest, member_orders[stratum](round_index)))
+                key = self.space.key(choice)
+                if key in self.seen:
+                    self.skipped_seen += 1
+                    continue
+                self.seen.add(key)
+                yield choice
+
+
+def load_seen(space: ScenarioSpace, paths: Iterable[str], successful_only: bool = True) -> Set[Tuple]:
+    """Combinations present in earlier result files (JSONL run files or legacy results JSON)."""
+    from result_sink import iter_records
+
+    seen: Set[Tuple] = set()
+    for path in paths:
+        if path.endswith(".jsonl"):
+            records = iter_records(path)
+        else:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            records = data.get("generations", []) if isinstance(data, dict) else []
+        before = len(seen)
+        for record in records:
+            if successful_only and not record.get("success", True):
+                continue
+            key = space.key_from_record(record)
+            if key is not None:
+                seen.add(key)
+        logger.info(f"Loaded {len(seen) - before} new combinations from {path}")
+    return seen
+
+
+def coverage_report(space: ScenarioSpace, keys: Iterable[Tuple], strata: Sequence[str] = ("biome", "style")) -> Dict[str, Any]:
+    """How much of the space, each dimension and each stratum combination the given combinations cover."""
+    keys = set(keys)
+    positions = [DIMENSIONS.index(dim) for dim in strata]
+    total = space.size()
+    strata_total = space.size(strata)
+    strata_covered = {tuple(key[p] for p in positions) for key in keys}
+    return {
+        "space_size": total,
+        "unique_combinations": len(keys),
+        "coverage": round(len(keys) / total, 6) if total else 0.0,
+        "dimensions": {
+            dim: {"covered": len({key[i] for key in keys}), "total": len(space.values[dim])}
+            for i, dim in enumerate(DIMENSIONS)
+        },
+        "strata": {
+            "dimensions": list(strata),
+            "covered": len(strata_covered),
+            "total": strata_total,
+            "coverage": round(len(strata_covered) / strata_total, 6) if strata_total else 0.0,
+        },
+    }
@@ -0,0 +1,103 @@
+"""Local stand-in for the Ollama HTTP API.
+
+Answers /api/generate (streaming and non-streaming) and /api/version with
+canned text after a configurable delay, so the scenario runner and the
+servers can be exercised without a model:
+
+    python stub_ollama.py --port 11435 --latency 0.5
+    python generate-actor-method-request.py --backend ollama --ollama_url http://localhost:11435
+
+`start_stub()` runs the same server inside an existing event loop.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from aiohttp import web
+
+STUB_VERSION = "0.0.0-stub"
+
+
+def _reply_words(prompt: str, num_words: int):
+    vocabulary = [w.strip(".,:-[]<>/") for w in prompt.split()] or ["village"]
+    rng = random.Random(prompt)
+    return [rng.choice(vocabulary) or "village" for _ in range(num_words)]
+
+
+def build_app(latency: float = 0.2, jitter: float = 0.0, num_words: int = 64, error_rate: float = 0.0) -> web.Application:
+    async def generate(request: web.Request) -> web.StreamResponse:
+        payload = await request.json()
+        prompt = payload.get("prompt", "")
+        words = _reply_words(prompt, int(payload.get("options", {}).get("num_predict", num_words) or num_words))
+        words = words[:num_words]
+        delay = max(0.0, latency + random.uniform(-jitter, jitter))
+        start = time.perf_counter_ns()
+
+        if random.random() < error_rate:
+            await asyncio.sleep(delay)
+            return web.json_response({"error": "stub failure"}, status=500)
+
+        final = {
+            "model": payload.get("model", "llama2"),
+            "done": True,
+            "prompt_eval_count": len(prompt.split()),
+            "eval_count": len(words),
+        }
+        if not payload.get("stream", True):
+            await asyncio.sleep(delay)
+            final["response"] = " ".join(words)
+            final["total_duration"] = time.perf_counter_ns() - start
+            return web.json_response(final)
+
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+        for word in words:
+            await asyncio.sleep(delay / len(words))
+            chunk = {"model": final["model"], "response": word + " ", "done": False}
+            await response.write((json.dumps(chunk) + "\n").encode("utf-8"))
+        final["response"] = ""
+        final["total_duration"] = time.perf_counter_ns() - start
+        await response.write((json.dumps(final) + "\n").encode("utf-8"))
+        await response.write_eof()
+        return response
+
+    async def version(request: web.Request) -> web.Response:
+        return web.json_response({"version": STUB_VERSION})
+
+    app = web.Application()
+    app.router.add_post("/api/generate", generate)
+    app.router.add_get("/api/version", version)
+    return app
+
+
+async def start_stub(host: str = "127.0.0.1", port: int = 0, **kwargs):
+    """Start the stub in the running loop; returns (runner, base_url). Call `await runner.cleanup()` to stop it."""
+    runner = web.AppRunner(build_app(**kwargs))
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    bound_port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://{host}:{bound_port}"
+
+
+def parse_args():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description="Stand-in Ollama server for tests")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds per generation")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Random +/- seconds added to the latency")
+    parser.add_argument("--num_words", type=int, default=64, help="Words per reply")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="Fraction of requests answered with HTTP 500")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    web.run_app(
+        build_app(args.latency, args.jitter, args.num_words, args.error_rate),
+        host=args.host,
+        port=args.port
+    )
@@ -0,0 +1,475 @@
+"""Serve many village LoRA adapters from one resident base model.
+
+One `NousResearch/Llama-2-7b-chat-hf` (or the tiny stand-in from
+tiny_llama.py with ADAPTER_TINY=1) stays loaded. PEFT adapters written by
+finetune.py are hot-loaded into the same `PeftModel` by name on first use and
+the least recently used ones are deleted again once more than
+ADAPTER_MAX_LOADED are resident, so memory grows by one adapter (a few MB of
+LoRA weights) per variant instead of one model copy per variant.
+
+Requests name their adapter (or none, for the plain base model). Requests that
+arrive within ADAPTER_BATCH_WINDOW_MS and share sampling settings are run as
+one left-padded `generate()` call; PEFT's `adapter_names` argument routes each
+row through its own adapter, so a batch can mix adapters freely.
+
+Adapters are discovered as subdirectories of ADAPTER_DIR that contain an
+`adapter_config.json` (the directory name is the adapter name), or registered
+explicitly with POST /adapters.
+
+    ADAPTER_DIR=./adapters python adapter_server.py
+    ADAPTER_TINY=1 ADAPTER_DIR=/tmp/tiny-adapters python adapter_server.py
+"""
+import asyncio
+import logging
+import os
+import sys
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Deque, Dict, List, Optional
+
+from fastapi import FastAPI, HTTPException
+from pydantic import BaseModel
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(funcName)s - %(message)s',
+    handlers=[
+        logging.StreamHandler(sys.stdout),
+        logging.FileHandler(f'adapter_server_{datetime.now().strftime("%Y%m%d")}.log')
+    ]
+)
+
+logger = logging.getLogger(__name__)
+
+BASE_MODEL_NAME = os.environ.get("ADAPTER_BASE_MODEL", "NousResearch/Llama-2-7b-chat-hf")
+ADAPTER_DIR = os.environ.get("ADAPTER_DIR", os.path.dirname(os.path.abspath(__file__)))
+ADAPTER_MAX_LOADED = int(os.environ.get("ADAPTER_MAX_LOADED", "4"))
+ADAPTER_BATCH_WINDOW_MS = float(os.environ.get("ADAPTER_BATCH_WINDOW_MS", "20"))
+ADAPTER_MAX_BATCH_SIZE = int(os.environ.get("ADAPTER_MAX_BATCH_SIZE", "8"))
+ADAPTER_TINY = os.environ.get("ADAPTER_TINY", "0").lower() in ("1", "true", "yes", "on")
+
+# PEFT's name for "no adapter" rows in a mixed-adapter batch
+BASE_ADAPTER = "__base__"
+
+
+class GenerationRequest(BaseModel):
+    prompt: str
+    adapter: Optional[str] = None
+    max_new_tokens: int = 256
+    temperature: float = 0.85
+    top_p: float = 0.95
+    top_k: int = 40
+    repetition_penalty: float = 1.15
+    do_sample: bool = True
+
+
+class RegisterAdapterRequest(BaseModel):
+    name: str
+    path: str
+
+
+def load_base_model(model_name: str = BASE_MODEL_NAME, tiny: bool = ADAPTER_TINY):
+    """Load the shared base model and tokenizer (4-bit on CUDA, like use-finetune.py)."""
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
+
+    if tiny:
+        from tiny_llama import build_tiny_llama
+        model, tokenizer = build_tiny_llama()
+        return model, tokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
+    quantization_config = None
+    if torch.cuda.is_available():
+        quantization_config = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=torch.float16
+        )
+    model = AutoModelForCausalLM.from_pretrained(
+        model_name,
+        torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32,
+        device_map="auto" if torch.cuda.is_available() else None,
+        quantization_config=quantization_config,
+        low_cpu_mem_usage=True
+    )
+    model.eval()
+    return model, tokenizer
+
+
+class AdapterRegistry:
+    """Named LoRA adapters hot-loaded into one PeftModel, with LRU unloading."""
+
+    def __init__(self, base_model, tokenizer, adapter_dir: str = ADAPTER_DIR, max_loaded: int = ADAPTER_MAX_LOADED):
+        self.base_model = base_model
+        self.tokenizer = tokenizer
+        self.adapter_dir = adapter_dir
+        self.max_loaded = max(1, max_loaded)
+        self.peft_model = None
+        self._registered: Dict[str, str] = {}
+        # name -> last use time, least recently used first
+        self._loaded: "OrderedDict[str, float]" = OrderedDict()
+        self.loads = 0
+        self.evictions = 0
+        self.load_seconds = 0.0
+
+    @property
+    def loaded(self) -> List[str]:
+        return list(self._loaded)
+
+    @property
+    def model(self):
+        return self.peft_model if self.peft_model is not None else self.base_model
+
+    def available(self) -> Dict[str, str]:
+        """Adapter name -> directory for every adapter that can be loaded."""
+        adapters = {}
+        if os.path.isdir(self.adapter_dir):
+            for entry in sorted(os.listdir(self.adapter_dir)):
+                path = os.path.join(self.adapter_dir, entry)
+                if os.path.exists(os.path.join(path, "adapter_config.json")):
+                    adapters[entry] = path
+        adapters.update(self._registered)
+        return adapters
+
+    def register(self, name: str, path: str) -> None:
+        if name == BASE_ADAPTER:
+            raise ValueError(f"'{BASE_ADAPTER}' is reserved for the base model")
+        if not os.path.exists(os.path.join(path, "adapter_config.json")):
+            raise FileNotFoundError(f"No adapter_config.json in {path}")
+        self._registered[name] = path
+
+    def ensure_loaded(self, names) -> None:
+        """Load every named adapter, then unload least recently used ones not in `names`."""
+        now = time.time()
+        for name in names:
+            if name not in self._loaded:
+                self._load(name)
+            self._loaded[name] = now
+            self._loaded.move_to_end(name)
+        while len(self._loaded) > self.max_loaded:
+            victim = next((n for n in self._loaded if n not in names), None)
+            if victim is None:
+                break  # Everything resident is needed by this batch
+            self.unload(victim)
+
+    def _load(self, name: str) -> None:
+        from peft import PeftModel
+
+        path = self.available().get(name)
+        if path is None:
+            raise KeyError(f"Unknown adapter: {name}")
+        start = time.time()
+        if self.peft_model is None:
+            self.peft_model = PeftModel.from_pretrained(self.base_model, path, adapter_name=name)
+            self.peft_model.eval()
+        else:
+            self.peft_model.load_adapter(path, adapter_name=name)
+        elapsed = time.time() - start
+        self.loads += 1
+        self.load_seconds += elapsed
+        logger.info(f"Loaded adapter '{name}' from {path} in {elapsed:.2f}s")
+
+    def unload(self, name: str) -> None:
+        if name not in self._loaded:
+            return
+        if len(self._loaded) == 1:
+            # PEFT needs one adapter left in the model; keep it until it is replaced
+            return
+        self.peft_model.delete_adapter(name)
+        del self._loaded[name]
+        self.evictions += 1
+        logger.info(f"Unloaded adapter '{name}'")
+
+    def adapter_bytes(self) -> Dict[str, int]:
+        sizes = {name: 0 for name in self._loaded}
+        if self.peft_model is not None:
+            for param_name, param in self.peft_model.named_parameters():
+                for name in sizes:
+                    if f".{name}." in param_name:
+                        sizes[name] += param.numel() * param.element_size()
+        return sizes
+
+    def stats(self) -> Dict[str, Any]:
+        base_bytes = sum(
+            p.numel() * p.element_size() for n, p in self.base_model.named_parameters() if "lora_" not in n
+        )
+        return {
+            "base_model": BASE_MODEL_NAME if not ADAPTER_TINY else "tiny",
+            "base_model_bytes": base_bytes,
+            "loaded": self.loaded,
+            "adapter_bytes": self.adapter_bytes(),
+            "available": list(self.available()),
+            "max_loaded": self.max_loaded,
+            "loads": self.loads,
+            "evictions": self.evictions,
+            "load_seconds": self.load_seconds,
+        }
+
+
+def count_generated_tokens(new_tokens, eos_token_id) -> List[int]:
+    """Tokens per row up to and including the first EOS."""
+    import torch
+    is_end = new_tokens == eos_token_id
+    first_end = is_end.int().argmax(dim=1)
+    full = torch.full_like(first_end, new_tokens.shape[1])
+    return torch.where(is_end.any(dim=1), first_end + 1, full).tolist()
+
+
+class PendingGeneration:
+    def __init__(self, request: GenerationRequest):
+        self.request = request
+        self.future = asyncio.get_running_loop().create_future()
+        self.created_at = time.time()
+
+
+class AdapterBatcher:
+    """Groups queued requests with the same sampling settings into mixed-adapter batches."""
+
+    def __init__(
+        self,
+        registry: AdapterRegistry,
+        batch_window: float = ADAPTER_BATCH_WINDOW_MS / 1000.0,
+        max_batch_size: int = ADAPTER_MAX_BATCH_SIZE,
+    ):
+        self.registry = registry
+        self.batch_window = batch_window
+        self.max_batch_size = max(1, max_batch_size)
+        self._queue: Deque[PendingGeneration] = deque()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        # One thread owns the model: loads, unloads and generate() never overlap
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="adapter-generate")
+        self.batch_sizes: Dict[int, int] = {}
+        self.adapters_per_batch: Dict[int, int] = {}
+        self.requests_per_adapter: Dict[str, int] = {}
+        self.generated_tokens = 0
+        self.generation_seconds = 0.0
+
+    @staticmethod
+    def batch_key(request: GenerationRequest) -> tuple:
+        return (request.max_new_tokens, request.temperature, request.top_p, request.top_k,
+                request.repetition_penalty, request.do_sample)
+
+    def start(self) -> None:
+        self._task = asyncio.ensure_future(self._dispatch())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+        self.executor.shutdown(wait=False)
+
+    async def submit(self, request: GenerationRequest) -> Dict[str, Any]:
+        pending = PendingGeneration(request)
+        self._queue.append(pending)
+        self._wakeup.set()
+        return await pending.future
+
+    async def _collect_batch(self) -> List[PendingGeneration]:
+        batch = [self._queue.popleft()]
+        key = self.batch_key(batch[0].request)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.batch_window
+        while True:
+            for pending in list(self._queue):
+                if len(batch) >= self.max_batch_size:
+                    break
+                if self.batch_key(pending.request) == key:
+                    self._queue.remove(pending)
+                    batch.append(pending)
+            remaining = deadline - loop.time()
+            if len(batch) >= self.max_batch_size or remaining <= 0:
+                return batch
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _dispatch(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            batch = [p for p in await self._collect_batch() if not p.future.cancelled()]
+            if not batch:
+                continue
+            try:
+                results = await loop.run_in_executor(self.executor, self._run_batch, [p.request for p in batch])
+                for pending, result in zip(batch, results):
+                    result["queue_seconds"] = result["started_at"] - pending.created_at
+                    if not pending.future.done():
+                        pending.future.set_result(result)
+            except Exception as e:
+                logger.error(f"Adapter batch failed: {str(e)}")
+                for pending in batch:
+                    if not pending.future.done():
+                        pending.future.set_exception(e)
+
+    def _run_batch(self, requests: List[GenerationRequest]) -> List[Dict[str, Any]]:
+        import torch
+
+        started_at = time.time()
+        names = [request.adapter or BASE_ADAPTER for request in requests]
+        self.registry.ensure_loaded({name for name in names if name != BASE_ADAPTER})
+        model = self.registry.model
+        tokenizer = self.registry.tokenizer
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+        tokenizer.padding_side = "left"
+
+        first = requests[0]
+        inputs = tokenizer([request.prompt for request in requests], return_tensors="pt", padding=True).to(model.device)
+        generate_kwargs = dict(
+            max_new_tokens=first.max_new_tokens,
+            do_sample=first.do_sample,
+            repetition_penalty=first.repetition_penalty,
+            pad_token_id=tokenizer.pad_token_id,
+            eos_token_id=tokenizer.eos_token_id
+        )
+        if first.do_sample:
+            generate_kwargs.update(temperature=first.temperature, top_p=first.top_p, top_k=first.top_k)
+        if self.registry.peft_model is not None:
+            # Each row goes through its own adapter (or none) inside the same forward pass
+            generate_kwargs["adapter_names"] = names
+
+        with torch.inference_mode():
+            sequences = model.generate(**inputs, **generate_kwargs)
+        new_tokens = sequences[:, inputs["input_ids"].shape[1]:]
+        texts = tokenizer.batch_decode(new_tokens, skip_special_tokens=True)
+        token_counts = count_generated_tokens(new_tokens, tokenizer.eos_token_id)
+        generation_time = time.time() - started_at
+
+        self.batch_sizes[len(requests)] = self.batch_sizes.get(len(requests), 0) + 1
+        distinct = len(set(names))
+        self.adapters_per_batch[distinct] = self.adapters_per_batch.get(distinct, 0) + 1
+        for name in names:
+            self.requests_per_adapter[name] = self.requests_per_adapter.get(name, 0) + 1
+        self.generated_tokens += sum(token_counts)
+        self.generation_seconds += generation_time
+        logger.info(f"Generated batch of {len(requests)} ({distinct} adapters) in {generation_time:.2f}s")
+
+        return [
+            {
+                "response": text.strip(),
+                "adapter": request.adapter,
+                "tokens": count,
+                "batch_size": len(requests),
+                "generation_time": generation_time,
+                "started_at": started_at,
+            }
+            for request, text, count in zip(requests, texts, token_counts)
+        ]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queued": len(self._queue),
+            "window_ms": self.batch_window * 1000.0,
+            "max_batch_size": self.max_batch_size,
+            "batch_sizes": {str(k): v for k, v in sorted(self.batch_sizes.items())},
+            "adapters_per_batch": {str(k): v for k, v in sorted(self.adapters_per_batch.items())},
+            "requests_per_adapter": dict(self.requests_per_adapter),
+            "generated_tokens": self.generated_tokens,
+            "tokens_per_second": self.generated_tokens / self.generation_seconds if self.generation_seconds else 0.0,
+        }
+
+
+app = FastAPI()
+registry: Optional[AdapterRegistry] = None
+batcher: Optional[AdapterBatcher] = None
+
+
+@app.on_event("startup")
+async def startup():
+    global registry, batcher
+    logger.info("="*50)
+    logger.info(f"Loading base model {'tiny' if ADAPTER_TINY else BASE_MODEL_NAME}")
+    loop = asyncio.get_running_loop()
+    model, tokenizer = await loop.run_in_executor(None, load_base_model)
+    registry = AdapterRegistry(model, tokenizer)
+    batcher = AdapterBatcher(registry)
+    batcher.start()
+    logger.info(f"Adapter server ready, adapters available: {list(registry.available())}")
+    logger.info("="*50)
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    if batcher is not None:
+        batcher.stop()
+
+
+@app.post("/generate")
+async def generate(request: GenerationRequest):
+    """Generate with the named adapter (or the base model when none is given)"""
+    if request.adapter is not None and request.adapter not in registry.available():
+        raise HTTPException(status_code=404, detail=f"Unknown adapter: {request.adapter}")
+    try:
+        start_time = time.time()
+        result = await batcher.submit(request)
+        result.pop("started_at", None)
+        result["total_time"] = time.time() - start_time
+        return result
+    except Exception as e:
+        error_msg = f"Generation error: {str(e)}"
+        logger.error(error_msg)
+        raise HTTPException(status_code=500, detail=error_msg)
+
+
+@app.get("/adapters")
+async def list_adapters():
+    """Available and resident adapters with their memory footprint"""
+    return registry.stats()
+
+
+@app.post("/adapters")
+async def register_adapter(request: RegisterAdapterRequest):
+    """Make an adapter directory outside ADAPTER_DIR available under a name"""
+    try:
+        registry.register(request.name, request.path)
+    except (ValueError, FileNotFoundError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"registered": request.name, "path": request.path}
+
+
+@app.post("/adapters/{name}/load")
+async def preload_adapter(name: str):
+    """Load an adapter ahead of its first request"""
+    if name not in registry.available():
+        raise HTTPException(status_code=404, detail=f"Unknown adapter: {name}")
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(batcher.executor, registry.ensure_loaded, {name})
+    return registry.stats()
+
+
+@app.delete("/adapters/{name}")
+async def unload_adapter(name: str):
+    """Unload a resident adapter"""
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(batcher.executor, registry.unload, name)
+    return registry.stats()
+
+
+@app.get("/stats")
+async def stats():
+    return {"adapters": registry.stats(), "batching": batcher.stats()}
+
+
+@app.get("/health")
+async def health_check():
+    """Health check endpoint"""
+    return {
+        "status": "healthy" if registry is not None else "starting",
+        "timestamp": datetime.now().isoformat(),
+        "loaded_adapters": registry.loaded if registry is not None else [],
+    }
+
+
+if __name__ == "__main__":
+    import uvicorn
+    logger.info("Starting adapter server on port 1026")
+    uvicorn.run(app, host="0.0.0.0", port=1026)
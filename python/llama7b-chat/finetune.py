@@ -1,18 +1,17 @@
-from datasets import load_dataset
-from transformers import (
-    AutoTokenizer,
-    AutoModelForCausalLM,
-    TrainingArguments,
-    Trainer,
-    DataCollatorForLanguageModeling,
-    TrainerCallback,
-    TrainerState
-)
-from peft import LoraConfig, get_peft_model, prepare_model_for_kbit_training
-import torch
+import argparse
+import glob
+import hashlib
+import inspect
+import json
 import logging
 import os
+import shutil
 import sys
+import time
+from model_snapshots import bnb_4bit_config, load_model
+
+# torch, transformers, peft, datasets and packing.py (which needs torch and the
+# Trainer) are imported inside the functions that use them, so --help is instant.
 
 # Set PyTorch and CUDA memory settings
 os.environ["PYTORCH_CUDA_ALLOC_CONF"] = "max_split_size_mb:128,expandable_segments:True"
@@ -20,35 +19,90 @@ os.environ["CUDA_VISIBLE_DEVICES"] = "0"
 os.environ["LD_LIBRARY_PATH"] = "/home/mrdjan/cuda-12.1/lib64:" + os.environ.get("LD_LIBRARY_PATH", "")
 os.environ["PATH"] = "/home/mrdjan/cuda-12.1/bin:" + os.environ.get("PATH", "")
 
-# Configure logging
+# Configure logging, unless an importer (e.g. train_benchmark.py) already has; opening
+# the FileHandler would create finetune.log in its working directory
 try:
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.FileHandler('finetune.log'),
-            logging.StreamHandler()
-        ]
-    )
+    if not logging.getLogger().handlers:
+        logging.basicConfig(
+            level=logging.INFO,
+            format='%(asctime)s - %(levelname)s - %(message)s',
+            handlers=[
+                logging.FileHandler('finetune.log'),
+                logging.StreamHandler()
+            ]
+        )
 except Exception as e:
     print(f"Failed to configure logging: {e}")
     raise
 
-def load_dataset_safely():
+# Prompt format the adapter is trained on; part of the tokenization cache key
+PROMPT_TEMPLATE = "### Instruction: {instructions}\n### Response: {output}"
+# Per-example cap; packing makes long examples cheap, so they are no longer cut to 32 tokens
+MAX_LENGTH = 512
+TOKENIZED_CACHE_DIR = os.environ.get("TOKENIZED_CACHE_DIR", "./tokenized_cache")
+LORA_R = 8  # Reduced for 4-bit
+LORA_TARGET_MODULES = ("q_proj", "v_proj")
+DATA_FILES = ("../village_data.json",)
+SHUFFLE_BUFFER = 10000
+MAX_STEPS = 50
+
+def resolve_data_files(patterns=DATA_FILES):
+    """Expand glob patterns into a sorted file list and the `load_dataset` builder that reads them."""
+    files = sorted({path for pattern in patterns for path in glob.glob(pattern)})
+    if not files:
+        raise FileNotFoundError(f"No data files match {list(patterns)}")
+    builders = {"parquet" if path.endswith(".parquet") else "json" for path in files}
+    if len(builders) > 1:
+        raise ValueError(f"Data files mix Parquet and JSON: {files}")
+    return files, builders.pop()
+
+def load_dataset_safely(data_files=DATA_FILES):
+    from datasets import load_dataset
+
     try:
-        dataset = load_dataset("json", data_files={"train": "../village_data.json"}, split="train")
+        files, builder = resolve_data_files(data_files)
+        dataset = load_dataset(builder, data_files={"train": files}, split="train")
         if len(dataset) == 0:
             raise ValueError("Dataset is empty")
         logging.info(f"Dataset loaded with {len(dataset)} examples")
         return dataset
     except FileNotFoundError:
-        logging.error("village_data.json file not found")
+        logging.error(f"Data files not found: {list(data_files)}")
         raise
     except Exception as e:
         logging.error(f"Failed to load dataset: {str(e)}")
         raise
 
+def apply_lora(model, r=LORA_R, target_modules=LORA_TARGET_MODULES, gradient_checkpointing=True):
+    """Prepare `model` for k-bit training and wrap it with the LoRA adapter that gets trained."""
+    from peft import LoraConfig, get_peft_model, prepare_model_for_kbit_training
+
+    # Prepare model for k-bit training (on an unquantized model this only sets up input grads / checkpointing)
+    model = prepare_model_for_kbit_training(model, use_gradient_checkpointing=gradient_checkpointing)
+
+    # Define LoRA Config for 4-bit training
+    lora_config = LoraConfig(
+        r=r,
+        lora_alpha=2 * r,
+        target_modules=list(target_modules),
+        lora_dropout=0.05,
+        bias="none",
+        task_type="CAUSAL_LM"
+    )
+
+    # Get PEFT model
+    model = get_peft_model(model, lora_config)
+
+    # Enable memory optimizations
+    if gradient_checkpointing:
+        model.gradient_checkpointing_enable()
+    model.config.use_cache = False
+    return model
+
 def initialize_model_and_tokenizer(model_name):
+    import torch
+    from transformers import AutoTokenizer
+
     try:
         # Clear GPU cache before loading model
         if torch.cuda.is_available():
@@ -75,38 +129,18 @@ def initialize_model_and_tokenizer(model_name):
             max_memory = {0: "8GB"}  # Reduced to 8GB
             logging.info(f"Setting GPU memory limit to: {max_memory[0]}")
 
-        # Load model with 4-bit quantization
-        model = AutoModelForCausalLM.from_pretrained(
+        # Load model with 4-bit quantization (nf4, double quant for further memory savings),
+        # from the pre-quantized snapshot when one exists
+        model = load_model(
             model_name,
             torch_dtype=torch.float16,
+            quantization_config=bnb_4bit_config(double_quant=True),
             device_map={"": 0},
             max_memory=max_memory,
-            load_in_4bit=True,  # Changed to 4-bit
-            bnb_4bit_quant_type="nf4",  # Using nf4 format for better quality
-            bnb_4bit_compute_dtype=torch.float16,
-            bnb_4bit_use_double_quant=True,  # Further memory savings
             low_cpu_mem_usage=True
         )
 
-        # Prepare model for k-bit training
-        model = prepare_model_for_kbit_training(model)
-
-        # Define LoRA Config for 4-bit training
-        lora_config = LoraConfig(
-            r=8,  # Reduced for 4-bit
-            lora_alpha=16,
-            target_modules=["q_proj", "v_proj"],
-            lora_dropout=0.05,
-            bias="none",
-            task_type="CAUSAL_LM"
-        )
-
-        # Get PEFT model
-        model = get_peft_model(model, lora_config)
-
-        # Enable memory optimizations
-        model.gradient_checkpointing_enable()
-        model.config.use_cache = False
+        model = apply_lora(model)
         logging.info("Model loaded successfully with 4-bit quantization, LoRA adapters, and memory optimizations")
 
         return tokenizer, model
@@ -120,41 +154,219 @@ def initialize_model_and_tokenizer(model_name):
         logging.error(f"Unexpected error loading model/tokenizer: {e}")
         raise
 
-def tokenize_function(example, tokenizer):
+def tokenize_function(batch, tokenizer, max_length=MAX_LENGTH):
+    """Tokenize a batch of examples (a dict of columns, as passed by `dataset.map(batched=True)`)."""
     try:
-        if not isinstance(example['instructions'], str):
-            logging.error(f"Invalid data type - instructions: {type(example['instructions'])}")
-            raise ValueError("Instructions is not a string")
-
-        # Simplified prompt format
-        full_text = f"### Instruction: {example['instructions']}\n### Response: {example.get('output', '')}"
+        outputs = batch.get('output') or [''] * len(batch['instructions'])
+        texts = []
+        for instructions, output in zip(batch['instructions'], outputs):
+            if not isinstance(instructions, str):
+                logging.error(f"Invalid data type - instructions: {type(instructions)}")
+                raise ValueError("Instructions is not a string")
+            texts.append(PROMPT_TEMPLATE.format(instructions=instructions, output=output or ''))
 
         tokens = tokenizer(
-            full_text,
+            texts,
             truncation=True,
-            max_length=32,  # Reduced from 64
+            max_length=max_length,
             padding=False,
             return_tensors=None
         )
 
-        if not tokens or len(tokens['input_ids']) == 0:
+        if any(len(ids) == 0 for ids in tokens['input_ids']):
             raise ValueError("Tokenization produced empty output")
 
         return tokens
     except Exception as e:
-        logging.error(f"Tokenization error for example: {str(e)}")
+        logging.error(f"Tokenization error for batch: {str(e)}")
         raise
 
+def tokenization_fingerprint(dataset, tokenizer, max_length=MAX_LENGTH):
+    """Key of a tokenized dataset: the source data, the tokenizer, the prompt format and max_length."""
+    if hasattr(tokenizer, "backend_tokenizer"):
+        vocabulary = tokenizer.backend_tokenizer.to_str()
+    else:
+        vocabulary = json.dumps(sorted(tokenizer.get_vocab().items()))
+    material = {
+        "dataset": getattr(dataset, "_fingerprint", None) or len(dataset),
+        "tokenizer": tokenizer.name_or_path,
+        "tokenizer_class": type(tokenizer).__name__,
+        "vocabulary": hashlib.sha256(vocabulary.encode("utf-8")).hexdigest(),
+        "special_tokens": tokenizer.special_tokens_map,
+        "prompt_template": PROMPT_TEMPLATE,
+        "max_length": max_length,
+    }
+    return hashlib.sha256(json.dumps(material, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:24]
+
+def tokenize_dataset(dataset, tokenizer, max_length=MAX_LENGTH, num_proc=None, cache_dir=TOKENIZED_CACHE_DIR, batch_size=1000):
+    """Tokenize in batches over `num_proc` processes, reusing the Arrow copy in `cache_dir` when the inputs are unchanged."""
+    from datasets import load_from_disk
+
+    start_time = time.time()
+    cache_path = None
+    if cache_dir:
+        cache_path = os.path.join(cache_dir, tokenization_fingerprint(dataset, tokenizer, max_length))
+        if os.path.exists(os.path.join(cache_path, "dataset_info.json")):
+            tokenized = load_from_disk(cache_path)
+            logging.info(f"Loaded tokenized dataset from cache {cache_path} in {time.time() - start_time:.2f}s")
+            return tokenized
+
+    tokenized = dataset.map(
+        tokenize_function,
+        batched=True,
+        batch_size=batch_size,
+        num_proc=num_proc if num_proc and num_proc > 1 else None,
+        fn_kwargs={"tokenizer": tokenizer, "max_length": max_length},
+        remove_columns=dataset.column_names,
+        desc="Tokenizing dataset"
+    )
+    logging.info(f"Tokenized {len(tokenized)} examples in {time.time() - start_time:.2f}s (num_proc={num_proc})")
+
+    if cache_path:
+        # Save under a temporary name so an interrupted save is never mistaken for a cache hit
+        tmp_path = f"{cache_path}.tmp-{os.getpid()}"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        tokenized.save_to_disk(tmp_path)
+        if os.path.exists(cache_path):
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        else:
+            os.replace(tmp_path, cache_path)
+        tokenized = load_from_disk(cache_path)
+        logging.info(f"Saved tokenized dataset to cache {cache_path}")
+    return tokenized
+
+def load_streaming_dataset(data_files, tokenizer, max_length=MAX_LENGTH, shuffle_buffer=SHUFFLE_BUFFER, seed=42, batch_size=1000):
+    """Read the data files lazily and tokenize on the fly.
+
+    Memory stays bounded by the shuffle buffer and one tokenization batch,
+    whatever the size of the corpus, as long as the files are JSONL or
+    Parquet (a JSON array file is parsed whole). Shard order and the buffer
+    are reshuffled every pass, since the Trainer calls `set_epoch` on the
+    dataset each time it restarts it.
+    """
+    from datasets import load_dataset
+
+    files, builder = resolve_data_files(data_files)
+    dataset = load_dataset(builder, data_files={"train": files}, split="train", streaming=True)
+    columns = dataset.column_names
+    if shuffle_buffer > 1:
+        dataset = dataset.shuffle(seed=seed, buffer_size=shuffle_buffer)
+    tokenized = dataset.map(
+        tokenize_function,
+        batched=True,
+        batch_size=batch_size,
+        fn_kwargs={"tokenizer": tokenizer, "max_length": max_length},
+        remove_columns=columns
+    )
+    logging.info(
+        f"Streaming {len(files)} {builder} file(s) ({dataset.n_shards} shards) "
+        f"with a shuffle buffer of {shuffle_buffer} examples"
+    )
+    return tokenized
+
+def parse_args():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description="LoRA fine-tune Llama-2 on the village dataset")
+    parser.add_argument("--data_files", type=str, nargs="+", default=list(DATA_FILES),
+                        help="JSON/JSONL or Parquet files; glob patterns are expanded (quote them)")
+    parser.add_argument("--streaming", action="store_true",
+                        help="Read and tokenize the data files lazily instead of loading them into memory")
+    parser.add_argument("--shuffle_buffer", type=int, default=SHUFFLE_BUFFER,
+                        help="Examples held in the streaming shuffle buffer")
+    parser.add_argument("--max_steps", type=int, default=MAX_STEPS,
+                        help="Optimizer steps to train for; required with --streaming, where the corpus size is unknown")
+    parser.add_argument("--seed", type=int, default=42, help="Seed for training and the streaming shuffle")
+    parser.add_argument("--max_length", type=int, default=MAX_LENGTH, help="Truncate examples to this many tokens")
+    parser.add_argument("--num_proc", type=int, default=min(8, os.cpu_count() or 1),
+                        help="Processes used for tokenization")
+    parser.add_argument("--tokenized_cache_dir", type=str, default=TOKENIZED_CACHE_DIR,
+                        help="Where tokenized datasets are cached, keyed by data, tokenizer, prompt format and max_length")
+    parser.add_argument("--no_tokenized_cache", action="store_true", help="Always re-tokenize")
+    parser.add_argument("--batching", type=str, choices=["packed", "bucketed", "padded"], default="packed",
+                        help="packed: concatenate examples into max_seq_len rows; bucketed: similar-length batches "
+                             "under --max_batch_tokens; padded: fixed-size batches padded to their longest example")
+    parser.add_argument("--max_seq_len", type=int, default=1024, help="Row length for packed batches")
+    parser.add_argument("--per_device_batch_size", type=int, default=128,
+                        help="Examples per batch for packed and padded batching")
+    parser.add_argument("--max_batch_tokens", type=int, default=16384, help="Padded-token budget per bucketed batch")
+    parser.add_argument("--gradient_accumulation_steps", type=int, default=4)
+    return parser.parse_args()
+
+def build_batching(args, tokenizer, tokenized_dataset, mask_dtype=None):
+    """Return (data_collator, batch_sampler, stats) for the chosen batching mode; the mask dtype defaults to float16."""
+    import torch
+    from packing import BatchStats, LengthBucketBatchSampler, PackingCollator, PaddingCollator
+
+    if args.batching == "bucketed" and args.streaming:
+        raise ValueError("Bucketed batching needs every example length up front; use packed or padded with --streaming")
+    stats = BatchStats()
+    if args.batching == "packed":
+        collator = PackingCollator(
+            tokenizer,
+            max_seq_len=args.max_seq_len,
+            mask_dtype=mask_dtype or torch.float16,
+            stats=stats
+        )
+        return collator, None, stats
+
+    collator = PaddingCollator(tokenizer, max_seq_len=args.max_length, stats=stats)
+    if args.batching == "bucketed":
+        lengths = [len(ids) for ids in tokenized_dataset["input_ids"]]
+        sampler = LengthBucketBatchSampler(lengths, max_tokens=args.max_batch_tokens)
+        logging.info(f"Bucketed {len(lengths)} examples into {len(sampler)} batches of <= {args.max_batch_tokens} tokens")
+        return collator, sampler, stats
+    return collator, None, stats
+
+def build_training_arguments(args, output_dir, **overrides):
+    """TrainingArguments for the fine-tuning run; `overrides` replace individual settings (train_benchmark.py runs on CPU)."""
+    from transformers import TrainingArguments
+
+    settings = dict(
+        output_dir=output_dir,
+        num_train_epochs=3,
+        per_device_train_batch_size=args.per_device_batch_size,
+        gradient_accumulation_steps=args.gradient_accumulation_steps,
+        learning_rate=2e-4,
+        logging_steps=10,
+        save_steps=50,
+        fp16=True,
+        gradient_checkpointing=True,
+        optim="adamw_torch",
+        max_grad_norm=0.3,
+        warmup_ratio=0.03,
+        weight_decay=0.01,
+        report_to="tensorboard",
+        dataloader_pin_memory=False,
+        save_total_limit=1,
+        ddp_find_unused_parameters=False,
+        use_cpu=False,
+        max_steps=args.max_steps,
+        seed=args.seed,
+        dataloader_num_workers=0
+    )
+    settings.update(overrides)
+    # transformers 5 folds warmup_ratio into warmup_steps (a float below 1 is a ratio)
+    if "warmup_ratio" not in inspect.signature(TrainingArguments).parameters:
+        settings["warmup_steps"] = settings.pop("warmup_ratio")
+    return TrainingArguments(**settings)
+
 def main():
+    args = parse_args()
+    import torch
+    from packing import BatchingTrainer
+
+    if args.streaming and args.max_steps <= 0:
+        raise ValueError("--streaming needs --max_steps > 0: a streamed dataset has no length to derive epochs from")
     try:
         # Load dataset
-        dataset = load_dataset_safely()
+        if not args.streaming:
+            dataset = load_dataset_safely(args.data_files)
 
-        # Print dataset info
-        logging.info(f"Dataset features: {dataset.features}")
-        logging.info(f"Dataset size: {len(dataset)}")
-        logging.info("First example:")
-        logging.info(dataset[0])
+            # Print dataset info
+            logging.info(f"Dataset features: {dataset.features}")
+            logging.info(f"Dataset size: {len(dataset)}")
+            logging.info("First example:")
+            logging.info(dataset[0])
 
         # Initialize model and tokenizer
         model_name = "NousResearch/Llama-2-7b-chat-hf"
@@ -168,54 +380,46 @@ def main():
         logging.info(f"Percentage of trainable parameters: {100 * trainable_params / total_params:.2f}%")
 
         # Tokenize dataset
-        logging.info("Starting dataset tokenization...")
-        tokenized_dataset = dataset.map(
-            lambda x: tokenize_function(x, tokenizer),
-            batched=False,
-            remove_columns=dataset.column_names,
-            desc="Tokenizing dataset"
-        )
+        if args.streaming:
+            tokenized_dataset = load_streaming_dataset(
+                args.data_files,
+                tokenizer,
+                max_length=args.max_length,
+                shuffle_buffer=args.shuffle_buffer,
+                seed=args.seed
+            )
+        else:
+            logging.info("Starting dataset tokenization...")
+            tokenized_dataset = tokenize_dataset(
+                dataset,
+                tokenizer,
+                max_length=args.max_length,
+                num_proc=args.num_proc,
+                cache_dir=None if args.no_tokenized_cache else args.tokenized_cache_dir
+            )
+
+        data_collator, batch_sampler, batch_stats = build_batching(args, tokenizer, tokenized_dataset)
 
         # Setup training
         output_dir = "./village_finetuned_model"
         os.makedirs(output_dir, exist_ok=True)
 
-        training_args = TrainingArguments(
-            output_dir=output_dir,
-            num_train_epochs=3,
-            per_device_train_batch_size=1,
-            gradient_accumulation_steps=128,
-            learning_rate=2e-4,
-            logging_steps=10,
-            save_steps=50,
-            fp16=True,
-            gradient_checkpointing=True,
-            optim="adamw_torch",
-            max_grad_norm=0.3,
-            warmup_ratio=0.03,
-            weight_decay=0.01,
-            report_to="tensorboard",
-            dataloader_pin_memory=False,
-            save_total_limit=1,
-            ddp_find_unused_parameters=False,
-            no_cuda=False,
-            max_steps=50,
-            dataloader_num_workers=0,
-            group_by_length=True,
-            length_column_name="length"
-        )
+        training_args = build_training_arguments(args, output_dir)
 
         # Initialize trainer
-        trainer = Trainer(
+        trainer = BatchingTrainer(
             model=model,
             args=training_args,
             train_dataset=tokenized_dataset,
-            data_collator=DataCollatorForLanguageModeling(tokenizer=tokenizer, mlm=False)
+            data_collator=data_collator,
+            batch_sampler=batch_sampler,
+            batch_stats=batch_stats
         )
 
         # Train
         logging.info("Starting training...")
         trainer.train()
+        logging.info(f"Batching ({args.batching}): {batch_stats.summary()}")
 
         # Save results
         logging.info("Saving model and tokenizer...")
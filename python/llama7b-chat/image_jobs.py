@@ -0,0 +1,349 @@
+"""Asynchronous image job queue with per-step progress.
+
+Jobs are submitted to `ImageJobManager`, which hands them in batches to a
+runner coroutine (the resident Stable Diffusion worker in server.py). When a
+job reaches the head of the queue the dispatcher waits up to a short window
+for more jobs with the same `batch_key` (resolution, steps, guidance) and runs
+them together, so the UNet works at a batch size above one while several
+clients are waiting. The runner reports denoising progress through a
+callback, so clients can poll the job status (queue position, current step,
+ETA) or follow it as a stream of status updates. Finished jobs are kept for a
+retention window and then pruned.
+"""
+import asyncio
+import logging
+import os
+import time
+import uuid
+from collections import deque
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, Hashable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+IMAGE_JOB_RETENTION_SECONDS = float(os.environ.get("IMAGE_JOB_RETENTION_SECONDS", "900"))
+IMAGE_JOB_MAX_QUEUE = int(os.environ.get("IMAGE_JOB_MAX_QUEUE", "64"))
+IMAGE_BATCH_WINDOW_MS = float(os.environ.get("IMAGE_BATCH_WINDOW_MS", "50"))
+IMAGE_BATCH_MAX_SIZE = int(os.environ.get("IMAGE_BATCH_MAX_SIZE", "4"))
+# Number of finished jobs kept for the latency percentiles
+LATENCY_SAMPLES = 1000
+
+
+class JobQueueFullError(Exception):
+    """The job queue is at IMAGE_JOB_MAX_QUEUE; the client should retry later."""
+
+
+class ImageJob:
+    """State of one image generation job."""
+
+    def __init__(self, request: Any, num_steps: int):
+        self.id = uuid.uuid4().hex
+        self.request = request
+        self.status = "queued"
+        self.step = 0
+        self.num_steps = num_steps
+        # The scheduler may run a different number of timesteps than requested (PNDM runs 31 for 30)
+        self.scheduler_step = 0
+        self.scheduler_steps: Optional[int] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[str] = None
+        self.batch_size = 0
+        self.done = asyncio.Event()
+        self.changed = asyncio.Condition()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed")
+
+    async def _notify(self) -> None:
+        async with self.changed:
+            self.changed.notify_all()
+
+
+def _percentiles(samples) -> Dict[str, Optional[float]]:
+    if not samples:
+        return {"count": 0, "mean": None, "p50": None, "p95": None, "max": None}
+    ordered = sorted(samples)
+
+    def pick(q: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 3)
+
+    return {
+        "count": len(ordered),
+        "mean": round(sum(ordered) / len(ordered), 3),
+        "p50": pick(0.50),
+        "p95": pick(0.95),
+        "max": round(ordered[-1], 3),
+    }
+
+
+class ImageJobManager:
+    """FIFO queue of image jobs driven by a single batching dispatcher task.
+
+    `runner(jobs, on_step)` receives a list of compatible jobs and must return
+    one result dict per job, in the same order. Without a `batch_key` (or with
+    `max_batch_size` 1) every batch holds exactly one job.
+    """
+
+    def __init__(
+        self,
+        runner: Callable[[List[ImageJob], Callable[[int, int], None]], Awaitable[List[Dict[str, Any]]]],
+        retention_seconds: float = IMAGE_JOB_RETENTION_SECONDS,
+        max_queue: int = IMAGE_JOB_MAX_QUEUE,
+        batch_key: Optional[Callable[[ImageJob], Hashable]] = None,
+        batch_window: float = IMAGE_BATCH_WINDOW_MS / 1000.0,
+        max_batch_size: int = IMAGE_BATCH_MAX_SIZE,
+    ):
+        self.runner = runner
+        self.retention_seconds = retention_seconds
+        self.max_queue = max_queue
+        self.batch_key = batch_key
+        self.batch_window = batch_window
+        self.max_batch_size = max(1, max_batch_size) if batch_key is not None else 1
+        # batch size -> number of batches run at that size
+        self.batch_sizes: Dict[int, int] = {}
+        self.completed_from_cache = 0
+        self._queue_waits: Deque[float] = deque(maxlen=LATENCY_SAMPLES)
+        self._latencies: Deque[float] = deque(maxlen=LATENCY_SAMPLES)
+        self._jobs: Dict[str, ImageJob] = {}
+        self._queue: Deque[ImageJob] = deque()
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+        # Exponential moving average of seconds per denoising step, used for ETAs
+        self._seconds_per_step: Optional[float] = None
+        self._step_started_at: Optional[float] = None
+
+    async def start(self) -> None:
+        self._tasks = [asyncio.ensure_future(self._dispatch()), asyncio.ensure_future(self._prune())]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    def submit(self, request: Any, num_steps: int) -> ImageJob:
+        if len(self._queue) >= self.max_queue:
+            raise JobQueueFullError(f"Image job queue is full ({self.max_queue} jobs waiting)")
+        job = ImageJob(request, num_steps)
+        self._jobs[job.id] = job
+        self._queue.append(job)
+        self._wakeup.set()
+        logger.info(f"Queued image job {job.id} (position {len(self._queue)})")
+        return job
+
+    def add_finished(self, request: Any, num_steps: int, result: Dict[str, Any]) -> ImageJob:
+        """Register a job whose result is already available (e.g. from the image store)."""
+        job = ImageJob(request, num_steps)
+        job.status = "done"
+        job.step = num_steps
+        job.result = result
+        job.started_at = job.finished_at = job.created_at
+        job.done.set()
+        self._jobs[job.id] = job
+        self.completed_from_cache += 1
+        return job
+
+    def get(self, job_id: str) -> Optional[ImageJob]:
+        return self._jobs.get(job_id)
+
+    async def wait(self, job: ImageJob) -> ImageJob:
+        await job.done.wait()
+        return job
+
+    def queue_position(self, job: ImageJob) -> int:
+        """1-based position among queued jobs, 0 once the job has started."""
+        try:
+            return self._queue.index(job) + 1
+        except ValueError:
+            return 0
+
+    def _eta(self, job: ImageJob) -> Optional[float]:
+        if job.finished:
+            return 0.0
+        if self._seconds_per_step is None:
+            return None
+        # Upper bound: assumes the jobs ahead are not batched with each other
+        remaining = job.num_steps - job.step
+        for ahead in self._queue:
+            if ahead is job:
+                break
+            remaining += ahead.num_steps
+        if job.status == "queued":
+            remaining += max((j.num_steps - j.step for j in self._jobs.values() if j.status == "running"), default=0)
+        return remaining * self._seconds_per_step
+
+    def status(self, job: ImageJob) -> Dict[str, Any]:
+        eta = self._eta(job)
+        info = {
+            "job_id": job.id,
+            "status": job.status,
+            "queue_position": self.queue_position(job),
+            "step": job.step,
+            "num_steps": job.num_steps,
+            "scheduler_steps": job.scheduler_steps,
+            "batch_size": job.batch_size,
+            "progress": job.step / job.num_steps if job.num_steps else 0.0,
+            "eta_seconds": round(eta, 2) if eta is not None else None,
+            "created_at": job.created_at,
+            "started_at": job.started_at,
+            "finished_at": job.finished_at,
+        }
+        if job.error:
+            info["error"] = job.error
+        return info
+
+    async def events(self, job: ImageJob, heartbeat: float = 15.0) -> AsyncIterator[Dict[str, Any]]:
+        """Yield the job status on every change (and at least every `heartbeat` seconds) until it finishes."""
+        last = None
+        while True:
+            current = self.status(job)
+            if current != last:
+                yield current
+                last = current
+            if job.finished:
+                return
+            async with job.changed:
+                try:
+                    await asyncio.wait_for(job.changed.wait(), timeout=heartbeat)
+                except asyncio.TimeoutError:
+                    last = None
+
+    def _progress_callback(self, batch: List[ImageJob]) -> Callable[[int, int], None]:
+        """Build a thread-safe step callback for the runner."""
+        loop = asyncio.get_running_loop()
+
+        def on_step(step: int, num_steps: int) -> None:
+            loop.call_soon_threadsafe(self._record_step, batch, step, num_steps)
+
+        return on_step
+
+    def _record_step(self, batch: List[ImageJob], step: int, num_steps: int) -> None:
+        now = time.time()
+        previous = batch[0].scheduler_step
+        if self._step_started_at is not None and step > previous:
+            # Seconds per batched step: that is what the queue waits on. Measured per
+            # scheduler timestep, expressed per requested step like the ETAs that use it
+            per_step = (now - self._step_started_at) / (step - previous) * num_steps / batch[0].num_steps
+            if self._seconds_per_step is None:
+                self._seconds_per_step = per_step
+            else:
+                self._seconds_per_step = 0.8 * self._seconds_per_step + 0.2 * per_step
+        self._step_started_at = now
+        for job in batch:
+            job.scheduler_step = step
+            job.scheduler_steps = num_steps
+            # Progress is reported against the requested step count
+            job.step = min(job.num_steps, round(step * job.num_steps / num_steps)) if num_steps else step
+            asyncio.ensure_future(job._notify())
+
+    def _take_compatible(self, batch: List[ImageJob], key: Hashable) -> None:
+        """Move queued jobs with the same batch key into the batch, keeping FIFO order otherwise."""
+        for job in list(self._queue):
+            if len(batch) >= self.max_batch_size:
+                return
+            if self.batch_key(job) == key:
+                self._queue.remove(job)
+                batch.append(job)
+
+    async def _collect_batch(self) -> List[ImageJob]:
+        batch = [self._queue.popleft()]
+        if self.max_batch_size == 1:
+            return batch
+        key = self.batch_key(batch[0])
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.batch_window
+        while True:
+            self._take_compatible(batch, key)
+            remaining = deadline - loop.time()
+            if len(batch) >= self.max_batch_size or remaining <= 0:
+                return batch
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _dispatch(self) -> None:
+        while True:
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            batch = await self._collect_batch()
+            started_at = time.time()
+            for job in batch:
+                job.status = "running"
+                job.started_at = started_at
+                job.batch_size = len(batch)
+                await job._notify()
+            self._step_started_at = started_at
+            self.batch_sizes[len(batch)] = self.batch_sizes.get(len(batch), 0) + 1
+            logger.info(f"Running image batch of {len(batch)}: {', '.join(job.id for job in batch)}")
+            try:
+                results = await self.runner(batch, self._progress_callback(batch))
+                for job, result in zip(batch, results):
+                    job.result = result
+                    job.status = "done"
+                    job.step = job.num_steps
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                for job in batch:
+                    job.status = "failed"
+                    job.error = str(e)
+                logger.error(f"Image batch failed: {str(e)}")
+            finally:
+                finished_at = time.time()
+                self._step_started_at = None
+                for job in batch:
+                    job.finished_at = finished_at
+                    self._queue_waits.append(job.started_at - job.created_at)
+                    self._latencies.append(job.finished_at - job.created_at)
+                    job.done.set()
+                    await job._notify()
+            logger.info(f"Image batch of {len(batch)} {batch[0].status} in {finished_at - started_at:.2f}s")
+
+    async def _prune(self) -> None:
+        while True:
+            await asyncio.sleep(min(30.0, max(self.retention_seconds / 2, 1.0)))
+            cutoff = time.time() - self.retention_seconds
+            expired = [job_id for job_id, job in self._jobs.items() if job.finished and job.finished_at < cutoff]
+            for job_id in expired:
+                del self._jobs[job_id]
+            if expired:
+                logger.info(f"Pruned {len(expired)} finished image jobs")
+
+    def stats(self) -> Dict[str, Any]:
+        statuses: Dict[str, int] = {}
+        for job in self._jobs.values():
+            statuses[job.status] = statuses.get(job.status, 0) + 1
+        return {
+            "queued": len(self._queue),
+            "jobs": statuses,
+            "seconds_per_step": self._seconds_per_step,
+            "retention_seconds": self.retention_seconds,
+            "completed_from_cache": self.completed_from_cache,
+            "batching": {
+                "window_ms": self.batch_window * 1000.0,
+                "max_batch_size": self.max_batch_size,
+                "batch_sizes": {str(size): count for size, count in sorted(self.batch_sizes.items())},
+            },
+            "queue_wait_seconds": _percentiles(self._queue_waits),
+            "latency_seconds": _percentiles(self._latencies),
+        }
+
+
+def attach_to_app(app, manager: ImageJobManager) -> ImageJobManager:
+    """Run the dispatcher and pruner for the lifetime of the FastAPI app."""
+
+    @app.on_event("startup")
+    async def _start_image_jobs():
+        await manager.start()
+
+    @app.on_event("shutdown")
+    async def _stop_image_jobs():
+        await manager.stop()
+
+    return manager
@@ -0,0 +1,276 @@
+"""Content-addressed on-disk store for generated images.
+
+A seeded generation is fully determined by the model, scheduler, prompts,
+step count, guidance scale, size, seed and output format, so its image is
+stored under a hash of exactly those fields and served straight from disk the
+next time the same request comes in. Unseeded requests are random and are
+never stored.
+
+The index (`index.json`) survives restarts and can be shared by several
+server processes: every read-modify-write happens under an exclusive lock on
+`index.lock`, and both the index and the image files are written to a
+temporary file first and moved into place with `os.replace`. When the stored
+images exceed the size limit, least recently used entries are evicted.
+
+Lookups never take the lock or write to disk. They read a parsed copy of
+the index that is reloaded only when `index.json` changes. Access times and
+hit counts are kept in memory and merged into the index on the next `put`,
+or by `flush()` at most every `flush_interval` seconds.
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process locking, single server only
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STORE_DIR = os.path.abspath(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "image-generation", "outputs", "image_store")
+)
+
+
+def _env_flag(name: str, default: str = "0") -> bool:
+    return os.environ.get(name, default).strip().lower() in ("1", "true", "yes", "on")
+
+
+def _atomic_write(path: str, data: bytes) -> None:
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class ImageStore:
+    """Size-bounded LRU store of encoded images keyed by a hash of the request."""
+
+    def __init__(self, root: str = DEFAULT_STORE_DIR, max_bytes: int = 2 * 1024 ** 3, flush_interval: float = 60.0):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.index_path = os.path.join(root, "index.json")
+        self.lock_path = os.path.join(root, "index.lock")
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.evictions = 0
+        # Guards the in-memory state below; lookups run on executor threads
+        self._state_lock = threading.Lock()
+        self._snapshot: Dict[str, Any] = {}
+        self._snapshot_signature = None
+        # key -> (last access time, hits) not yet written to the index
+        self._pending_access: Dict[str, tuple] = {}
+        # Keys whose image file has gone missing, dropped from the index on the next write
+        self._missing = set()
+        self._last_flush = time.monotonic()
+        os.makedirs(root, exist_ok=True)
+
+    @classmethod
+    def from_env(cls) -> Optional["ImageStore"]:
+        """Build the store from IMAGE_STORE_* environment variables, or None if disabled."""
+        if not _env_flag("IMAGE_STORE_ENABLED", "1"):
+            return None
+        store = cls(
+            root=os.environ.get("IMAGE_STORE_DIR", DEFAULT_STORE_DIR),
+            max_bytes=int(os.environ.get("IMAGE_STORE_MAX_BYTES", str(2 * 1024 ** 3))),
+        )
+        logger.info(f"Image store at {store.root} (limit {store.max_bytes} bytes)")
+        return store
+
+    @staticmethod
+    def make_key(
+        model_id: str,
+        scheduler: str,
+        prompt: str,
+        negative_prompt: str,
+        num_steps: int,
+        guidance_scale: float,
+        height: int,
+        width: int,
+        seed: int,
+        image_format: str,
+    ) -> str:
+        """Hash every input that determines the encoded image into a store key."""
+        material = {
+            "model_id": model_id,
+            "scheduler": scheduler,
+            "prompt": prompt,
+            "negative_prompt": negative_prompt,
+            "num_steps": num_steps,
+            "guidance_scale": float(guidance_scale),
+            "size": [height, width],
+            "seed": seed,
+            "format": image_format,
+        }
+        encoded = json.dumps(material, sort_keys=True, ensure_ascii=False).encode("utf-8")
+        return hashlib.sha256(encoded).hexdigest()
+
+    def path_for(self, key: str, image_format: str) -> str:
+        return os.path.join(self.root, key[:2], f"{key}.{image_format}")
+
+    @contextmanager
+    def _locked_index(self):
+        """Hold the index lock and yield the index; changes are written back atomically."""
+        with open(self.lock_path, "a+") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(self.index_path, "r", encoding="utf-8") as f:
+                        index = json.load(f)
+                except (FileNotFoundError, json.JSONDecodeError):
+                    index = {}
+                before = json.dumps(index, sort_keys=True)
+                self._apply_pending(index)
+                yield index
+                if json.dumps(index, sort_keys=True) != before:
+                    _atomic_write(self.index_path, json.dumps(index, indent=1, sort_keys=True).encode("utf-8"))
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _apply_pending(self, index: Dict[str, Any]) -> None:
+        """Merge the access times, hit counts and missing files recorded since the last write."""
+        with self._state_lock:
+            pending, self._pending_access = self._pending_access, {}
+            missing, self._missing = self._missing, set()
+            self._last_flush = time.monotonic()
+        for key, (last_access, hits) in pending.items():
+            entry = index.get(key)
+            if entry is not None:
+                entry["last_access"] = max(entry["last_access"], last_access)
+                entry["hits"] = entry.get("hits", 0) + hits
+        for key in missing:
+            entry = index.get(key)
+            if entry is not None and not os.path.exists(os.path.join(self.root, entry["file"])):
+                del index[key]
+
+    def _read_index(self) -> Dict[str, Any]:
+        """The index as last written, re-parsed only when the file has changed."""
+        try:
+            stat = os.stat(self.index_path)
+        except FileNotFoundError:
+            return {}
+        signature = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        with self._state_lock:
+            if signature == self._snapshot_signature:
+                return self._snapshot
+        try:
+            # Writers replace the file atomically, so no lock is needed to read a consistent copy
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                index = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+        with self._state_lock:
+            self._snapshot, self._snapshot_signature = index, signature
+        return index
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Return the stored entry with its `image_bytes`, or None on a miss."""
+        entry = self._read_index().get(key)
+        path = os.path.join(self.root, entry["file"]) if entry is not None else None
+        image_bytes = None
+        if path is not None:
+            try:
+                with open(path, "rb") as f:
+                    image_bytes = f.read()
+            except FileNotFoundError:
+                # Evicted by another process, or removed behind our back
+                image_bytes = None
+        now = time.time()
+        with self._state_lock:
+            if image_bytes is None:
+                self.misses += 1
+                if path is not None:
+                    self._missing.add(key)
+                return None
+            self.hits += 1
+            _, hits = self._pending_access.get(key, (now, 0))
+            self._pending_access[key] = (now, hits + 1)
+            flush_due = time.monotonic() - self._last_flush >= self.flush_interval
+        if flush_due:
+            self.flush()
+        return dict(entry, last_access=now, image_bytes=image_bytes, output_file=path)
+
+    def flush(self) -> None:
+        """Write the access times and hit counts recorded by lookups to the index."""
+        with self._state_lock:
+            if not self._pending_access and not self._missing:
+                self._last_flush = time.monotonic()
+                return
+        with self._locked_index():
+            pass
+
+    def put(self, key: str, image_bytes: bytes, image_format: str, metadata: Optional[Dict[str, Any]] = None) -> str:
+        """Store an encoded image under `key`, evicting old entries if needed; returns its path."""
+        path = self.path_for(key, image_format)
+        with self._locked_index() as index:
+            # Under the lock, so another process's eviction cannot remove the shard directory in between
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            _atomic_write(path, image_bytes)
+            now = time.time()
+            index[key] = {
+                "file": os.path.relpath(path, self.root),
+                "format": image_format,
+                "size": len(image_bytes),
+                "created_at": now,
+                "last_access": now,
+                "hits": 0,
+                "metadata": metadata or {},
+            }
+            self._evict(index, keep=key)
+        with self._state_lock:
+            self.stored += 1
+        return path
+
+    def _evict(self, index: Dict[str, Any], keep: str) -> None:
+        total = sum(entry["size"] for entry in index.values())
+        for key in sorted(index, key=lambda k: index[k]["last_access"]):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            entry = index.pop(key)
+            total -= entry["size"]
+            with self._state_lock:
+                self.evictions += 1
+            path = os.path.join(self.root, entry["file"])
+            try:
+                os.remove(path)
+                os.rmdir(os.path.dirname(path))  # Only succeeds once the shard directory is empty
+            except OSError:
+                pass
+            logger.info(f"Evicted image {key} ({entry['size']} bytes) from store")
+
+    def stats(self) -> Dict[str, Any]:
+        index = self._read_index()
+        entries = len(index)
+        total = sum(entry["size"] for entry in index.values())
+        lookups = self.hits + self.misses
+        return {
+            "root": self.root,
+            "entries": entries,
+            "bytes": total,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "stored": self.stored,
+            "evictions": self.evictions,
+        }
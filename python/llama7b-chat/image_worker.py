@@ -0,0 +1,292 @@
+"""Client and supervisor for the resident Stable Diffusion worker.
+
+`generate-stable-fusion.py --serve` loads the pipeline once, warms it up and
+then answers jobs over a multiprocessing connection (a Unix socket by default).
+`ImageWorker` starts that process, talks to it, and restarts it when it dies,
+either from the watchdog or lazily on the next submitted job.
+"""
+import asyncio
+import logging
+import os
+import secrets
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SCRIPT_PATH = os.path.abspath(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "image-generation", "generate-stable-fusion.py")
+)
+
+
+class ImageWorkerError(Exception):
+    """The worker could not be started or failed while running a job."""
+
+
+class ImageWorker:
+    """Supervises one `generate-stable-fusion.py --serve` process."""
+
+    def __init__(
+        self,
+        script_path: str = DEFAULT_SCRIPT_PATH,
+        model_id: str = "CompVis/stable-diffusion-v1-4",
+        device: str = "cuda",
+        tiny: bool = False,
+        address: Optional[str] = None,
+        startup_timeout: float = 900.0,
+        watchdog_interval: float = 5.0,
+    ):
+        self.script_path = script_path
+        self.model_id = model_id
+        self.device = device
+        self.tiny = tiny
+        self.address = address or os.path.join(tempfile.gettempdir(), f"image-worker-{os.getpid()}.sock")
+        self.startup_timeout = startup_timeout
+        self.watchdog_interval = watchdog_interval
+        self.restarts = 0
+        self.jobs_completed = 0
+        self.jobs_failed = 0
+        # Model, device and scheduler reported by the running worker
+        self.pipeline_info: Optional[Dict[str, Any]] = None
+        # Prompt embedding cache statistics as of the worker's last reply
+        self.embed_cache_stats: Optional[Dict[str, Any]] = None
+        self._authkey = secrets.token_hex(16)
+        self._process: Optional[subprocess.Popen] = None
+        self._conn = None
+        # Jobs are serialized: the worker holds one pipeline and answers one request at a time
+        self._lock = threading.Lock()
+        self._watchdog: Optional[asyncio.Task] = None
+        self._stopping = False
+
+    @classmethod
+    def from_env(cls) -> "ImageWorker":
+        """Configure the worker from IMAGE_WORKER_* environment variables."""
+        return cls(
+            script_path=os.environ.get("IMAGE_WORKER_SCRIPT", DEFAULT_SCRIPT_PATH),
+            model_id=os.environ.get("IMAGE_WORKER_MODEL_ID", "CompVis/stable-diffusion-v1-4"),
+            device=os.environ.get("IMAGE_WORKER_DEVICE", "cuda"),
+            tiny=os.environ.get("IMAGE_WORKER_TINY", "0").lower() in ("1", "true", "yes", "on"),
+            address=os.environ.get("IMAGE_WORKER_ADDRESS") or None,
+            startup_timeout=float(os.environ.get("IMAGE_WORKER_STARTUP_TIMEOUT", "900")),
+        )
+
+    @property
+    def is_running(self) -> bool:
+        return self._process is not None and self._process.poll() is None and self._conn is not None
+
+    def _connect_address(self):
+        host, sep, port = self.address.rpartition(":")
+        if sep and port.isdigit():
+            return (host or "127.0.0.1", int(port))
+        return self.address
+
+    def _spawn(self) -> None:
+        if not os.path.exists(self.script_path):
+            raise ImageWorkerError(f"Image generation script not found at: {self.script_path}")
+
+        command = [
+            sys.executable,
+            self.script_path,
+            "--serve",
+            "--worker_address", self.address,
+            "--model_id", self.model_id,
+            "--device", self.device,
+        ]
+        if self.tiny:
+            command.append("--tiny_pipeline")
+
+        env = dict(os.environ, IMAGE_WORKER_AUTHKEY=self._authkey)
+        logger.info(f"Starting image worker: {' '.join(command)}")
+        # The worker logs to its own image_generation.log; keep its stdio out of our pipes
+        self._process = subprocess.Popen(
+            command,
+            cwd=os.path.dirname(self.script_path),
+            env=env,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=None,
+        )
+
+        # The listener only opens once the pipeline is loaded and warmed up
+        deadline = time.time() + self.startup_timeout
+        while True:
+            if self._process.poll() is not None:
+                raise ImageWorkerError(f"Image worker exited during startup with code {self._process.returncode}")
+            try:
+                self._conn = Client(self._connect_address(), authkey=self._authkey.encode())
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.time() > deadline:
+                    self._kill()
+                    raise ImageWorkerError(f"Image worker not ready after {self.startup_timeout:.0f}s")
+                time.sleep(0.5)
+            except (OSError, EOFError, AuthenticationError) as e:
+                self._kill()
+                raise ImageWorkerError(f"Could not connect to the image worker: {e!r}") from e
+
+        try:
+            self._conn.send({"op": "ping"})
+            info = self._conn.recv()
+        except (OSError, EOFError) as e:
+            # Don't leave the child running without a connection to it
+            self._kill()
+            raise ImageWorkerError(f"Image worker failed the startup handshake: {e!r}") from e
+        self.pipeline_info = {key: info.get(key) for key in ("model_id", "device", "scheduler")}
+        logger.info(f"Image worker ready (pid={self._process.pid}, model={info.get('model_id')}, device={info.get('device')})")
+
+    def _kill(self) -> None:
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except OSError:
+                pass
+            self._conn = None
+        if self._process is not None and self._process.poll() is None:
+            self._process.kill()
+            self._process.wait()
+        self._process = None
+
+    def _ensure_running(self) -> None:
+        if self.is_running:
+            return
+        if self._process is not None:
+            logger.warning(f"Image worker died (code {self._process.poll()}), restarting")
+            self.restarts += 1
+        self._kill()
+        self._spawn()
+
+    def start(self) -> None:
+        """Start the worker (blocking until it is ready)."""
+        with self._lock:
+            self._ensure_running()
+
+    def stop(self) -> None:
+        """Ask the worker to exit, killing it if it does not answer."""
+        self._stopping = True
+        with self._lock:
+            if self.is_running:
+                try:
+                    self._conn.send({"op": "shutdown"})
+                    self._conn.recv()
+                    self._process.wait(timeout=30)
+                except (EOFError, OSError, subprocess.TimeoutExpired):
+                    pass
+            self._kill()
+        logger.info("Image worker stopped")
+
+    def call(
+        self,
+        message: Dict[str, Any],
+        on_progress: Optional[Callable[[int, int], None]] = None,
+    ) -> Dict[str, Any]:
+        """Send one request and wait for its reply, restarting the worker if needed.
+
+        Progress events sent by the worker before the reply are passed to
+        `on_progress(step, num_steps)`.
+        """
+        with self._lock:
+            self._ensure_running()
+            try:
+                self._conn.send(message)
+                reply = self._conn.recv()
+                while reply.get("event") == "progress":
+                    if on_progress is not None:
+                        on_progress(reply["step"], reply["num_steps"])
+                    reply = self._conn.recv()
+                if reply.get("payload"):
+                    # Encoded image follows as one raw message; no pickling or base64
+                    reply["image_bytes"] = self._conn.recv_bytes()
+                for output in reply.get("outputs", []):
+                    # Batch replies: one raw message per output, in order
+                    output["image_bytes"] = self._conn.recv_bytes()
+            except (EOFError, OSError) as e:
+                # The process crashed mid-job; fail this job, the next one restarts it
+                self.jobs_failed += 1
+                self.restarts += 1
+                self._kill()
+                raise ImageWorkerError(f"Image worker crashed while running the job: {str(e)}") from e
+
+        if not reply.get("ok"):
+            self.jobs_failed += 1
+            raise ImageWorkerError(reply.get("error", "Unknown image worker error"))
+        self.jobs_completed += len(reply.get("outputs", [])) or 1
+        if "embed_cache" in reply:
+            self.embed_cache_stats = reply["embed_cache"]
+        return reply
+
+    async def generate(self, on_progress: Optional[Callable[[int, int], None]] = None, **job) -> Dict[str, Any]:
+        """Submit a generation job without blocking the event loop."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.call, {"op": "generate", "job": job}, on_progress)
+
+    async def generate_batch(
+        self,
+        jobs: List[Dict[str, Any]],
+        on_progress: Optional[Callable[[int, int], None]] = None,
+        **shared,
+    ) -> List[Dict[str, Any]]:
+        """Run several jobs that share size, steps and guidance as one batched pipeline call.
+
+        Each job carries its own prompt, negative_prompt, seed, output_file and
+        image_format; one output dict (with `image_bytes`) is returned per job.
+        """
+        loop = asyncio.get_running_loop()
+        message = {"op": "generate_batch", "batch": dict(shared, jobs=jobs)}
+        reply = await loop.run_in_executor(None, self.call, message, on_progress)
+        return reply["outputs"]
+
+    async def _watch(self) -> None:
+        while not self._stopping:
+            await asyncio.sleep(self.watchdog_interval)
+            if self._process is not None and self._process.poll() is not None and not self._lock.locked():
+                logger.warning("Image worker watchdog found a dead worker, restarting")
+                loop = asyncio.get_running_loop()
+                try:
+                    await loop.run_in_executor(None, self.start)
+                except ImageWorkerError as e:
+                    logger.error(f"Image worker restart failed: {str(e)}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "running": self.is_running,
+            "pid": self._process.pid if self._process is not None else None,
+            "model_id": self.model_id,
+            "device": "cpu" if self.tiny else self.device,
+            "restarts": self.restarts,
+            "jobs_completed": self.jobs_completed,
+            "jobs_failed": self.jobs_failed,
+            "prompt_embed_cache": self.embed_cache_stats,
+        }
+
+
+def attach_to_app(app, worker: ImageWorker) -> ImageWorker:
+    """Start the worker in the background on startup and stop it on shutdown."""
+
+    @app.on_event("startup")
+    async def _start_image_worker():
+        loop = asyncio.get_running_loop()
+
+        async def _boot():
+            try:
+                await loop.run_in_executor(None, worker.start)
+            except ImageWorkerError as e:
+                logger.error(f"Image worker failed to start, will retry on first job: {str(e)}")
+
+        # Model loading takes a while; don't hold up the text endpoints
+        asyncio.ensure_future(_boot())
+        worker._watchdog = asyncio.ensure_future(worker._watch())
+
+    @app.on_event("shutdown")
+    async def _stop_image_worker():
+        if worker._watchdog is not None:
+            worker._watchdog.cancel()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, worker.stop)
+
+    return worker
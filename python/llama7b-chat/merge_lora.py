@@ -0,0 +1,346 @@
+"""Merge the LoRA adapter from finetune.py into the base weights and export it.
+
+`use-finetune.py` loads the 4-bit base model and wraps it in a `PeftModel`
+every time, which means two artifacts to load and an extra low-rank matmul on
+every adapted projection. This tool folds the adapter into the base weights
+(`merge_and_unload()`), writes the result as a standalone safetensors
+checkpoint with the tokenizer, and can additionally save a bitsandbytes
+re-quantized copy. `--benchmark` loads the unmerged and merged models the same
+way and compares load time, prefill time and per-token decode latency on the
+same prompts.
+
+Merging is done in full or half precision: folding LoRA deltas into already
+quantized 4-bit weights would round them away, so the base model is loaded
+unquantized here and only the export is re-quantized.
+
+    python merge_lora.py --adapter_dir ./village_finetuned_model --output_dir ./village_merged_model
+    python merge_lora.py --output_dir ./village_merged_model --quantize 4bit
+    python merge_lora.py --output_dir ./village_merged_model --benchmark
+    python merge_lora.py --tiny --benchmark   # CPU smoke test with a random tiny Llama
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+BASE_MODEL_NAME = "NousResearch/Llama-2-7b-chat-hf"
+DEFAULT_ADAPTER_DIR = "./village_finetuned_model"
+DEFAULT_OUTPUT_DIR = "./village_merged_model"
+
+BENCHMARK_PROMPTS = [
+    "### Instruction:\nGenerate a detailed, imaginative description of a quaint medieval village.\n"
+    "### Input:\nVillage: Eldoria\nTime: Medieval period\nLocation: Valley surrounded by forests\n"
+    "### Response:\nLet me describe this village in detail:\n",
+    "### Instruction:\nCreate a vivid description of a village in a desert environment.\n"
+    "### Input:\nVillage: Sandstone Haven\nClimate: Hot desert\nSpecial feature: Built around an oasis\n"
+    "### Response:\nLet me describe this village in detail:\n",
+]
+
+
+def _dtype(name: str):
+    import torch
+    return {"float16": torch.float16, "bfloat16": torch.bfloat16, "float32": torch.float32}[name]
+
+
+def _quantization_config(quantize: Optional[str]):
+    if quantize is None:
+        return None
+    import torch
+    from transformers import BitsAndBytesConfig
+    if quantize == "4bit":
+        return BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=torch.float16,
+            bnb_4bit_use_double_quant=True
+        )
+    return BitsAndBytesConfig(load_in_8bit=True)
+
+
+def _sync():
+    import torch
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def load_unmerged(base_model: str, adapter_dir: str, dtype: str = "float16", device_map="auto", quantize: Optional[str] = None):
+    """Load the base model and wrap it with the LoRA adapter, as use-finetune.py does."""
+    from peft import PeftModel
+    from transformers import AutoModelForCausalLM
+
+    model = AutoModelForCausalLM.from_pretrained(
+        base_model,
+        torch_dtype=_dtype(dtype),
+        device_map=device_map,
+        quantization_config=_quantization_config(quantize),
+        low_cpu_mem_usage=True
+    )
+    model = PeftModel.from_pretrained(model, adapter_dir)
+    model.eval()
+    return model
+
+
+def load_merged(merged_dir: str, dtype: str = "float16", device_map="auto", quantize: Optional[str] = None):
+    """Load a checkpoint written by merge_adapter() (or its re-quantized copy)."""
+    from transformers import AutoModelForCausalLM
+
+    model = AutoModelForCausalLM.from_pretrained(
+        merged_dir,
+        torch_dtype=_dtype(dtype),
+        device_map=device_map,
+        quantization_config=_quantization_config(quantize),
+        low_cpu_mem_usage=True
+    )
+    model.eval()
+    return model
+
+
+def merge_adapter(
+    base_model: str,
+    adapter_dir: str,
+    output_dir: str,
+    dtype: str = "float16",
+    device_map="auto",
+    max_shard_size: str = "2GB"
+) -> str:
+    """Fold the LoRA adapter into the base weights and save a standalone safetensors checkpoint."""
+    from transformers import AutoTokenizer
+
+    logger.info(f"Loading {base_model} ({dtype}) with adapter {adapter_dir}")
+    start = time.perf_counter()
+    model = load_unmerged(base_model, adapter_dir, dtype=dtype, device_map=device_map)
+    logger.info(f"Loaded in {time.perf_counter() - start:.2f}s, merging adapter")
+
+    merged = model.merge_and_unload()
+    os.makedirs(output_dir, exist_ok=True)
+    merged.save_pretrained(output_dir, safe_serialization=True, max_shard_size=max_shard_size)
+
+    # finetune.py saves the tokenizer next to the adapter; fall back to the base model's
+    tokenizer_source = adapter_dir if os.path.exists(os.path.join(adapter_dir, "tokenizer_config.json")) else base_model
+    AutoTokenizer.from_pretrained(tokenizer_source, use_fast=True).save_pretrained(output_dir)
+
+    with open(os.path.join(output_dir, "merge_info.json"), "w", encoding="utf-8") as f:
+        json.dump({
+            "base_model": base_model,
+            "adapter_dir": os.path.abspath(adapter_dir),
+            "dtype": dtype,
+            "merged_at": datetime.now().isoformat()
+        }, f, indent=2)
+
+    logger.info(f"Merged checkpoint saved to {output_dir} in {time.perf_counter() - start:.2f}s")
+    return output_dir
+
+
+def requantize(merged_dir: str, output_dir: str, quantize: str = "4bit") -> str:
+    """Save a bitsandbytes-quantized copy of a merged checkpoint (needs CUDA and bitsandbytes)."""
+    from transformers import AutoTokenizer
+
+    logger.info(f"Re-quantizing {merged_dir} to {quantize}")
+    model = load_merged(merged_dir, quantize=quantize)
+    os.makedirs(output_dir, exist_ok=True)
+    model.save_pretrained(output_dir, safe_serialization=True)
+    AutoTokenizer.from_pretrained(merged_dir, use_fast=True).save_pretrained(output_dir)
+    logger.info(f"Quantized checkpoint saved to {output_dir}")
+    return output_dir
+
+
+def measure_latency(model, tokenizer, prompts: List[str], max_new_tokens: int = 64) -> Dict[str, float]:
+    """Greedy-decode each prompt and time prefill and per-token decode separately."""
+    import torch
+
+    prefill_times = []
+    decode_times = []
+    decoded_tokens = 0
+    for prompt in prompts:
+        inputs = tokenizer(prompt, return_tensors="pt").to(model.device)
+        with torch.inference_mode():
+            _sync()
+            start = time.perf_counter()
+            model(**inputs)
+            _sync()
+            prefill_times.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            output = model.generate(
+                **inputs,
+                max_new_tokens=max_new_tokens,
+                min_new_tokens=max_new_tokens,
+                do_sample=False,
+                pad_token_id=tokenizer.eos_token_id
+            )
+            _sync()
+            elapsed = time.perf_counter() - start
+        new_tokens = output.shape[1] - inputs["input_ids"].shape[1]
+        # generate() includes one prefill; take it out to get decode-only time
+        decode_times.append(max(elapsed - prefill_times[-1], 0.0))
+        decoded_tokens += new_tokens
+
+    return {
+        "prompts": len(prompts),
+        "prefill_seconds": sum(prefill_times) / len(prefill_times),
+        "decode_tokens": decoded_tokens,
+        "per_token_ms": 1000.0 * sum(decode_times) / decoded_tokens if decoded_tokens else 0.0,
+    }
+
+
+def benchmark(
+    base_model: str,
+    adapter_dir: str,
+    merged_dir: str,
+    dtype: str = "float16",
+    device_map="auto",
+    quantize: Optional[str] = None,
+    prompts: Optional[List[str]] = None,
+    max_new_tokens: int = 64
+) -> Dict[str, Dict[str, float]]:
+    """Compare load time and latency of base+adapter against the merged checkpoint."""
+    import gc
+    import torch
+    from transformers import AutoTokenizer
+
+    prompts = prompts or BENCHMARK_PROMPTS
+    tokenizer = AutoTokenizer.from_pretrained(merged_dir, use_fast=True)
+    results = {}
+    for label in ("unmerged", "merged"):
+        start = time.perf_counter()
+        if label == "unmerged":
+            model = load_unmerged(base_model, adapter_dir, dtype=dtype, device_map=device_map, quantize=quantize)
+        else:
+            model = load_merged(merged_dir, dtype=dtype, device_map=device_map, quantize=quantize)
+        _sync()
+        load_seconds = time.perf_counter() - start
+
+        measure_latency(model, tokenizer, prompts[:1], max_new_tokens=4)  # warm-up
+        results[label] = dict(load_seconds=load_seconds, **measure_latency(model, tokenizer, prompts, max_new_tokens))
+        logger.info(f"{label}: {results[label]}")
+
+        del model
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    print(f"\n{'':<10}{'load (s)':>12}{'prefill (s)':>14}{'ms/token':>12}")
+    print("-" * 48)
+    for label, r in results.items():
+        print(f"{label:<10}{r['load_seconds']:>12.3f}{r['prefill_seconds']:>14.4f}{r['per_token_ms']:>12.3f}")
+    return results
+
+
+def build_tiny_artifacts(workdir: str):
+    """Write a tiny base model and a non-trivial LoRA adapter to disk for CPU testing."""
+    import torch
+    from peft import LoraConfig, get_peft_model
+    from tiny_llama import build_tiny_llama
+
+    base_dir = os.path.join(workdir, "tiny-base")
+    adapter_dir = os.path.join(workdir, "tiny-adapter")
+    model, tokenizer = build_tiny_llama()
+    model.save_pretrained(base_dir, safe_serialization=True)
+    tokenizer.save_pretrained(base_dir)
+
+    torch.manual_seed(1)
+    lora_config = LoraConfig(
+        r=8,
+        lora_alpha=16,
+        target_modules=["q_proj", "v_proj"],
+        lora_dropout=0.0,
+        bias="none",
+        task_type="CAUSAL_LM",
+        init_lora_weights=False  # Random B as well as A, so the merge actually changes weights
+    )
+    get_peft_model(model, lora_config).save_pretrained(adapter_dir)
+    tokenizer.save_pretrained(adapter_dir)
+    return base_dir, adapter_dir
+
+
+def check_merge(base_model: str, adapter_dir: str, merged_dir: str, dtype: str = "float32") -> float:
+    """Max absolute logit difference between base+adapter and the merged checkpoint."""
+    import torch
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(merged_dir, use_fast=True)
+    inputs = tokenizer(BENCHMARK_PROMPTS[0], return_tensors="pt")
+    with torch.inference_mode():
+        unmerged = load_unmerged(base_model, adapter_dir, dtype=dtype, device_map=None)(**inputs).logits
+        merged = load_merged(merged_dir, dtype=dtype, device_map=None)(**inputs).logits
+    return float((unmerged - merged).abs().max())
+
+
+def parse_args():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description="Merge the village LoRA adapter into the base model")
+    parser.add_argument("--base_model", type=str, default=BASE_MODEL_NAME, help="Base model name or path")
+    parser.add_argument("--adapter_dir", type=str, default=DEFAULT_ADAPTER_DIR, help="LoRA adapter written by finetune.py")
+    parser.add_argument("--output_dir", type=str, default=DEFAULT_OUTPUT_DIR, help="Where to write the merged checkpoint")
+    parser.add_argument("--dtype", type=str, default="float16", choices=["float16", "bfloat16", "float32"],
+                        help="Precision used for merging and for the exported weights")
+    parser.add_argument("--device", type=str, default="auto", help="'auto' (accelerate device map) or 'cpu'")
+    parser.add_argument("--max_shard_size", type=str, default="2GB", help="Maximum safetensors shard size")
+    parser.add_argument("--quantize", type=str, choices=["4bit", "8bit"], default=None,
+                        help="Also save a bitsandbytes re-quantized copy (and benchmark quantized loads)")
+    parser.add_argument("--quantized_output_dir", type=str, default=None,
+                        help="Directory for the re-quantized copy (default: <output_dir>-<quantize>)")
+    parser.add_argument("--skip_merge", action="store_true", help="Reuse an existing merged checkpoint")
+    parser.add_argument("--benchmark", action="store_true", help="Compare merged and unmerged load time and latency")
+    parser.add_argument("--max_new_tokens", type=int, default=64, help="Tokens decoded per benchmark prompt")
+    parser.add_argument("--tiny", action="store_true", help="Run on CPU with a random tiny Llama and adapter")
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[logging.StreamHandler(sys.stdout)]
+    )
+    args = parse_args()
+    device_map = None if args.device == "cpu" else args.device
+
+    try:
+        if args.tiny:
+            workdir = tempfile.mkdtemp(prefix="tiny-merge-")
+            args.base_model, args.adapter_dir = build_tiny_artifacts(workdir)
+            args.output_dir = os.path.join(workdir, "tiny-merged")
+            args.dtype = "float32"
+            device_map = None
+            logger.info(f"Tiny artifacts written to {workdir}")
+
+        if not args.skip_merge:
+            merge_adapter(args.base_model, args.adapter_dir, args.output_dir, args.dtype, device_map, args.max_shard_size)
+
+        if args.tiny:
+            logger.info(f"Max logit difference merged vs. unmerged: {check_merge(args.base_model, args.adapter_dir, args.output_dir):.2e}")
+
+        if args.quantize:
+            requantize(args.output_dir, args.quantized_output_dir or f"{args.output_dir}-{args.quantize}", args.quantize)
+
+        if args.benchmark:
+            results = benchmark(
+                args.base_model,
+                args.adapter_dir,
+                args.output_dir,
+                dtype=args.dtype,
+                device_map=device_map,
+                quantize=args.quantize,
+                max_new_tokens=args.max_new_tokens
+            )
+            with open(os.path.join(args.output_dir, "benchmark.json"), "w", encoding="utf-8") as f:
+                json.dump(results, f, indent=2)
+
+    except KeyboardInterrupt:
+        logger.info("Process interrupted by user")
+        sys.exit(1)
+    except Exception as e:
+        logger.error(f"Merge failed: {e}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
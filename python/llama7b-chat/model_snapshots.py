@@ -0,0 +1,346 @@
+"""Local cache of pre-quantized / converted model snapshots.
+
+`use-finetune.py`, `finetune.py` and the actor-method generator each load the
+full fp16 Llama-2 weights and quantize them to 4-bit on every start. This
+module saves the model once, already quantized (or converted to the requested
+dtype), as a safetensors checkpoint that `from_pretrained` memory-maps, and
+serves later loads straight from it. Snapshots are keyed on the model id,
+revision, dtype, quantization config and library versions, so changing any of
+them builds a new snapshot instead of loading a stale one.
+
+Every snapshot directory carries a `snapshot.json` with the time the original
+(hub) load took and the time of the latest snapshot load, so the startup
+saving is visible with `python model_snapshots.py list`.
+
+    python model_snapshots.py build --model_id NousResearch/Llama-2-7b-chat-hf --quantize 4bit
+    python model_snapshots.py list
+    python model_snapshots.py prune --max_bytes 20GB
+
+Set MODEL_SNAPSHOTS_ENABLED=0 to always load from the original weights.
+Saving 4-bit bitsandbytes weights needs bitsandbytes >= 0.41.3.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_ROOT = os.environ.get(
+    "MODEL_SNAPSHOT_DIR", os.path.join(os.path.expanduser("~"), ".cache", "village-ai", "snapshots")
+)
+METADATA_FILE = "snapshot.json"
+
+
+def snapshots_enabled() -> bool:
+    return os.environ.get("MODEL_SNAPSHOTS_ENABLED", "1").strip().lower() in ("1", "true", "yes", "on")
+
+
+def bnb_4bit_config(double_quant: bool = False):
+    """The 4-bit NF4 / fp16-compute settings the training and inference scripts use."""
+    import torch
+    from transformers import BitsAndBytesConfig
+    return BitsAndBytesConfig(
+        load_in_4bit=True,
+        bnb_4bit_quant_type="nf4",
+        bnb_4bit_compute_dtype=torch.float16,
+        bnb_4bit_use_double_quant=double_quant
+    )
+
+
+def _library_versions() -> Dict[str, Optional[str]]:
+    from importlib import metadata
+    versions = {}
+    for package in ("transformers", "bitsandbytes", "safetensors"):
+        try:
+            versions[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            versions[package] = None
+    return versions
+
+
+def snapshot_key(model_id: str, revision: Optional[str], torch_dtype: Any, quantization_config: Any) -> Tuple[str, Dict[str, Any]]:
+    """Return (key, material): a stable hash of everything that changes the saved weights."""
+    quantization = quantization_config.to_dict() if quantization_config is not None else None
+    material = {
+        "model_id": model_id,
+        "revision": revision,
+        "torch_dtype": str(torch_dtype),
+        "quantization": quantization,
+        "versions": _library_versions(),
+    }
+    encoded = json.dumps(material, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest(), material
+
+
+def snapshot_dir(key: str, model_id: str, root: str = SNAPSHOT_ROOT) -> str:
+    slug = model_id.rstrip("/").split("/")[-1].replace(" ", "_")
+    return os.path.join(root, f"{slug}-{key[:16]}")
+
+
+def _dir_size(path: str) -> int:
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            total += os.path.getsize(os.path.join(dirpath, filename))
+    return total
+
+
+def _read_metadata(path: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(os.path.join(path, METADATA_FILE), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def _write_metadata(path: str, metadata: Dict[str, Any]) -> None:
+    tmp_path = os.path.join(path, METADATA_FILE + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(metadata, f, indent=2, default=str)
+    os.replace(tmp_path, os.path.join(path, METADATA_FILE))
+
+
+def load_model(
+    model_id: str,
+    revision: Optional[str] = None,
+    torch_dtype: Any = None,
+    quantization_config: Any = None,
+    device_map: Any = "auto",
+    root: str = SNAPSHOT_ROOT,
+    build: bool = True,
+    **from_pretrained_kwargs
+):
+    """Load a causal LM from its snapshot, building the snapshot from the original weights first if needed.
+
+    Extra keyword arguments (max_memory, low_cpu_mem_usage, ...) are passed to
+    `from_pretrained` in both cases. Returns the model; the load report is
+    logged and kept on `model.snapshot_report`.
+    """
+    from transformers import AutoModelForCausalLM
+
+    if not snapshots_enabled():
+        start = time.perf_counter()
+        model = AutoModelForCausalLM.from_pretrained(
+            model_id, revision=revision, torch_dtype=torch_dtype, quantization_config=quantization_config,
+            device_map=device_map, **from_pretrained_kwargs
+        )
+        model.snapshot_report = {"source": "original", "seconds": time.perf_counter() - start}
+        logger.info(f"Loaded {model_id} from original weights in {model.snapshot_report['seconds']:.2f}s (snapshots disabled)")
+        return model
+
+    key, material = snapshot_key(model_id, revision, torch_dtype, quantization_config)
+    path = snapshot_dir(key, model_id, root)
+    metadata = _read_metadata(path)
+
+    if metadata is not None:
+        start = time.perf_counter()
+        # The saved config carries the quantization config; the weights are loaded as stored
+        model = AutoModelForCausalLM.from_pretrained(
+            path, torch_dtype=torch_dtype, device_map=device_map, **from_pretrained_kwargs
+        )
+        seconds = time.perf_counter() - start
+        metadata["last_load_seconds"] = seconds
+        metadata["last_used"] = datetime.now().isoformat()
+        metadata["loads"] = metadata.get("loads", 0) + 1
+        _write_metadata(path, metadata)
+        original = metadata.get("original_load_seconds")
+        saved = f", {original - seconds:.2f}s faster than the original load" if original else ""
+        logger.info(f"Loaded {model_id} from snapshot {path} in {seconds:.2f}s{saved}")
+        model.snapshot_report = {"source": "snapshot", "seconds": seconds, "original_seconds": original, "path": path}
+        return model
+
+    start = time.perf_counter()
+    model = AutoModelForCausalLM.from_pretrained(
+        model_id, revision=revision, torch_dtype=torch_dtype, quantization_config=quantization_config,
+        device_map=device_map, **from_pretrained_kwargs
+    )
+    seconds = time.perf_counter() - start
+    logger.info(f"Loaded {model_id} from original weights in {seconds:.2f}s")
+    model.snapshot_report = {"source": "original", "seconds": seconds}
+
+    if build:
+        try:
+            save_snapshot(model, model_id, path, material, seconds)
+            model.snapshot_report["path"] = path
+        except Exception as e:
+            # A snapshot is an optimisation; never fail the load because of it
+            logger.warning(f"Could not save snapshot for {model_id}: {e}")
+    return model
+
+
+def save_snapshot(model, model_id: str, path: str, material: Dict[str, Any], original_load_seconds: float) -> str:
+    """Write the loaded model (and its tokenizer, if available) to `path` atomically."""
+    from transformers import AutoTokenizer
+
+    start = time.perf_counter()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    try:
+        model.save_pretrained(tmp_path, safe_serialization=True)
+        try:
+            AutoTokenizer.from_pretrained(material.get("model_id"), revision=material.get("revision")).save_pretrained(tmp_path)
+        except (OSError, ValueError) as e:
+            logger.info(f"Snapshot saved without tokenizer: {e}")
+        _write_metadata(tmp_path, dict(
+            material,
+            created_at=datetime.now().isoformat(),
+            last_used=datetime.now().isoformat(),
+            original_load_seconds=original_load_seconds,
+            last_load_seconds=None,
+            loads=0,
+            size_bytes=_dir_size(tmp_path)
+        ))
+        if os.path.exists(path):
+            # Another process finished the same snapshot first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        else:
+            os.replace(tmp_path, path)
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+    logger.info(f"Saved snapshot of {model_id} to {path} in {time.perf_counter() - start:.2f}s")
+    return path
+
+
+def list_snapshots(root: str = SNAPSHOT_ROOT) -> List[Dict[str, Any]]:
+    snapshots = []
+    if not os.path.isdir(root):
+        return snapshots
+    for entry in sorted(os.listdir(root)):
+        path = os.path.join(root, entry)
+        metadata = _read_metadata(path)
+        if metadata is None or ".tmp-" in entry:
+            continue
+        snapshots.append(dict(metadata, path=path))
+    return snapshots
+
+
+def prune_snapshots(
+    root: str = SNAPSHOT_ROOT,
+    keep: Optional[int] = None,
+    older_than_days: Optional[float] = None,
+    max_bytes: Optional[int] = None,
+    dry_run: bool = False
+) -> List[str]:
+    """Remove least recently used snapshots until every given limit holds; returns the removed paths."""
+    # Least recently used first
+    snapshots = sorted(list_snapshots(root), key=lambda s: s.get("last_used") or "")
+    removed = []
+    total = sum(s.get("size_bytes", 0) for s in snapshots)
+    cutoff = time.time() - older_than_days * 86400 if older_than_days is not None else None
+    for index, snapshot in enumerate(snapshots):
+        remaining = len(snapshots) - index
+        too_many = keep is not None and remaining > keep
+        too_old = cutoff is not None and datetime.fromisoformat(snapshot["last_used"]).timestamp() < cutoff
+        # Always keep the most recently used snapshot under a size limit
+        too_big = max_bytes is not None and total > max_bytes and remaining > 1
+        if not (too_many or too_old or too_big):
+            continue
+        removed.append(snapshot["path"])
+        total -= snapshot.get("size_bytes", 0)
+        if not dry_run:
+            shutil.rmtree(snapshot["path"], ignore_errors=True)
+    return removed
+
+
+def _parse_size(value: str) -> int:
+    units = {"KB": 1024, "MB": 1024 ** 2, "GB": 1024 ** 3, "TB": 1024 ** 4}
+    value = value.strip().upper()
+    for unit, factor in units.items():
+        if value.endswith(unit):
+            return int(float(value[:-len(unit)]) * factor)
+    return int(value)
+
+
+def parse_args():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description="Build, list and prune pre-quantized model snapshots")
+    parser.add_argument("--root", type=str, default=SNAPSHOT_ROOT, help="Snapshot directory")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build = subparsers.add_parser("build", help="Load a model once and save its snapshot")
+    build.add_argument("--model_id", type=str, default="NousResearch/Llama-2-7b-chat-hf")
+    build.add_argument("--revision", type=str, default=None)
+    build.add_argument("--quantize", type=str, choices=["4bit", "4bit-double", "8bit", "none"], default="4bit",
+                       help="4bit matches use-finetune.py and the actor-method script, 4bit-double matches finetune.py")
+    build.add_argument("--dtype", type=str, choices=["float16", "bfloat16", "float32"], default="float16")
+    build.add_argument("--device", type=str, default="auto", help="'auto' or 'cpu'")
+
+    subparsers.add_parser("list", help="Show snapshots with their load-time savings")
+
+    prune = subparsers.add_parser("prune", help="Delete least recently used snapshots")
+    prune.add_argument("--keep", type=int, default=None, help="Keep this many most recently used snapshots")
+    prune.add_argument("--older_than_days", type=float, default=None, help="Delete snapshots unused for this long")
+    prune.add_argument("--max_bytes", type=str, default=None, help="Total size limit, e.g. 20GB")
+    prune.add_argument("--dry_run", action="store_true")
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[logging.StreamHandler(sys.stdout)]
+    )
+    args = parse_args()
+
+    if args.command == "build":
+        import torch
+        from transformers import BitsAndBytesConfig
+        quantization_config = {
+            "4bit": lambda: bnb_4bit_config(double_quant=False),
+            "4bit-double": lambda: bnb_4bit_config(double_quant=True),
+            "8bit": lambda: BitsAndBytesConfig(load_in_8bit=True),
+            "none": lambda: None,
+        }[args.quantize]()
+        model = load_model(
+            args.model_id,
+            revision=args.revision,
+            torch_dtype=getattr(torch, args.dtype),
+            quantization_config=quantization_config,
+            device_map=None if args.device == "cpu" else args.device,
+            root=args.root,
+            low_cpu_mem_usage=True
+        )
+        print(json.dumps(model.snapshot_report, indent=2, default=str))
+
+    elif args.command == "list":
+        snapshots = list_snapshots(args.root)
+        if not snapshots:
+            print(f"No snapshots in {args.root}")
+            return
+        print(f"{'model':<40}{'quant':>8}{'size':>10}{'orig (s)':>10}{'snap (s)':>10}{'loads':>7}  last used")
+        print("-" * 108)
+        for s in snapshots:
+            quantization = s.get("quantization") or {}
+            quant = "4bit" if quantization.get("load_in_4bit") else "8bit" if quantization.get("load_in_8bit") else s.get("torch_dtype", "")
+            last = s.get("last_load_seconds")
+            print(
+                f"{s['model_id'][-40:]:<40}{quant.replace('torch.', ''):>8}{s.get('size_bytes', 0) / 1024 ** 3:>9.2f}G"
+                f"{s.get('original_load_seconds', 0):>10.2f}{(last if last is not None else float('nan')):>10.2f}"
+                f"{s.get('loads', 0):>7}  {s.get('last_used', '')[:19]}"
+            )
+
+    elif args.command == "prune":
+        removed = prune_snapshots(
+            args.root,
+            keep=args.keep,
+            older_than_days=args.older_than_days,
+            max_bytes=_parse_size(args.max_bytes) if args.max_bytes else None,
+            dry_run=args.dry_run
+        )
+        for path in removed:
+            print(f"{'Would remove' if args.dry_run else 'Removed'} {path}")
+        print(f"{len(removed)} snapshot(s) {'selected' if args.dry_run else 'removed'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+"""Async HTTP client for the Ollama API.
+
+Both FastAPI servers share this module instead of forking `curl` per request.
+One aiohttp session is kept per process so requests reuse keep-alive
+connections from a bounded pool, and transport failures are mapped onto a
+small exception hierarchy the servers translate into HTTP status codes.
+"""
+import asyncio
+import json
+import logging
+import os
+from typing import Any, AsyncIterator, Dict, Optional
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+# Defaults can be overridden from the environment without touching the servers
+OLLAMA_URL = os.environ.get("OLLAMA_URL", "http://localhost:11434")
+OLLAMA_POOL_SIZE = int(os.environ.get("OLLAMA_POOL_SIZE", "8"))
+OLLAMA_CONNECT_TIMEOUT = float(os.environ.get("OLLAMA_CONNECT_TIMEOUT", "5"))
+OLLAMA_READ_TIMEOUT = float(os.environ.get("OLLAMA_READ_TIMEOUT", "300"))
+OLLAMA_KEEPALIVE_TIMEOUT = float(os.environ.get("OLLAMA_KEEPALIVE_TIMEOUT", "60"))
+
+
+class OllamaError(Exception):
+    """Base error for failed Ollama calls; `status_code` is the HTTP status to surface."""
+
+    status_code = 502
+
+
+class OllamaUnavailableError(OllamaError):
+    """Ollama could not be reached (connection refused, DNS, reset)."""
+
+    status_code = 503
+
+
+class OllamaTimeoutError(OllamaError):
+    """Ollama did not answer within the configured timeouts."""
+
+    status_code = 504
+
+
+class OllamaResponseError(OllamaError):
+    """Ollama answered with an error status or a body we could not parse."""
+
+    status_code = 502
+
+
+class OllamaClient:
+    """Pooled async client for a single Ollama instance."""
+
+    def __init__(
+        self,
+        base_url: str = OLLAMA_URL,
+        pool_size: int = OLLAMA_POOL_SIZE,
+        connect_timeout: float = OLLAMA_CONNECT_TIMEOUT,
+        read_timeout: float = OLLAMA_READ_TIMEOUT,
+        keepalive_timeout: float = OLLAMA_KEEPALIVE_TIMEOUT,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.keepalive_timeout = keepalive_timeout
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._lock = asyncio.Lock()
+
+    async def start(self) -> None:
+        """Open the connection pool. Safe to call more than once."""
+        async with self._lock:
+            if self._session is not None and not self._session.closed:
+                return
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            timeout = aiohttp.ClientTimeout(
+                total=None,
+                connect=self.connect_timeout,
+                sock_read=self.read_timeout,
+            )
+            self._session = aiohttp.ClientSession(
+                base_url=self.base_url,
+                connector=connector,
+                timeout=timeout,
+            )
+            logger.info(
+                f"Ollama client started for {self.base_url} "
+                f"(pool={self.pool_size}, connect={self.connect_timeout}s, read={self.read_timeout}s)"
+            )
+
+    async def close(self) -> None:
+        """Close the pool and drop all keep-alive connections."""
+        async with self._lock:
+            if self._session is not None and not self._session.closed:
+                await self._session.close()
+                logger.info("Ollama client closed")
+            self._session = None
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        # Lazily start so scripts can use the client without FastAPI lifecycle hooks
+        if self._session is None or self._session.closed:
+            await self.start()
+        return self._session
+
+    async def _request_json(self, method: str, path: str, payload: Optional[dict] = None) -> Dict[str, Any]:
+        session = await self._get_session()
+        try:
+            async with session.request(method, path, json=payload) as response:
+                body = await response.text()
+                if response.status >= 400:
+                    raise OllamaResponseError(f"Ollama returned HTTP {response.status}: {body[:500]}")
+                try:
+                    return json.loads(body)
+                except json.JSONDecodeError as e:
+                    raise OllamaResponseError(f"Failed to parse Ollama response: {str(e)}") from e
+        except asyncio.TimeoutError as e:
+            raise OllamaTimeoutError(f"Ollama request to {path} timed out") from e
+        except aiohttp.ClientConnectionError as e:
+            raise OllamaUnavailableError(f"Could not connect to Ollama at {self.base_url}: {str(e)}") from e
+        except aiohttp.ClientError as e:
+            raise OllamaResponseError(f"Ollama request to {path} failed: {str(e)}") from e
+
+    async def generate(
+        self,
+        prompt: str,
+        model: str = "llama2",
+        options: Optional[Dict[str, Any]] = None,
+    ) -> Dict[str, Any]:
+        """Run a non-streaming generation and return Ollama's full JSON reply."""
+        payload: Dict[str, Any] = {"model": model, "prompt": prompt, "stream": False}
+        if options:
+            payload["options"] = options
+        return await self._request_json("POST", "/api/generate", payload)
+
+    async def generate_stream(
+        self,
+        prompt: str,
+        model: str = "llama2",
+        options: Optional[Dict[str, Any]] = None,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """Run a streaming generation, yielding each NDJSON chunk Ollama sends.
+
+        Chunks carry a partial `response` string; the last one has `done: true`
+        and Ollama's timing counters.
+        """
+        payload: Dict[str, Any] = {"model": model, "prompt": prompt, "stream": True}
+        if options:
+            payload["options"] = options
+        session = await self._get_session()
+        try:
+            async with session.post("/api/generate", json=payload) as response:
+                if response.status >= 400:
+                    body = await response.text()
+                    raise OllamaResponseError(f"Ollama returned HTTP {response.status}: {body[:500]}")
+                async for line in response.content:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        chunk = json.loads(line)
+                    except json.JSONDecodeError as e:
+                        raise OllamaResponseError(f"Failed to parse Ollama stream chunk: {str(e)}") from e
+                    if "error" in chunk:
+                        raise OllamaResponseError(f"Ollama stream error: {chunk['error']}")
+                    yield chunk
+                    if chunk.get("done"):
+                        return
+        except asyncio.TimeoutError as e:
+            raise OllamaTimeoutError("Ollama stream timed out") from e
+        except aiohttp.ClientConnectionError as e:
+            raise OllamaUnavailableError(f"Could not connect to Ollama at {self.base_url}: {str(e)}") from e
+        except aiohttp.ClientError as e:
+            raise OllamaResponseError(f"Ollama stream failed: {str(e)}") from e
+
+    async def version(self) -> str:
+        """Return the Ollama server version string."""
+        data = await self._request_json("GET", "/api/version")
+        return data.get("version", "unknown")
+
+
+def attach_to_app(app, client: OllamaClient) -> OllamaClient:
+    """Tie the client's pool to the FastAPI app's startup/shutdown events."""
+
+    @app.on_event("startup")
+    async def _start_ollama_client():
+        await client.start()
+
+    @app.on_event("shutdown")
+    async def _close_ollama_client():
+        await client.close()
+
+    return client
@@ -0,0 +1,291 @@
+"""Sequence packing and length-bucketed batching for causal LM fine-tuning.
+
+The village examples are a few dozen tokens long, so a batch of one padded
+example wastes almost every forward pass. Two ways to fill batches with real
+tokens:
+
+* `PackingCollator` concatenates the examples of a batch into as few rows of
+  `max_seq_len` tokens as possible (first-fit decreasing). Every example keeps
+  its own position ids starting at 0, attention never crosses an example
+  boundary, and the label of each example's first token is masked so no
+  example is trained to predict its neighbour. Boundaries are enforced with
+  an explicit block-diagonal 4D mask, which eager and SDPA attention honour;
+  position ids alone do not stop them attending across examples.
+* `LengthBucketBatchSampler` groups examples of similar length into batches
+  under a token budget, and `PaddingCollator` pads each batch only to its own
+  longest example.
+
+Both collators record how many of the tokens they emit are real
+(`BatchStats`), and `BatchingTrainer` adds padding efficiency and tokens per
+optimizer step to every Trainer log.
+"""
+import logging
+import random
+from collections import deque
+from typing import Any, Dict, List, Optional, Sequence
+
+import torch
+from transformers import Trainer
+
+logger = logging.getLogger(__name__)
+
+IGNORE_INDEX = -100
+
+
+class BatchStats:
+    """Running totals of real vs emitted tokens.
+
+    By default a batch counts as soon as it is collated. With `deferred=True`
+    (set by `BatchingTrainer`) collated batches wait in a FIFO until `consume()`
+    is called as each one is trained on, so batches the dataloader fetched
+    ahead are not counted yet.
+    """
+
+    def __init__(self, deferred: bool = False):
+        self.deferred = deferred
+        self.batches = 0
+        self.examples = 0
+        self.rows = 0
+        self.real_tokens = 0
+        self.total_tokens = 0
+        self._pending = deque()
+
+    def record(self, examples: int, rows: int, real_tokens: int, total_tokens: int) -> None:
+        if self.deferred:
+            self._pending.append((examples, rows, real_tokens, total_tokens))
+        else:
+            self._add(examples, rows, real_tokens, total_tokens)
+
+    def consume(self) -> None:
+        """Count the oldest collated batch that has not been counted yet."""
+        if self._pending:
+            self._add(*self._pending.popleft())
+
+    def _add(self, examples: int, rows: int, real_tokens: int, total_tokens: int) -> None:
+        self.batches += 1
+        self.examples += examples
+        self.rows += rows
+        self.real_tokens += real_tokens
+        self.total_tokens += total_tokens
+
+    def snapshot(self) -> Dict[str, int]:
+        return {
+            "batches": self.batches,
+            "examples": self.examples,
+            "rows": self.rows,
+            "real_tokens": self.real_tokens,
+            "total_tokens": self.total_tokens,
+        }
+
+    def summary(self) -> Dict[str, Any]:
+        return dict(
+            self.snapshot(),
+            padding_efficiency=round(self.real_tokens / self.total_tokens, 4) if self.total_tokens else None,
+            tokens_per_batch=round(self.real_tokens / self.batches, 1) if self.batches else None,
+            examples_per_batch=round(self.examples / self.batches, 1) if self.batches else None,
+        )
+
+
+def pack_lengths(lengths: Sequence[int], max_seq_len: int) -> List[List[int]]:
+    """Group item indices into bins whose lengths sum to at most `max_seq_len` (first-fit decreasing)."""
+    bins: List[List[int]] = []
+    free: List[int] = []
+    for index in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+        length = lengths[index]
+        for b, space in enumerate(free):
+            if length <= space:
+                bins[b].append(index)
+                free[b] -= length
+                break
+        else:
+            bins.append([index])
+            free.append(max_seq_len - length)
+    return bins
+
+
+def _round_up(value: int, multiple: Optional[int]) -> int:
+    if not multiple:
+        return value
+    return -(-value // multiple) * multiple
+
+
+class PackingCollator:
+    """Packs a batch of tokenized examples into rows of up to `max_seq_len` tokens.
+
+    The batch carries a [batch, 1, seq, seq] block-diagonal causal attention
+    mask in `mask_dtype` (use the model's compute dtype).
+    """
+
+    def __init__(
+        self,
+        tokenizer,
+        max_seq_len: int = 1024,
+        mask_dtype: torch.dtype = torch.float32,
+        pad_to_multiple_of: Optional[int] = 8,
+        stats: Optional[BatchStats] = None,
+    ):
+        self.pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+        self.max_seq_len = max_seq_len
+        self.mask_dtype = mask_dtype
+        self.pad_to_multiple_of = pad_to_multiple_of
+        self.stats = stats or BatchStats()
+
+    def __call__(self, features: List[Dict[str, Any]]) -> Dict[str, torch.Tensor]:
+        sequences = [list(f["input_ids"])[:self.max_seq_len] for f in features]
+        bins = pack_lengths([len(s) for s in sequences], self.max_seq_len)
+        row_len = min(_round_up(max(sum(len(sequences[i]) for i in b) for b in bins), self.pad_to_multiple_of),
+                      _round_up(self.max_seq_len, self.pad_to_multiple_of))
+
+        input_ids = torch.full((len(bins), row_len), self.pad_token_id, dtype=torch.long)
+        labels = torch.full((len(bins), row_len), IGNORE_INDEX, dtype=torch.long)
+        position_ids = torch.zeros((len(bins), row_len), dtype=torch.long)
+        # Sequence number of every token in its row; -1 marks padding
+        segments = torch.full((len(bins), row_len), -1, dtype=torch.long)
+
+        real_tokens = 0
+        for row, members in enumerate(bins):
+            offset = 0
+            for segment, index in enumerate(members):
+                tokens = sequences[index]
+                end = offset + len(tokens)
+                input_ids[row, offset:end] = torch.tensor(tokens, dtype=torch.long)
+                labels[row, offset:end] = input_ids[row, offset:end]
+                # Nothing may be trained to predict an example's first token from the previous example
+                labels[row, offset] = IGNORE_INDEX
+                position_ids[row, offset:end] = torch.arange(len(tokens))
+                segments[row, offset:end] = segment
+                offset = end
+                real_tokens += len(tokens)
+            # Padding counts up from 0 as one more sequence
+            position_ids[row, offset:] = torch.arange(row_len - offset)
+
+        self.stats.record(len(features), len(bins), real_tokens, len(bins) * row_len)
+        return {
+            "input_ids": input_ids,
+            "labels": labels,
+            "position_ids": position_ids,
+            "attention_mask": self._block_causal_mask(segments),
+        }
+
+    def _block_causal_mask(self, segments: torch.Tensor) -> torch.Tensor:
+        row_len = segments.shape[1]
+        same_segment = segments[:, :, None] == segments[:, None, :]
+        causal = torch.tril(torch.ones(row_len, row_len, dtype=torch.bool))
+        # Padding attends to itself only, which keeps its softmax finite
+        allowed = (same_segment & causal & (segments[:, :, None] >= 0)) | torch.eye(row_len, dtype=torch.bool)
+        mask = torch.zeros(allowed.shape, dtype=self.mask_dtype)
+        return mask.masked_fill(~allowed, torch.finfo(self.mask_dtype).min)[:, None]
+
+
+class PaddingCollator:
+    """Pads a batch to its longest example; labels are masked on padding."""
+
+    def __init__(self, tokenizer, max_seq_len: Optional[int] = None, pad_to_multiple_of: Optional[int] = 8,
+                 stats: Optional[BatchStats] = None):
+        self.pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+        self.max_seq_len = max_seq_len
+        self.pad_to_multiple_of = pad_to_multiple_of
+        self.stats = stats or BatchStats()
+
+    def __call__(self, features: List[Dict[str, Any]]) -> Dict[str, torch.Tensor]:
+        sequences = [list(f["input_ids"])[:self.max_seq_len] if self.max_seq_len else list(f["input_ids"]) for f in features]
+        row_len = _round_up(max(len(s) for s in sequences), self.pad_to_multiple_of)
+        input_ids = torch.full((len(sequences), row_len), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(sequences), row_len), dtype=torch.long)
+        for row, tokens in enumerate(sequences):
+            input_ids[row, :len(tokens)] = torch.tensor(tokens, dtype=torch.long)
+            attention_mask[row, :len(tokens)] = 1
+        labels = input_ids.masked_fill(attention_mask == 0, IGNORE_INDEX)
+        real_tokens = int(attention_mask.sum())
+        self.stats.record(len(sequences), len(sequences), real_tokens, input_ids.numel())
+        return {"input_ids": input_ids, "attention_mask": attention_mask, "labels": labels}
+
+
+class LengthBucketBatchSampler(torch.utils.data.Sampler):
+    """Batches of similar-length examples whose padded size stays within `max_tokens`.
+
+    Examples are sorted by length once (ties broken randomly), cut into
+    batches greedily, and the batch order is reshuffled every epoch, so the
+    number of batches is fixed and the Trainer can size its schedule from it.
+    """
+
+    def __init__(self, lengths: Sequence[int], max_tokens: int, max_batch_size: Optional[int] = None,
+                 shuffle: bool = True, seed: int = 0, pad_to_multiple_of: Optional[int] = 8):
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        rng = random.Random(seed)
+        order = sorted(range(len(lengths)), key=lambda i: (lengths[i], rng.random()))
+        self.batches: List[List[int]] = []
+        batch: List[int] = []
+        for index in order:
+            # Sorted ascending, so this example is the longest in the batch
+            padded = _round_up(lengths[index], pad_to_multiple_of)
+            full = max_batch_size is not None and len(batch) >= max_batch_size
+            if batch and (full or padded * (len(batch) + 1) > max_tokens):
+                self.batches.append(batch)
+                batch = []
+            batch.append(index)
+        if batch:
+            self.batches.append(batch)
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def __len__(self) -> int:
+        return len(self.batches)
+
+    def __iter__(self):
+        order = list(range(len(self.batches)))
+        if self.shuffle:
+            random.Random(self.seed + self.epoch).shuffle(order)
+        self.epoch += 1
+        for b in order:
+            yield self.batches[b]
+
+
+class BatchingTrainer(Trainer):
+    """Trainer that can draw batches from a batch sampler and logs padding efficiency and tokens per step."""
+
+    def __init__(self, *args, batch_sampler=None, batch_stats: Optional[BatchStats] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.batch_sampler = batch_sampler
+        self.batch_stats = batch_stats
+        if batch_stats is not None:
+            # The dataloader collates ahead of training; count batches as training_step receives them
+            batch_stats.deferred = True
+        self._last_stats = batch_stats.snapshot() if batch_stats is not None else None
+        self._last_step = 0
+
+    def get_train_dataloader(self):
+        if self.batch_sampler is None:
+            return super().get_train_dataloader()
+        dataloader = torch.utils.data.DataLoader(
+            self.train_dataset,
+            batch_sampler=self.batch_sampler,
+            collate_fn=self.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+        )
+        return self.accelerator.prepare(dataloader)
+
+    def training_step(self, *args, **kwargs):
+        if self.batch_stats is not None:
+            self.batch_stats.consume()
+        return super().training_step(*args, **kwargs)
+
+    def log(self, logs: Dict[str, float], *args, **kwargs) -> None:
+        if self.batch_stats is not None:
+            # Deltas since the previous log, so every entry describes its own logging window
+            current = self.batch_stats.snapshot()
+            steps = self.state.global_step - self._last_step
+            real = current["real_tokens"] - self._last_stats["real_tokens"]
+            total = current["total_tokens"] - self._last_stats["total_tokens"]
+            if total:
+                logs["padding_efficiency"] = round(real / total, 4)
+            if steps > 0:
+                logs["tokens_per_step"] = round(real / steps, 1)
+                logs["examples_per_step"] = round((current["examples"] - self._last_stats["examples"]) / steps, 1)
+            self._last_stats = current
+            self._last_step = self.state.global_step
+        super().log(logs, *args, **kwargs)
@@ -0,0 +1,188 @@
+"""Reuse of prefilled key/value caches for shared prompt prefixes.
+
+Every Llama-2 prompt built by `build_prompt()` starts with the same
+`<s>[INST] <<SYS>>` header, and the settings block that follows is often
+repeated across requests. `PrefixCache` tokenizes the full prompt once, cuts it
+at configurable marker strings (the end of the header and the end of the
+system block by default), and keeps the model's past key/values for each of
+those token prefixes in a bounded LRU cache. Generation then starts from the
+longest cached prefix, so prefill only runs over the part of the prompt that
+has not been seen before.
+
+Prefix boundaries are taken from the offsets of the full prompt's tokens, so a
+cached prefix is always exactly the first tokens of the prompt as the
+tokenizer would split it, never a separately tokenized fragment.
+"""
+import copy
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Where Llama-2 prompts from build_prompt() stop being shared: after the fixed
+# header, and after the whole system block (settings repeat across requests)
+LLAMA2_PREFIX_MARKERS = (
+    "with the following settings:\n\n",
+    "<</SYS>>\n\n",
+)
+
+
+def cache_nbytes(past_key_values) -> int:
+    """Total size of the key/value tensors held by a transformers cache."""
+    layers = getattr(past_key_values, "layers", None)
+    if layers is not None:
+        tensors = [t for layer in layers for t in (getattr(layer, "keys", None), getattr(layer, "values", None))]
+    elif hasattr(past_key_values, "key_cache"):
+        tensors = list(past_key_values.key_cache) + list(past_key_values.value_cache)
+    else:
+        tensors = [t for layer in past_key_values for t in layer]
+    return sum(t.element_size() * t.nelement() for t in tensors if t is not None)
+
+
+class PrefixCache:
+    """LRU cache of prefilled past key/values keyed by token-id prefix."""
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        markers: Sequence[str] = LLAMA2_PREFIX_MARKERS,
+        max_entries: int = 16,
+        max_bytes: int = 2 * 1024 ** 3,
+        min_prefix_tokens: int = 8,
+    ):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.markers = tuple(markers)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.min_prefix_tokens = min_prefix_tokens
+        # token-id prefix -> (size_in_bytes, past_key_values)
+        self._entries: "OrderedDict[Tuple[int, ...], tuple]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.prefill_tokens_saved = 0
+        self.prefill_tokens_computed = 0
+
+    def prefix_lengths(self, prompt: str, offsets: List[Tuple[int, int]]) -> List[int]:
+        """Token counts of the prompt prefixes ending at each marker, ascending."""
+        lengths = set()
+        for marker in self.markers:
+            position = prompt.find(marker)
+            if position < 0:
+                continue
+            end = position + len(marker)
+            count = 0
+            while count < len(offsets) and offsets[count][1] <= end:
+                count += 1
+            # Leave at least one token for generate() to run the model on
+            if self.min_prefix_tokens <= count < len(offsets):
+                lengths.add(count)
+        return sorted(lengths)
+
+    def _lookup(self, key: Tuple[int, ...]):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def _put(self, key: Tuple[int, ...], past_key_values) -> None:
+        size = cache_nbytes(past_key_values)
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._bytes -= self._entries.pop(key)[0]
+        self._entries[key] = (size, past_key_values)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            _, (evicted_size, _) = self._entries.popitem(last=False)
+            self._bytes -= evicted_size
+            self.evictions += 1
+
+    def prefill(self, input_ids: List[int], boundaries: List[int]):
+        """Return (past_key_values, prefix_length) for the longest boundary prefix, filling the cache as needed."""
+        import torch
+
+        if not boundaries:
+            return None, 0
+
+        # Longest prefix already cached
+        start, state = 0, None
+        for length in reversed(boundaries):
+            cached = self._lookup(tuple(input_ids[:length]))
+            if cached is not None:
+                start, state = length, copy.deepcopy(cached)
+                break
+
+        if start:
+            self.hits += 1
+            self.prefill_tokens_saved += start
+        else:
+            self.misses += 1
+
+        # Prefill the remaining boundary segments one after another, caching each prefix
+        with torch.inference_mode():
+            for length in boundaries:
+                if length <= start:
+                    continue
+                chunk = torch.tensor([input_ids[start:length]], device=self.model.device)
+                state = self.model(input_ids=chunk, past_key_values=state, use_cache=True).past_key_values
+                self.prefill_tokens_computed += length - start
+                self._put(tuple(input_ids[:length]), copy.deepcopy(state))
+                start = length
+        return state, start
+
+    def generate(self, prompt: str, num_return_sequences: int = 1, **generate_kwargs) -> List[str]:
+        """Sample `num_return_sequences` continuations of `prompt`, starting from the cached prefix state."""
+        import torch
+
+        start_time = time.time()
+        encoded = self.tokenizer(prompt, return_offsets_mapping=True)
+        input_ids = list(encoded["input_ids"])
+        hits_before = self.hits
+        state, prefix_length = self.prefill(input_ids, self.prefix_lengths(prompt, encoded["offset_mapping"]))
+
+        input_tensor = torch.tensor([input_ids] * num_return_sequences, device=self.model.device)
+        if state is not None and num_return_sequences > 1:
+            state.batch_repeat_interleave(num_return_sequences)
+
+        with torch.inference_mode():
+            sequences = self.model.generate(
+                input_ids=input_tensor,
+                attention_mask=torch.ones_like(input_tensor),
+                past_key_values=state,
+                **generate_kwargs
+            )
+        self.prefill_tokens_computed += len(input_ids) - prefix_length
+
+        logger.info(
+            f"Prefix cache {'hit' if self.hits > hits_before else 'miss'}: decoding from "
+            f"{prefix_length}/{len(input_ids)} prefilled prompt tokens ({time.time() - start_time:.2f}s total)"
+        )
+        return self.tokenizer.batch_decode(sequences[:, len(input_ids):], skip_special_tokens=True)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        total = self.prefill_tokens_saved + self.prefill_tokens_computed
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "prefill_tokens_saved": self.prefill_tokens_saved,
+            "prefill_tokens_computed": self.prefill_tokens_computed,
+            "prefill_saved_fraction": self.prefill_tokens_saved / total if total else 0.0,
+        }
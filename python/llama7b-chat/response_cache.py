@@ -0,0 +1,138 @@
+"""Exact-match cache for Ollama generations.
+
+Entries are keyed on the fully built prompt plus the model and the sampling
+options that change the output. The cache is bounded both by entry count and
+by the total size of the cached text, evicts least recently used entries first
+and expires entries after a per-entry TTL. It is opt-in: `cache_from_env()`
+returns None unless RESPONSE_CACHE_ENABLED is set.
+"""
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Ollama options that influence the generated text and therefore the cache key
+KEY_OPTIONS = ("temperature", "top_p", "top_k", "num_predict", "repeat_penalty", "seed")
+
+
+def _env_flag(name: str, default: str = "0") -> bool:
+    return os.environ.get(name, default).strip().lower() in ("1", "true", "yes", "on")
+
+
+class ResponseCache:
+    """LRU + TTL cache mapping (model, prompt, options) to generated text."""
+
+    def __init__(
+        self,
+        max_entries: int = 256,
+        max_bytes: int = 16 * 1024 * 1024,
+        ttl_seconds: float = 3600.0,
+        deterministic_only: bool = False,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.deterministic_only = deterministic_only
+        # key -> (expires_at, size_in_bytes, value)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.skipped = 0
+
+    @staticmethod
+    def make_key(prompt: str, model: str, options: Optional[Dict[str, Any]] = None) -> str:
+        """Hash the prompt, model and output-affecting options into a cache key."""
+        options = options or {}
+        material = {
+            "model": model,
+            "prompt": prompt,
+            "options": {name: options.get(name) for name in KEY_OPTIONS},
+        }
+        encoded = json.dumps(material, sort_keys=True, ensure_ascii=False).encode("utf-8")
+        return hashlib.sha256(encoded).hexdigest()
+
+    def is_cacheable(self, options: Optional[Dict[str, Any]] = None) -> bool:
+        """A request is cacheable unless deterministic_only is set and it has no fixed seed."""
+        if not self.deterministic_only:
+            return True
+        seed = (options or {}).get("seed", -1)
+        return seed is not None and seed != -1
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, size, value = entry
+        if expires_at <= time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: str, value: str, ttl_seconds: Optional[float] = None) -> None:
+        size = len(value.encode("utf-8"))
+        if size > self.max_bytes:
+            # A single oversized response would flush the whole cache; just skip it
+            self.skipped += 1
+            logger.debug(f"Response of {size} bytes exceeds cache limit, not caching")
+            return
+        if key in self._entries:
+            self._remove(key)
+        ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        self._entries[key] = (time.monotonic() + ttl, size, value)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key: str) -> None:
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl_seconds,
+            "deterministic_only": self.deterministic_only,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "skipped": self.skipped,
+        }
+
+
+def cache_from_env() -> Optional[ResponseCache]:
+    """Build the cache from RESPONSE_CACHE_* environment variables, or None if disabled."""
+    if not _env_flag("RESPONSE_CACHE_ENABLED"):
+        return None
+    cache = ResponseCache(
+        max_entries=int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", "256")),
+        max_bytes=int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", str(16 * 1024 * 1024))),
+        ttl_seconds=float(os.environ.get("RESPONSE_CACHE_TTL", "3600")),
+        deterministic_only=_env_flag("RESPONSE_CACHE_DETERMINISTIC_ONLY"),
+    )
+    logger.info(f"Response cache enabled: {cache.stats()}")
+    return cache
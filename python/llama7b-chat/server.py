@@ -1,16 +1,24 @@
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, Response
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
 from typing import Optional, List
+import asyncio
 import logging
 import sys
 import traceback
 from datetime import datetime
 import time
 import json
-import subprocess
 import os
+import base64
+
+from ollama_client import OllamaClient, OllamaError, attach_to_app
+from image_worker import ImageWorker, ImageWorkerError, attach_to_app as attach_image_worker
+from image_store import ImageStore
+from image_jobs import ImageJob, ImageJobManager, JobQueueFullError, attach_to_app as attach_image_jobs
+from response_cache import ResponseCache, cache_from_env
+from single_flight import SingleFlight
 
 # Configure logging with detailed format
 logging.basicConfig(
@@ -26,6 +34,43 @@ logger = logging.getLogger(__name__)
 
 app = FastAPI()
 
+# Shared Ollama connection pool, opened on startup and closed on shutdown
+ollama = attach_to_app(app, OllamaClient())
+
+OLLAMA_MODEL = "llama2"
+OLLAMA_OPTIONS = {
+    "temperature": 0.85,
+    "top_p": 0.95,
+    "top_k": 40,
+    "num_predict": 512,
+    "repeat_penalty": 1.15,
+    "seed": -1
+}
+
+# Resident Stable Diffusion worker, configured through IMAGE_WORKER_* variables
+image_worker = attach_image_worker(app, ImageWorker.from_env())
+
+# Content-addressed store of seeded images (IMAGE_STORE_*), None when disabled
+image_store = ImageStore.from_env()
+
+
+@app.on_event("shutdown")
+async def _flush_image_store():
+    # Lookups batch their access times in memory; persist them for LRU eviction
+    if image_store is not None:
+        await asyncio.get_running_loop().run_in_executor(None, image_store.flush)
+
+# Opt-in exact-match cache (RESPONSE_CACHE_ENABLED=1), None when disabled
+response_cache = cache_from_env()
+
+# Identical concurrent generations share one upstream Ollama call
+single_flight = SingleFlight()
+
+STREAM_MEDIA_TYPES = {
+    "sse": "text/event-stream",
+    "ndjson": "application/x-ndjson"
+}
+
 # Configure CORS
 app.add_middleware(
     CORSMiddleware,
@@ -46,6 +91,8 @@ class ImageGenerationRequest(BaseModel):
     guidance_scale: float = 7.5
     height: int = 768
     width: int = 512
+    output_format: str = "png"
+    seed: Optional[int] = None
 
 def build_prompt(system_msg: str, user_prompt: str) -> str:
     """Build the prompt in Llama 2 chat format"""
@@ -108,50 +155,32 @@ def build_prompt(system_msg: str, user_prompt: str) -> str:
         logger.error(f"Error building prompt: {str(e)}")
         raise HTTPException(status_code=400, detail="Failed to build prompt")
 
-def call_ollama(prompt: str) -> str:
-    """Call Ollama API using curl command"""
+async def call_ollama(prompt: str) -> str:
+    """Call Ollama API through the pooled async client"""
     try:
-        logger.info("Preparing to call Ollama API")
-        # Prepare the curl command
-        curl_command = [
-            "curl",
-            "-X",
-            "POST",
-            "http://localhost:11434/api/generate",
-            "-d",
-            json.dumps({
-                "model": "llama2",
-                "prompt": prompt,
-                "stream": False,
-                "options": {
-                    "temperature": 0.85,
-                    "top_p": 0.95,
-                    "top_k": 40,
-                    "num_predict": 512,
-                    "repeat_penalty": 1.15,
-                    "seed": -1
-                }
-            })
-        ]
-
-        logger.debug(f"Executing curl command: {' '.join(curl_command)}")
-        # Execute the command
-        result = subprocess.run(curl_command, capture_output=True, text=True)
-
-        if result.returncode != 0:
-            error_msg = f"Ollama API error: {result.stderr}"
-            logger.error(error_msg)
-            raise HTTPException(status_code=500, detail=error_msg)
+        request_key = ResponseCache.make_key(prompt, OLLAMA_MODEL, OLLAMA_OPTIONS)
+        use_cache = response_cache is not None and response_cache.is_cacheable(OLLAMA_OPTIONS)
+        if use_cache:
+            cached = response_cache.get(request_key)
+            if cached is not None:
+                logger.info("Serving response from cache")
+                return cached
 
-        # Parse the response
-        response = json.loads(result.stdout)
+        logger.info("Preparing to call Ollama API")
+        response = await single_flight.do(
+            request_key,
+            lambda: ollama.generate(prompt, model=OLLAMA_MODEL, options=OLLAMA_OPTIONS)
+        )
         logger.info("Successfully received response from Ollama")
-        return response.get("response", "")
+        response_text = response.get("response", "")
+        if use_cache:
+            response_cache.put(request_key, response_text)
+        return response_text
 
-    except json.JSONDecodeError as e:
-        error_msg = f"Failed to parse Ollama response: {str(e)}"
+    except OllamaError as e:
+        error_msg = f"Ollama API error: {str(e)}"
         logger.error(error_msg)
-        raise HTTPException(status_code=500, detail=error_msg)
+        raise HTTPException(status_code=e.status_code, detail=error_msg)
     except Exception as e:
         error_msg = f"Error calling Ollama: {str(e)}"
         logger.error(f"{error_msg}\n{traceback.format_exc()}")
@@ -174,7 +203,7 @@ async def generate_content(request: GenerationRequest):
 
         # Generate response using Ollama
         logger.info("Starting text generation with Ollama...")
-        response_text = call_ollama(formatted_prompt)
+        response_text = await call_ollama(formatted_prompt)
         logger.info("Text generation completed")
 
         generation_time = time.time() - start_time
@@ -194,31 +223,156 @@ async def generate_content(request: GenerationRequest):
             }
         }
 
+    except HTTPException as he:
+        logger.error("="*50)
+        raise he
     except Exception as e:
         error_msg = f"Generation error: {str(e)}"
         logger.error(f"{error_msg}\n{traceback.format_exc()}")
         logger.error("="*50)
         raise HTTPException(status_code=500, detail=error_msg)
 
+def format_stream_frame(payload: dict, stream_format: str, event: Optional[str] = None) -> str:
+    """Serialize one stream frame as an SSE event or an NDJSON line"""
+    data = json.dumps(payload, ensure_ascii=False)
+    if stream_format == "sse":
+        prefix = f"event: {event}\n" if event else ""
+        return f"{prefix}data: {data}\n\n"
+    return data + "\n"
+
+async def cached_chunks(response_text: str):
+    """Replay a cached response as a single final Ollama-style stream chunk"""
+    yield {"response": response_text, "done": True, "cached": True}
+
+@app.post("/generate/stream")
+async def generate_content_stream(request: GenerationRequest, format: str = "sse"):
+    """Stream generated tokens as Server-Sent Events (format=sse) or NDJSON (format=ndjson)"""
+    if format not in STREAM_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"Unsupported stream format: {format}")
+
+    logger.info("="*50)
+    logger.info(f"Starting new streaming generation request ({format})")
+    logger.info(f"System message: {request.system_message}")
+    logger.info(f"User prompt: {request.prompt}")
+
+    start_time = time.time()
+    formatted_prompt = build_prompt(request.system_message, request.prompt)
+
+    cache_key = None
+    cached = None
+    if response_cache is not None and response_cache.is_cacheable(OLLAMA_OPTIONS):
+        cache_key = ResponseCache.make_key(formatted_prompt, OLLAMA_MODEL, OLLAMA_OPTIONS)
+        cached = response_cache.get(cache_key)
+
+    if cached is not None:
+        logger.info("Serving streamed response from cache")
+        chunks = cached_chunks(cached)
+    else:
+        chunks = ollama.generate_stream(formatted_prompt, model=OLLAMA_MODEL, options=OLLAMA_OPTIONS)
+
+    # Pull the first chunk before answering so connection errors still map to a proper status code
+    try:
+        first_chunk = await chunks.__anext__()
+    except StopAsyncIteration:
+        first_chunk = {"response": "", "done": True}
+    except OllamaError as e:
+        error_msg = f"Ollama API error: {str(e)}"
+        logger.error(error_msg)
+        logger.error("="*50)
+        raise HTTPException(status_code=e.status_code, detail=error_msg)
+    time_to_first_token = time.time() - start_time
+    logger.info(f"First token received in {time_to_first_token:.3f} seconds")
+
+    async def frames():
+        parts = []
+        chunk = first_chunk
+        try:
+            while True:
+                token = chunk.get("response", "")
+                if token:
+                    parts.append(token)
+                    yield format_stream_frame({"token": token, "done": False}, format)
+                if chunk.get("done"):
+                    break
+                try:
+                    chunk = await chunks.__anext__()
+                except StopAsyncIteration:
+                    break
+        except OllamaError as e:
+            error_msg = f"Ollama API error: {str(e)}"
+            logger.error(error_msg)
+            logger.error("="*50)
+            yield format_stream_frame({"success": False, "error": error_msg, "done": True}, format, event="error")
+            return
+        finally:
+            # Release the pooled connection even if the client disconnects mid-stream
+            await chunks.aclose()
+
+        generation_time = time.time() - start_time
+        response_text = "".join(parts)
+        if cache_key is not None and not chunk.get("cached"):
+            response_cache.put(cache_key, response_text)
+        logger.info(f"Generated response: {response_text}")
+        logger.info(f"Streaming generation completed in {generation_time:.2f} seconds")
+        logger.info("="*50)
+
+        yield format_stream_frame({
+            "success": True,
+            "done": True,
+            "response": response_text,
+            "generation_time": f"{generation_time:.2f}s",
+            "logs": {
+                "generation_time": generation_time,
+                "time_to_first_token": time_to_first_token,
+                "eval_count": chunk.get("eval_count"),
+                "timestamp": datetime.now().isoformat()
+            }
+        }, format, event="done")
+
+    return StreamingResponse(
+        frames(),
+        media_type=STREAM_MEDIA_TYPES[format],
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/cache/stats")
+async def cache_stats():
+    """Response cache and request coalescing counters"""
+    return {
+        "response_cache": {"enabled": False} if response_cache is None else {"enabled": True, **response_cache.stats()},
+        "single_flight": single_flight.stats()
+    }
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
     try:
         # Check if Ollama is running and get version
-        result = subprocess.run(["curl", "http://localhost:11434/api/version"],
-                              capture_output=True, text=True)
-        ollama_status = result.returncode == 0
+        try:
+            ollama_version = await ollama.version()
+            ollama_status = True
+        except OllamaError as e:
+            logger.warning(f"Ollama health probe failed: {str(e)}")
+            ollama_version = None
+            ollama_status = False
+
+        store_stats = None
+        if image_store is not None:
+            # stats() may stat and re-read the index file; keep that off the event loop
+            store_stats = await asyncio.get_running_loop().run_in_executor(None, image_store.stats)
 
         health_status = {
             "status": "healthy" if ollama_status else "unhealthy",
             "ollama_running": ollama_status,
+            "image_worker": image_worker.stats(),
+            "image_jobs": image_jobs.stats(),
+            "image_store": store_stats,
             "timestamp": datetime.now().isoformat()
         }
 
         if ollama_status:
-            version_info = json.loads(result.stdout)
-            health_status["ollama_version"] = version_info.get("version", "unknown")
-            logger.info(f"Ollama version: {version_info.get('version')}")
+            health_status["ollama_version"] = ollama_version
+            logger.info(f"Ollama version: {ollama_version}")
 
         logger.info(f"Health check: {json.dumps(health_status, indent=2)}")
         return health_status
@@ -230,111 +384,152 @@ async def health_check():
             "timestamp": datetime.now().isoformat()
         }
 
-@app.post("/generate-image")
-async def generate_image(request: ImageGenerationRequest):
-    """Generate an image using the Stable Diffusion model"""
-    try:
-        logger.info("="*50)
-        logger.info("Starting image generation request")
-        logger.info(f"Prompt: {request.prompt}")
-        logger.info(f"Parameters: steps={request.num_steps}, guidance={request.guidance_scale}, size={request.height}x{request.width}")
-
-        # Get absolute paths
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        script_path = os.path.abspath(os.path.join(current_dir, "..", "image-generation", "generate-stable-fusion.py"))
-        output_dir = os.path.abspath(os.path.join(current_dir, "..", "image-generation", "outputs", "generated_images"))
-
-        # Verify script exists
-        if not os.path.exists(script_path):
-            error_msg = f"Image generation script not found at: {script_path}"
-            logger.error(error_msg)
-            raise HTTPException(status_code=500, detail=error_msg)
-
-        # Ensure output directory exists
-        os.makedirs(output_dir, exist_ok=True)
-
-        # Generate a unique filename
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        output_file = os.path.abspath(os.path.join(output_dir, f"generated_{timestamp}.png"))
-
-        logger.info(f"Script path: {script_path}")
-        logger.info(f"Output file: {output_file}")
-
-        # Build the command with all parameters
-        command = [
-            sys.executable,
-            script_path,
-            "--single_image",
-            "--prompt", request.prompt,
-            "--negative_prompt", request.negative_prompt,
-            "--num_steps", str(request.num_steps),
-            "--guidance_scale", str(request.guidance_scale),
-            "--height", str(request.height),
-            "--width", str(request.width),
-            "--output_file", output_file,
-            "--return_base64"  # Request base64 output
-        ]
-
-        # Execute the command
-        start_time = time.time()
-        logger.info(f"Executing command: {' '.join(command)}")
-
-        try:
-            result = subprocess.run(
-                command,
-                capture_output=True,
-                text=True,
-                check=True
+IMAGE_MEDIA_TYPES = {
+    "png": "image/png",
+    "webp": "image/webp"
+}
+
+def image_batch_key(job: ImageJob) -> tuple:
+    """Jobs can share a pipeline call when resolution, steps and guidance match"""
+    request = job.request
+    return (request.height, request.width, request.num_steps, request.guidance_scale)
+
+async def run_image_batch(jobs: List[ImageJob], on_progress) -> List[dict]:
+    """Run a batch of compatible image jobs on the resident worker and return one reply per job"""
+    first = jobs[0].request
+    logger.info("="*50)
+    logger.info(f"Starting image generation batch of {len(jobs)}: {', '.join(job.id for job in jobs)}")
+    for job in jobs:
+        logger.info(f"Prompt [{job.id}]: {job.request.prompt}")
+    logger.info(f"Parameters: steps={first.num_steps}, guidance={first.guidance_scale}, size={first.height}x{first.width}")
+
+    # Get absolute paths
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    output_dir = os.path.abspath(os.path.join(current_dir, "..", "image-generation", "outputs", "generated_images"))
+
+    # Ensure output directory exists
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Generate unique filenames; jobs in one batch share the timestamp
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    worker_jobs = []
+    for job in jobs:
+        request = job.request
+        if image_store is not None and request.seed is not None:
+            # Seeded images are written into the image store once they come back
+            output_file = None
+        else:
+            output_file = os.path.abspath(os.path.join(output_dir, f"generated_{timestamp}_{job.id[:8]}.{request.output_format}"))
+            logger.info(f"Output file [{job.id}]: {output_file}")
+        worker_jobs.append({
+            "prompt": request.prompt,
+            "negative_prompt": request.negative_prompt,
+            "seed": request.seed,
+            "output_file": output_file,
+            "image_format": request.output_format
+        })
+
+    # Submit the batch to the resident worker
+    start_time = time.time()
+    results = await image_worker.generate_batch(
+        worker_jobs,
+        on_progress=on_progress,
+        num_steps=first.num_steps,
+        guidance_scale=first.guidance_scale,
+        height=first.height,
+        width=first.width
+    )
+
+    generation_time = time.time() - start_time
+    logger.info(f"Image batch completed in {generation_time:.2f}s")
+
+    if len(results) != len(jobs) or not all(result.get("image_bytes") for result in results):
+        raise ImageWorkerError("Image data not found in worker reply")
+
+    loop = asyncio.get_running_loop()
+    for job, result in zip(jobs, results):
+        logger.info(f"Received {len(result['image_bytes'])} bytes of {result['format']} data (seed {result['seed']})")
+        result["generation_time"] = generation_time
+        result["cached"] = False
+        key = image_store_key(job.request)
+        if key is not None:
+            result["output_file"] = await loop.run_in_executor(
+                None, image_store.put, key, result["image_bytes"], result["format"], {"prompt": job.request.prompt}
             )
-        except subprocess.CalledProcessError as e:
-            error_msg = f"Command failed with return code {e.returncode}"
-            logger.error(f"{error_msg}\nCommand output: {e.stdout}\nCommand error: {e.stderr}")
-            raise HTTPException(status_code=500, detail=error_msg)
-
-        if result.returncode != 0:
-            error_msg = f"Command failed with return code {result.returncode}"
-            logger.error(f"{error_msg}\nCommand output: {result.stdout}\nCommand error: {result.stderr}")
-            raise HTTPException(status_code=500, detail=error_msg)
-
-        generation_time = time.time() - start_time
-        logger.info(f"Image generation process completed in {generation_time:.2f}s")
-
-        # Log the full output for debugging
-        logger.debug(f"Full command output:\n{result.stdout}")
-
-        # Extract base64 from output
-        base64_image = None
-        for line in result.stdout.split('\n'):
-            if line.startswith('BASE64:'):
-                base64_image = line[7:]  # Remove 'BASE64:' prefix
-                logger.info("Found base64 data in output")
-                break
-
-        if not base64_image:
-            error_msg = "Base64 image data not found in output"
-            logger.error(f"{error_msg}\nFull output:\n{result.stdout}")
-            raise HTTPException(status_code=500, detail=error_msg)
-
-        # Verify the base64 data is valid
-        try:
-            import base64
-            # Try to decode the base64 string to verify it's valid
-            decoded_data = base64.b64decode(base64_image)
-            logger.info(f"Base64 data validation successful. Decoded size: {len(decoded_data)} bytes")
-        except Exception as e:
-            error_msg = f"Invalid base64 data: {str(e)}"
-            logger.error(error_msg)
-            raise HTTPException(status_code=500, detail=error_msg)
+            logger.info(f"Stored image {key} at {result['output_file']}")
+    logger.info("="*50)
+    return results
+
+# Every image request, synchronous or not, goes through one job queue that batches compatible jobs
+image_jobs = attach_image_jobs(app, ImageJobManager(run_image_batch, batch_key=image_batch_key))
+
+def image_store_key(request: ImageGenerationRequest) -> Optional[str]:
+    """Store key of a seeded request, or None if it can't be cached (no seed, store disabled, worker not up yet)"""
+    info = image_worker.pipeline_info
+    if image_store is None or request.seed is None or info is None:
+        return None
+    return ImageStore.make_key(
+        model_id=info["model_id"],
+        scheduler=info.get("scheduler") or "",
+        prompt=request.prompt,
+        negative_prompt=request.negative_prompt,
+        num_steps=request.num_steps,
+        guidance_scale=request.guidance_scale,
+        height=request.height,
+        width=request.width,
+        seed=request.seed,
+        image_format=request.output_format
+    )
+
+async def submit_image_job(request: ImageGenerationRequest) -> ImageJob:
+    """Validate an image request and serve it from the image store or queue it"""
+    if request.output_format not in IMAGE_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"Unsupported output format: {request.output_format}")
+
+    key = image_store_key(request)
+    if key is not None:
+        loop = asyncio.get_running_loop()
+        stored = await loop.run_in_executor(None, image_store.get, key)
+        if stored is not None:
+            logger.info(f"Image store hit for {key}, skipping the pipeline")
+            result = {
+                "image_bytes": stored["image_bytes"],
+                "output_file": stored["output_file"],
+                "format": stored["format"],
+                "seed": request.seed,
+                "generation_time": 0.0,
+                "cached": True
+            }
+            return image_jobs.add_finished(request, request.num_steps, result)
 
-        logger.info("Successfully extracted and validated base64 image data")
-        logger.info("="*50)
+    try:
+        return image_jobs.submit(request, request.num_steps)
+    except JobQueueFullError as e:
+        logger.warning(str(e))
+        raise HTTPException(status_code=503, detail=str(e))
+
+async def render_image(request: ImageGenerationRequest) -> dict:
+    """Queue an image job and wait for its result"""
+    job = await image_jobs.wait(await submit_image_job(request))
+    if job.status == "failed":
+        error_msg = f"Image worker error: {job.error}"
+        logger.error(error_msg)
+        raise HTTPException(status_code=500, detail=error_msg)
+    return job.result
 
+@app.post("/generate-image")
+async def generate_image(request: ImageGenerationRequest):
+    """Generate an image and return it base64-encoded inside JSON (compatibility mode)"""
+    try:
+        result = await render_image(request)
         return {
             "success": True,
-            "image_base64": base64_image,
-            "generation_time": f"{generation_time:.2f}s",
+            "image_base64": base64.b64encode(result["image_bytes"]).decode("ascii"),
+            "generation_time": f"{result['generation_time']:.2f}s",
             "image_size": f"{request.height}x{request.width}",
-            "file_path": output_file
+            "file_path": result.get("output_file"),
+            "seed": result.get("seed"),
+            "cached": result.get("cached", False)
         }
 
     except HTTPException as he:
@@ -345,6 +540,103 @@ async def generate_image(request: ImageGenerationRequest):
         logger.error("="*50)
         raise HTTPException(status_code=500, detail=error_msg)
 
+@app.post("/generate-image/raw")
+async def generate_image_raw(request: ImageGenerationRequest):
+    """Generate an image and return the encoded bytes directly (image/png or image/webp)"""
+    try:
+        result = await render_image(request)
+        return Response(
+            content=result["image_bytes"],
+            media_type=IMAGE_MEDIA_TYPES[request.output_format],
+            headers={
+                "X-Generation-Time": f"{result['generation_time']:.2f}s",
+                "X-Image-Size": f"{request.height}x{request.width}",
+                "X-Image-Seed": str(result.get("seed")),
+                "X-Image-Cache": "hit" if result.get("cached") else "miss"
+            }
+        )
+
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        error_msg = f"Image generation error: {str(e)}"
+        logger.error(f"{error_msg}\n{traceback.format_exc()}")
+        logger.error("="*50)
+        raise HTTPException(status_code=500, detail=error_msg)
+
+def get_image_job(job_id: str) -> ImageJob:
+    job = image_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown or expired image job: {job_id}")
+    return job
+
+@app.post("/image-jobs", status_code=202)
+async def submit_image_job_endpoint(request: ImageGenerationRequest):
+    """Queue an image generation job and return its id immediately"""
+    job = await submit_image_job(request)
+    return {
+        **image_jobs.status(job),
+        "status_url": f"/image-jobs/{job.id}",
+        "result_url": f"/image-jobs/{job.id}/result",
+        "events_url": f"/image-jobs/{job.id}/events"
+    }
+
+@app.get("/image-jobs/stats")
+async def image_job_stats():
+    """Batch-size histogram and per-request queue wait / latency, for tuning IMAGE_BATCH_WINDOW_MS"""
+    return image_jobs.stats()
+
+@app.get("/image-jobs/{job_id}")
+async def image_job_status(job_id: str):
+    """Queue position, current denoising step and ETA of a job"""
+    return image_jobs.status(get_image_job(job_id))
+
+@app.get("/image-jobs/{job_id}/result")
+async def image_job_result(job_id: str, format: str = "raw"):
+    """Finished image as raw bytes (format=raw) or base64 JSON (format=json); 202 while pending"""
+    job = get_image_job(job_id)
+    if not job.finished:
+        return JSONResponse(status_code=202, content=image_jobs.status(job))
+    if job.status == "failed":
+        raise HTTPException(status_code=500, detail=f"Image worker error: {job.error}")
+
+    request = job.request
+    if format == "json":
+        return {
+            "success": True,
+            "image_base64": base64.b64encode(job.result["image_bytes"]).decode("ascii"),
+            "generation_time": f"{job.result['generation_time']:.2f}s",
+            "image_size": f"{request.height}x{request.width}",
+            "file_path": job.result.get("output_file"),
+            "seed": job.result.get("seed"),
+            "cached": job.result.get("cached", False)
+        }
+    return Response(
+        content=job.result["image_bytes"],
+        media_type=IMAGE_MEDIA_TYPES[request.output_format],
+        headers={
+            "X-Generation-Time": f"{job.result['generation_time']:.2f}s",
+            "X-Image-Seed": str(job.result.get("seed")),
+            "X-Image-Cache": "hit" if job.result.get("cached") else "miss"
+        }
+    )
+
+@app.get("/image-jobs/{job_id}/events")
+async def image_job_events(job_id: str):
+    """Server-Sent Events stream of job status updates until the job finishes"""
+    job = get_image_job(job_id)
+
+    async def frames():
+        async for status in image_jobs.events(job):
+            event = "done" if status["status"] in ("done", "failed") else "progress"
+            yield format_stream_frame(status, "sse", event=event)
+
+    return StreamingResponse(
+        frames(),
+        media_type=STREAM_MEDIA_TYPES["sse"],
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 if __name__ == "__main__":
     import uvicorn
     logger.info("Starting Llama server on port 1025")
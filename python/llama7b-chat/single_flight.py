@@ -0,0 +1,69 @@
+"""Coalesce identical concurrent async calls into a single upstream call.
+
+The first caller for a key (the leader) starts the upstream call as a task;
+callers that arrive with the same key while it is running await that same
+task instead of starting their own. Every waiter receives the leader's result
+or its exception. A waiter that is cancelled (for example because its client
+disconnected) only stops waiting; the upstream call is cancelled once no
+waiters are left.
+"""
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    """Per-key deduplication of in-flight coroutines."""
+
+    def __init__(self):
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._waiters: Dict[str, int] = {}
+        self.upstream_calls = 0
+        self.coalesced = 0
+        self.failures = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """Return fn()'s result, sharing one call among concurrent callers with the same key."""
+        task = self._inflight.get(key)
+        if task is None:
+            self.upstream_calls += 1
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            self._waiters[key] = 0
+            task.add_done_callback(lambda t, k=key: self._finish(k, t))
+        else:
+            self.coalesced += 1
+            logger.info(f"Joining in-flight request ({self._waiters[key]} already waiting)")
+
+        self._waiters[key] += 1
+        try:
+            # shield() keeps one waiter's cancellation from cancelling the shared task
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.done() and self._waiters.get(key) == 1 and self._inflight.get(key) is task:
+                logger.info("Last waiter cancelled, cancelling upstream call")
+                task.cancel()
+            raise
+        finally:
+            if key in self._waiters and self._inflight.get(key) is task:
+                self._waiters[key] -= 1
+
+    def _finish(self, key: str, task: asyncio.Task) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+            del self._waiters[key]
+        if task.cancelled():
+            return
+        # Mark the exception as retrieved even if every waiter has gone away
+        if task.exception() is not None:
+            self.failures += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": len(self._inflight),
+            "upstream_calls": self.upstream_calls,
+            "upstream_calls_saved": self.coalesced,
+            "failures": self.failures,
+        }
@@ -0,0 +1,72 @@
+"""Tiny random-weight Llama model and tokenizer for CPU testing.
+
+Nothing is downloaded: the tokenizer is a character-level vocabulary built
+with the `tokenizers` library and the model is a two-layer `LlamaForCausalLM`
+initialised from a small config. Generations are gibberish, but the model has
+the same architecture and special tokens as the Llama-2 checkpoints, so
+batching, caching, LoRA and training code can be exercised end to end without
+a GPU or network access.
+"""
+import string
+
+TINY_MODEL_NAME = "tiny-random-llama"
+
+
+def build_tiny_tokenizer():
+    """Character-level fast tokenizer with Llama-style <s>, </s>, <unk> and <pad> tokens."""
+    from tokenizers import Regex, Tokenizer, decoders, models, pre_tokenizers, processors
+    from transformers import PreTrainedTokenizerFast
+
+    specials = ["<unk>", "<s>", "</s>", "<pad>"]
+    vocab = {token: i for i, token in enumerate(specials)}
+    for char in string.printable:
+        vocab.setdefault(char, len(vocab))
+
+    backend = Tokenizer(models.WordLevel(vocab, unk_token="<unk>"))
+    backend.pre_tokenizer = pre_tokenizers.Split(Regex(r"[\s\S]"), behavior="isolated")
+    backend.decoder = decoders.Fuse()
+    backend.post_processor = processors.TemplateProcessing(
+        single="<s> $A",
+        pair="<s> $A <s> $B",
+        special_tokens=[("<s>", vocab["<s>"])],
+    )
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=backend,
+        bos_token="<s>",
+        eos_token="</s>",
+        unk_token="<unk>",
+        pad_token="<pad>",
+        model_max_length=2048,
+    )
+    tokenizer.name_or_path = TINY_MODEL_NAME
+    return tokenizer
+
+
+def build_tiny_llama(seed: int = 0, tokenizer=None, **config_overrides):
+    """Return a (model, tokenizer) pair small enough to run on CPU in milliseconds.
+
+    `config_overrides` replace LlamaConfig fields, e.g. a few more layers for benchmarks.
+    """
+    import torch
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    tokenizer = tokenizer or build_tiny_tokenizer()
+    torch.manual_seed(seed)
+    settings = dict(
+        vocab_size=len(tokenizer),
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=2048,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id,
+    )
+    settings.update(config_overrides)
+    config = LlamaConfig(**settings)
+    model = LlamaForCausalLM(config)
+    model.config._name_or_path = TINY_MODEL_NAME
+    model.eval()
+    return model, tokenizer
@@ -0,0 +1,300 @@
+"""CPU training throughput benchmark for the fine-tuning pipeline.
+
+Runs the same steps as `finetune.main()` (tokenize_dataset, apply_lora,
+build_batching, build_training_arguments and BatchingTrainer) against a small
+randomly initialised Llama model and the character-level test tokenizer from
+`tiny_llama.py`, for a fixed number of optimizer steps. It needs no GPU and no
+network, so a change to the collator, LoRA rank or target modules, gradient
+checkpointing or streaming ingestion can be measured on any machine:
+
+    python train_benchmark.py --output base.json
+    python train_benchmark.py --lora_r 16 --target_modules q_proj,k_proj,v_proj,o_proj --output wide.json
+    python train_benchmark.py --compare base.json wide.json
+    python train_benchmark.py --streaming --output streaming.json
+
+Results are written as JSON: samples/sec, tokens/sec, padding efficiency,
+step-time percentiles (after --warmup_steps), peak RSS and trainable
+parameter counts, together with the configuration and library versions.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Any, Dict, List
+
+# Log to stdout only; finetune.py skips its own logging setup (and finetune.log) when handlers exist
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    handlers=[logging.StreamHandler(sys.stdout)]
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DATA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "village_data.json")
+
+# Metric -> True when higher is better
+COMPARED_METRICS = {
+    "samples_per_sec": True,
+    "tokens_per_sec": True,
+    "padding_efficiency": True,
+    "step_time_p50": False,
+    "step_time_p90": False,
+    "step_time_p99": False,
+    "peak_rss_mb": False,
+    "trainable_params": None,
+}
+
+
+def _percentile(ordered: List[float], q: float) -> float:
+    return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 4)
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 ** 2 if sys.platform == "darwin" else 1024), 1)
+
+
+def make_step_timer():
+    from transformers import TrainerCallback
+
+    class StepTimer(TrainerCallback):
+        """Wall time of every optimizer step and the batch stats at each step boundary."""
+
+        def __init__(self):
+            self.durations: List[float] = []
+            self.marks: List[tuple] = []
+            self._start = None
+            self.batch_stats = None
+
+        def on_step_begin(self, args, state, control, **kwargs):
+            self._start = time.perf_counter()
+
+        def on_step_end(self, args, state, control, **kwargs):
+            now = time.perf_counter()
+            self.durations.append(now - self._start)
+            self.marks.append((now, self.batch_stats.snapshot()))
+
+    return StepTimer()
+
+
+def load_rows(data_file: str, rows: int):
+    """The first `rows` examples of `data_file`, cycled if the file is shorter."""
+    from datasets import load_dataset
+
+    dataset = load_dataset("json", data_files={"train": data_file}, split="train")
+    return dataset.select([i % len(dataset) for i in range(rows)])
+
+
+def run_benchmark(args) -> Dict[str, Any]:
+    import torch
+    import transformers
+    import peft
+    from transformers import set_seed
+
+    from finetune import apply_lora, build_batching, build_training_arguments, load_streaming_dataset, tokenize_dataset
+    from packing import BatchingTrainer
+    from tiny_llama import build_tiny_llama
+
+    torch.set_num_threads(args.threads)
+    set_seed(args.seed)
+
+    model, tokenizer = build_tiny_llama(
+        seed=args.seed,
+        hidden_size=args.hidden_size,
+        intermediate_size=args.intermediate_size,
+        num_hidden_layers=args.layers,
+        num_attention_heads=args.heads,
+        num_key_value_heads=args.kv_heads,
+    )
+    model.train()
+    total_params = sum(p.numel() for p in model.parameters())
+    model = apply_lora(
+        model,
+        r=args.lora_r,
+        target_modules=[m.strip() for m in args.target_modules.split(",") if m.strip()],
+        gradient_checkpointing=args.gradient_checkpointing
+    )
+    trainable_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        start = time.perf_counter()
+        dataset = load_rows(args.data_file, args.rows)
+        if args.streaming:
+            # Same rows as the in-memory run, read back lazily from a JSONL file; tokenization happens during training
+            data_file = os.path.join(output_dir, "rows.jsonl")
+            dataset.to_json(data_file, lines=True)
+            tokenized = load_streaming_dataset([data_file], tokenizer, max_length=args.max_length,
+                                               shuffle_buffer=args.shuffle_buffer, seed=args.seed)
+            tokenize_seconds = None
+        else:
+            tokenized = tokenize_dataset(dataset, tokenizer, max_length=args.max_length, num_proc=1, cache_dir=None)
+            tokenize_seconds = round(time.perf_counter() - start, 3)
+
+        data_collator, batch_sampler, batch_stats = build_batching(args, tokenizer, tokenized, mask_dtype=torch.float32)
+        timer = make_step_timer()
+        timer.batch_stats = batch_stats
+
+        training_args = build_training_arguments(
+            args,
+            output_dir,
+            logging_steps=max(1, args.max_steps),
+            fp16=False,
+            use_cpu=True,
+            report_to=[],
+            save_strategy="no",
+            gradient_checkpointing=args.gradient_checkpointing,
+            disable_tqdm=True
+        )
+        trainer = BatchingTrainer(
+            model=model,
+            args=training_args,
+            train_dataset=tokenized,
+            data_collator=data_collator,
+            batch_sampler=batch_sampler,
+            batch_stats=batch_stats,
+            callbacks=[timer]
+        )
+        train_start = time.perf_counter()
+        output = trainer.train()
+        train_seconds = time.perf_counter() - train_start
+
+    warmup = min(args.warmup_steps, len(timer.durations) - 1)
+    measured = sorted(timer.durations[warmup:])
+    # Throughput over the measured steps: from the end of the last warmup step to the end of the run
+    if warmup > 0:
+        window_start, stats_start = timer.marks[warmup - 1]
+    else:
+        window_start, stats_start = train_start, {"examples": 0, "real_tokens": 0, "total_tokens": 0}
+    window_end, stats_end = timer.marks[-1]
+    window = window_end - window_start
+    real_tokens = stats_end["real_tokens"] - stats_start["real_tokens"]
+    total_tokens = stats_end["total_tokens"] - stats_start["total_tokens"]
+    samples = stats_end["examples"] - stats_start["examples"]
+
+    return {
+        "created_at": datetime.now().isoformat(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("compare", "output")},
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "torch": torch.__version__,
+            "transformers": transformers.__version__,
+            "peft": peft.__version__,
+            "threads": torch.get_num_threads(),
+        },
+        "results": {
+            "steps": len(timer.durations),
+            "measured_steps": len(measured),
+            "samples_per_sec": round(samples / window, 2),
+            "tokens_per_sec": round(real_tokens / window, 1),
+            "padding_efficiency": round(real_tokens / total_tokens, 4) if total_tokens else None,
+            "step_time_mean": round(sum(measured) / len(measured), 4),
+            "step_time_p50": _percentile(measured, 0.50),
+            "step_time_p90": _percentile(measured, 0.90),
+            "step_time_p99": _percentile(measured, 0.99),
+            "step_time_max": round(measured[-1], 4),
+            "peak_rss_mb": peak_rss_mb(),
+            "trainable_params": trainable_params,
+            "total_params": total_params,
+            "trainable_percent": round(100 * trainable_params / total_params, 3),
+            "tokenize_seconds": tokenize_seconds,
+            "train_seconds": round(train_seconds, 3),
+            "final_loss": round(output.training_loss, 4),
+        },
+    }
+
+
+def compare(base_path: str, new_path: str) -> Dict[str, Any]:
+    """Print and return the relative change of each metric from `base_path` to `new_path`."""
+    with open(base_path, "r", encoding="utf-8") as f:
+        base = json.load(f)
+    with open(new_path, "r", encoding="utf-8") as f:
+        new = json.load(f)
+
+    print(f"{'metric':<22}{'base':>14}{'new':>14}{'change':>10}")
+    print("-" * 62)
+    diff = {}
+    for metric, higher_is_better in COMPARED_METRICS.items():
+        a, b = base["results"].get(metric), new["results"].get(metric)
+        if a is None or b is None:
+            continue
+        change = (b - a) / a if a else None
+        verdict = ""
+        if change is not None and higher_is_better is not None and abs(change) >= 0.02:
+            verdict = "better" if (change > 0) == higher_is_better else "worse"
+        diff[metric] = {"base": a, "new": b, "change": round(change, 4) if change is not None else None, "verdict": verdict}
+        change_text = f"{change:+.1%}" if change is not None else "n/a"
+        print(f"{metric:<22}{a:>14}{b:>14}{change_text:>10}  {verdict}")
+
+    changed = {k: (base["config"].get(k), v) for k, v in new["config"].items() if base["config"].get(k) != v}
+    if changed:
+        print("\nConfiguration differences:")
+        for key, (a, b) in changed.items():
+            print(f"  {key}: {a} -> {b}")
+    return diff
+
+
+def parse_args():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description="Benchmark fine-tuning throughput on CPU with a tiny Llama model")
+    parser.add_argument("--compare", type=str, nargs=2, metavar=("BASE_JSON", "NEW_JSON"),
+                        help="Diff two benchmark results instead of running")
+    parser.add_argument("--output", type=str, default=None, help="Write the results JSON here")
+    parser.add_argument("--max_steps", type=int, default=20, help="Optimizer steps to run")
+    parser.add_argument("--warmup_steps", type=int, default=3, help="Steps left out of the timings")
+    parser.add_argument("--threads", type=int, default=min(4, os.cpu_count() or 1), help="torch CPU threads")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data_file", type=str, default=DEFAULT_DATA_FILE, help="JSON/JSONL examples")
+    parser.add_argument("--rows", type=int, default=20000, help="Examples to tokenize (the data file is cycled)")
+    parser.add_argument("--streaming", action="store_true", help="Stream the rows from disk and tokenize on the fly")
+    parser.add_argument("--shuffle_buffer", type=int, default=10000, help="Streaming shuffle buffer size")
+    # Model
+    parser.add_argument("--hidden_size", type=int, default=256)
+    parser.add_argument("--intermediate_size", type=int, default=688)
+    parser.add_argument("--layers", type=int, default=4)
+    parser.add_argument("--heads", type=int, default=8)
+    parser.add_argument("--kv_heads", type=int, default=4)
+    # LoRA
+    parser.add_argument("--lora_r", type=int, default=8)
+    parser.add_argument("--target_modules", type=str, default="q_proj,v_proj")
+    parser.add_argument("--gradient_checkpointing", action=argparse.BooleanOptionalAction, default=True)
+    # Batching, as in finetune.py
+    parser.add_argument("--max_length", type=int, default=512)
+    parser.add_argument("--batching", type=str, choices=["packed", "bucketed", "padded"], default="packed")
+    parser.add_argument("--max_seq_len", type=int, default=1024)
+    parser.add_argument("--per_device_batch_size", type=int, default=32)
+    parser.add_argument("--max_batch_tokens", type=int, default=4096)
+    parser.add_argument("--gradient_accumulation_steps", type=int, default=1)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.compare:
+        compare(*args.compare)
+        sys.exit(0)
+
+    report = run_benchmark(args)
+    results = report["results"]
+    logger.info("=" * 50)
+    logger.info(
+        f"{results['samples_per_sec']} samples/sec, {results['tokens_per_sec']} tokens/sec, "
+        f"step p50 {results['step_time_p50']}s / p90 {results['step_time_p90']}s, "
+        f"peak RSS {results['peak_rss_mb']} MB, {results['trainable_params']} trainable params"
+    )
+    logger.info("=" * 50)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+        logger.info(f"Saved benchmark results to {args.output}")
+    else:
+        print(text)
@@ -1,12 +1,13 @@
-from transformers import pipeline, AutoTokenizer, AutoModelForCausalLM
-import torch
+import argparse
 import logging
 import os
 import sys
 import time
 import json
 from datetime import datetime
-from peft import PeftModel
+from model_snapshots import bnb_4bit_config, load_model
+
+# torch, transformers and peft are imported inside the functions that use them, so --help is instant
 
 # Configure logging
 logging.basicConfig(
@@ -18,8 +19,24 @@ logging.basicConfig(
     ]
 )
 
+# Sampling settings for generate_batch()
+GENERATION_KWARGS = {
+    "do_sample": True,
+    "temperature": 0.85,      # Adjust temperature for creativity/coherence
+    "top_p": 0.95,
+    "top_k": 40,
+    "repetition_penalty": 1.15,
+    "length_penalty": 1.2,
+    "no_repeat_ngram_size": 4
+}
+MAX_NEW_TOKENS = 512
+# Upper bound on (rows x (longest prompt + max_new_tokens)) per generate() call
+DEFAULT_MAX_BATCH_TOKENS = 16384
+
 def setup_environment():
     """Setup CUDA and environment variables."""
+    import torch
+
     try:
         # Set PyTorch and CUDA memory settings
         os.environ["PYTORCH_CUDA_ALLOC_CONF"] = "max_split_size_mb:128,expandable_segments:True"
@@ -41,6 +58,10 @@ def setup_environment():
 
 def load_model_and_tokenizer(model_dir):
     """Load the base model and tokenizer, then apply the LoRA adapter."""
+    import torch
+    from peft import PeftModel
+    from transformers import AutoTokenizer
+
     try:
         logging.info(f"Loading model from base model: NousResearch/Llama-2-7b-chat-hf")
 
@@ -58,14 +79,13 @@ def load_model_and_tokenizer(model_dir):
         )
         logging.info("Tokenizer loaded successfully")
 
-        # Load the base model with 4-bit quantization for efficiency.
-        model = AutoModelForCausalLM.from_pretrained(
+        # Load the base model with 4-bit quantization for efficiency,
+        # from the pre-quantized snapshot when one exists
+        model = load_model(
             base_model_name,
             torch_dtype=torch.float16,
+            quantization_config=bnb_4bit_config(),
             device_map="auto",
-            load_in_4bit=True,
-            bnb_4bit_quant_type="nf4",
-            bnb_4bit_compute_dtype=torch.float16,
             low_cpu_mem_usage=True
         )
 
@@ -83,61 +103,181 @@ def load_model_and_tokenizer(model_dir):
         logging.error(f"Error loading model: {e}")
         raise
 
-def generate_text(generator, prompt, num_generations=1):
-    """Generate text using the given generator for a provided prompt."""
+def load_merged_model_and_tokenizer(merged_dir):
+    """Load a standalone checkpoint written by merge_lora.py, with the adapter already folded in."""
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    try:
+        logging.info(f"Loading merged model from: {merged_dir}")
+
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+        tokenizer = AutoTokenizer.from_pretrained(merged_dir, use_fast=True)
+
+        # A re-quantized export carries its quantization config and loads in 4/8-bit as is
+        model = AutoModelForCausalLM.from_pretrained(
+            merged_dir,
+            torch_dtype=torch.float16,
+            device_map="auto",
+            low_cpu_mem_usage=True
+        )
+
+        logging.info("Merged model loaded successfully")
+        return model, tokenizer
+
+    except Exception as e:
+        logging.error(f"Error loading merged model: {e}")
+        raise
+
+def plan_batches(lengths, num_generations, max_new_tokens, max_batch_tokens):
+    """Group prompt indices into batches, longest prompt first, within max_batch_tokens.
+
+    A batch costs rows x (longest prompt + max_new_tokens) tokens, where rows is
+    prompts x num_generations. Sorting by length keeps similar lengths together,
+    so little of each batch is padding. A prompt that alone exceeds the budget
+    still gets a batch of its own.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    batches = []
+    current = []
+    for index in order:
+        longest = lengths[current[0]] if current else lengths[index]
+        cost = (len(current) + 1) * num_generations * (longest + max_new_tokens)
+        if current and cost > max_batch_tokens:
+            batches.append(current)
+            current = []
+        current.append(index)
+    if current:
+        batches.append(current)
+    return batches
+
+def count_generated_tokens(new_tokens, eos_token_id):
+    """Count generated tokens per row up to and including the first EOS (the rest is padding)."""
+    import torch
+
+    is_end = new_tokens == eos_token_id
+    first_end = is_end.int().argmax(dim=1)
+    full = torch.full_like(first_end, new_tokens.shape[1])
+    return int(torch.where(is_end.any(dim=1), first_end + 1, full).sum())
+
+def generate_batch(model, tokenizer, prompts, num_generations=1, max_batch_tokens=DEFAULT_MAX_BATCH_TOKENS,
+                   max_new_tokens=MAX_NEW_TOKENS, **generation_overrides):
+    """Generate `num_generations` samples for every prompt with left-padded batched generate() calls.
+
+    Returns (outputs, stats): outputs[i] is the list of samples for prompts[i],
+    in the original prompt order; stats holds token counts and tokens/sec.
+    """
+    import torch
+
     try:
         start_time = time.time()
-        outputs = []
-
-        for i in range(num_generations):
-            output = generator(
-                prompt,
-                do_sample=True,
-                temperature=0.85,      # Adjust temperature for creativity/coherence
-                top_p=0.95,
-                top_k=40,
-                max_new_tokens=512,    # Maximum new tokens to generate
-                num_return_sequences=1,
-                repetition_penalty=1.15,
-                pad_token_id=generator.tokenizer.eos_token_id,
-                eos_token_id=generator.tokenizer.eos_token_id,
-                return_full_text=False,   # Only return the generated text
-                length_penalty=1.2,
-                no_repeat_ngram_size=4
-            )
-            outputs.append(output[0]['generated_text'])
+        generation_kwargs = dict(GENERATION_KWARGS, **generation_overrides)
+
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+        lengths = [len(ids) for ids in tokenizer(prompts)["input_ids"]]
+        batches = plan_batches(lengths, num_generations, max_new_tokens, max_batch_tokens)
+        logging.info(f"Generating {num_generations} samples for {len(prompts)} prompts in {len(batches)} batches")
+
+        outputs = [None] * len(prompts)
+        generated_tokens = 0
+        padding_tokens = 0
+        # Decoder-only models continue from the last position, so pad on the left
+        padding_side = tokenizer.padding_side
+        tokenizer.padding_side = "left"
+        try:
+            for batch in batches:
+                inputs = tokenizer([prompts[i] for i in batch], return_tensors="pt", padding=True).to(model.device)
+                prompt_length = inputs["input_ids"].shape[1]
+                padding_tokens += sum(prompt_length - lengths[i] for i in batch)
+
+                with torch.inference_mode():
+                    sequences = model.generate(
+                        **inputs,
+                        max_new_tokens=max_new_tokens,
+                        num_return_sequences=num_generations,
+                        pad_token_id=tokenizer.pad_token_id,
+                        eos_token_id=tokenizer.eos_token_id,
+                        **generation_kwargs
+                    )
+
+                # Only return the generated text; samples for one prompt are consecutive rows
+                new_tokens = sequences[:, prompt_length:]
+                generated_tokens += count_generated_tokens(new_tokens, tokenizer.eos_token_id)
+                texts = tokenizer.batch_decode(new_tokens, skip_special_tokens=True)
+                for row, index in enumerate(batch):
+                    outputs[index] = texts[row * num_generations:(row + 1) * num_generations]
+        finally:
+            tokenizer.padding_side = padding_side
 
         generation_time = time.time() - start_time
-        logging.info(f"Text generation completed in {generation_time:.2f} seconds")
-        return outputs
+        stats = {
+            "prompts": len(prompts),
+            "batches": len(batches),
+            "sequences": len(prompts) * num_generations,
+            "prompt_tokens": sum(lengths),
+            "padding_tokens": padding_tokens,
+            "generated_tokens": generated_tokens,
+            "generation_time": generation_time,
+            "tokens_per_second": generated_tokens / generation_time if generation_time > 0 else 0.0
+        }
+        logging.info(
+            f"Text generation completed in {generation_time:.2f} seconds: "
+            f"{generated_tokens} tokens, {stats['tokens_per_second']:.1f} tokens/sec"
+        )
+        return outputs, stats
 
     except Exception as e:
         logging.error(f"Error during text generation: {e}")
         raise
 
-def main():
-    try:
-        # Setup environment and determine device (CPU or CUDA)
-        device = setup_environment()
-
-        # Path to your fine-tuned LoRA adapter directory
-        model_dir = "./village_finetuned_model"
+def build_prompt(prompt_data):
+    return (
+        f"### Instruction:\n{prompt_data['instruction']}\n"
+        f"### Input:\n{prompt_data['input']}\n"
+        f"### Response:\nLet me describe this village in detail:\n"
+    )
+
+def parse_args():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description="Generate village descriptions with the fine-tuned model")
+    parser.add_argument("--model_dir", type=str, default="./village_finetuned_model", help="LoRA adapter directory")
+    parser.add_argument("--merged_model_dir", type=str, default=None,
+                        help="Load a checkpoint from merge_lora.py instead of base model + adapter")
+    parser.add_argument("--num_generations", type=int, default=2, help="Samples per prompt")
+    parser.add_argument("--max_batch_tokens", type=int, default=DEFAULT_MAX_BATCH_TOKENS,
+                        help="Token budget per batched generate() call (rows x (prompt + new tokens))")
+    parser.add_argument("--max_new_tokens", type=int, default=MAX_NEW_TOKENS, help="Maximum new tokens per sample")
+    parser.add_argument("--output", type=str, default=None, help="Output JSON file (default: timestamped file)")
+    parser.add_argument("--tiny", action="store_true", help="Use a tiny random-weight model on CPU for testing")
+    return parser.parse_args()
 
-        # Load model and tokenizer
-        model, tokenizer = load_model_and_tokenizer(model_dir)
+def main():
+    args = parse_args()
+    import torch
 
-        # Create text generation pipeline with the loaded model and tokenizer
-        generator = pipeline(
-            "text-generation",
-            model=model,
-            tokenizer=tokenizer,
-            device_map="auto"
-        )
+    try:
+        if args.tiny:
+            from tiny_llama import TINY_MODEL_NAME, build_tiny_llama
+            model, tokenizer = build_tiny_llama()
+            model_name = TINY_MODEL_NAME
+        else:
+            # Setup environment and determine device (CPU or CUDA)
+            device = setup_environment()
+
+            if args.merged_model_dir:
+                model, tokenizer = load_merged_model_and_tokenizer(args.merged_model_dir)
+            else:
+                # Load model and tokenizer with the fine-tuned LoRA adapter
+                model, tokenizer = load_model_and_tokenizer(args.model_dir)
+            model_name = "NousResearch/Llama-2-7b-chat-hf"
 
         # Prepare a results dictionary with timestamp and model info
         results = {
             "generation_timestamp": datetime.now().isoformat(),
-            "model_name": "NousResearch/Llama-2-7b-chat-hf",
+            "model_name": model_name,
             "responses": []
         }
 
@@ -157,18 +297,19 @@ def main():
             }
         ]
 
-        # Generate text for each prompt
-        for prompt_data in prompts:
-            prompt = (
-                f"### Instruction:\n{prompt_data['instruction']}\n"
-                f"### Input:\n{prompt_data['input']}\n"
-                f"### Response:\nLet me describe this village in detail:\n"
-            )
-
-            logging.info(f"\nGenerating text for prompt:\n{prompt}\n")
+        # Generate every version of every prompt in as few batched calls as possible
+        all_outputs, stats = generate_batch(
+            model,
+            tokenizer,
+            [build_prompt(prompt_data) for prompt_data in prompts],
+            num_generations=args.num_generations,
+            max_batch_tokens=args.max_batch_tokens,
+            max_new_tokens=args.max_new_tokens
+        )
+        results["generation_stats"] = stats
 
-            # Generate multiple versions of the response
-            outputs = generate_text(generator, prompt, num_generations=2)
+        for prompt_data, outputs in zip(prompts, all_outputs):
+            logging.info(f"\nGenerated text for prompt:\n{build_prompt(prompt_data)}\n")
 
             # Store each prompt and its generated responses
             prompt_result = {
@@ -196,7 +337,7 @@ def main():
             results["responses"].append(prompt_result)
 
         # Save the generated results to a JSON file with a timestamp in the filename
-        filename = "../responses_response.json" + time.strftime("%Y%m%d_%H%M%S")
+        filename = args.output or "../responses_response.json" + time.strftime("%Y%m%d_%H%M%S")
         with open(filename, "w", encoding="utf-8") as f:
             json.dump(results, f, indent=2, ensure_ascii=False)
 
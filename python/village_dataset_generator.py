@@ -0,0 +1,216 @@
+"""Streaming generator for large synthetic village instruction datasets.
+
+Produces rows in the same {"instructions", "input", "output"} shape as
+`village_generator_hardcoded.py`, drawn from the same vocabularies and with
+the same distribution (a name and an environment chosen independently per
+row), but at the scale of tens of millions of rows:
+
+* every possible row is rendered once up front, so drawing a chunk is a single
+  vectorised `Generator.integers` call over row indices;
+* rows are written in bounded chunks, so memory does not grow with the
+  dataset: JSONL lines are joined from the pre-rendered table, Parquet chunks
+  become dictionary-encoded row groups;
+* the work is split into shards generated by a process pool, each with a seed
+  spawned from the master seed, so the output depends only on --seed and
+  --rows_per_shard, never on the number of workers.
+
+    python village_dataset_generator.py --rows 20000000 --format parquet --output_dir village_dataset
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+
+from village_generator_hardcoded import Environment, instructions, village_names
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    handlers=[logging.StreamHandler(sys.stdout)]
+)
+
+logger = logging.getLogger(__name__)
+
+EXTENSIONS = {"jsonl": ".jsonl", "parquet": ".parquet"}
+
+
+def build_row_table() -> Tuple[List[str], List[str], np.ndarray, np.ndarray]:
+    """Return (instruction values, output values, instruction index, output index) for every possible row.
+
+    Row r of the table is instruction `instruction_index[r]` with output
+    `output_index[r]`. Names keep their duplicates, so a uniform draw over the
+    table matches the hardcoded generator's independent random.choice calls.
+    """
+    environments = list(Environment.values())
+    outputs = [f"{name} {environment}" for name in village_names for environment in environments]
+    instruction_index = np.repeat(np.arange(len(instructions), dtype=np.int32), len(outputs))
+    output_index = np.tile(np.arange(len(outputs), dtype=np.int32), len(instructions))
+    return list(instructions), outputs, instruction_index, output_index
+
+
+def _jsonl_lines(instruction_values: List[str], output_values: List[str], instruction_index, output_index) -> np.ndarray:
+    return np.array([
+        json.dumps({"instructions": instruction_values[i], "input": "", "output": output_values[o]}, ensure_ascii=False) + "\n"
+        for i, o in zip(instruction_index.tolist(), output_index.tolist())
+    ], dtype=object)
+
+
+def generate_shard(
+    shard_index: int,
+    num_rows: int,
+    seed_sequence: np.random.SeedSequence,
+    output_path: str,
+    output_format: str,
+    chunk_rows: int,
+    compression: str
+) -> Dict[str, Any]:
+    """Write one shard of `num_rows` rows; runs in a worker process."""
+    start = time.perf_counter()
+    rng = np.random.default_rng(seed_sequence)
+    instruction_values, output_values, instruction_index, output_index = build_row_table()
+    table_size = len(instruction_index)
+    tmp_path = f"{output_path}.tmp-{os.getpid()}"
+
+    if output_format == "jsonl":
+        lines = _jsonl_lines(instruction_values, output_values, instruction_index, output_index)
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for offset in range(0, num_rows, chunk_rows):
+                rows = rng.integers(0, table_size, size=min(chunk_rows, num_rows - offset))
+                f.write("".join(lines[rows].tolist()))
+    else:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        instruction_dictionary = pa.array(instruction_values, type=pa.string())
+        output_dictionary = pa.array(output_values, type=pa.string())
+        empty_dictionary = pa.array([""], type=pa.string())
+        schema = pa.schema([
+            ("instructions", pa.dictionary(pa.int32(), pa.string())),
+            ("input", pa.dictionary(pa.int32(), pa.string())),
+            ("output", pa.dictionary(pa.int32(), pa.string())),
+        ])
+        with pq.ParquetWriter(tmp_path, schema, compression=compression) as writer:
+            for offset in range(0, num_rows, chunk_rows):
+                rows = rng.integers(0, table_size, size=min(chunk_rows, num_rows - offset))
+                # Each chunk becomes one row group of dictionary-encoded columns
+                writer.write_table(pa.Table.from_arrays([
+                    pa.DictionaryArray.from_arrays(pa.array(instruction_index[rows]), instruction_dictionary),
+                    pa.DictionaryArray.from_arrays(pa.array(np.zeros(len(rows), dtype=np.int32)), empty_dictionary),
+                    pa.DictionaryArray.from_arrays(pa.array(output_index[rows]), output_dictionary),
+                ], schema=schema))
+
+    os.replace(tmp_path, output_path)
+    seconds = time.perf_counter() - start
+    return {
+        "shard": shard_index,
+        "path": output_path,
+        "rows": num_rows,
+        "bytes": os.path.getsize(output_path),
+        "seconds": round(seconds, 3),
+    }
+
+
+def generate_dataset(
+    num_rows: int,
+    output_dir: str,
+    output_format: str = "jsonl",
+    seed: int = 0,
+    rows_per_shard: int = 1_000_000,
+    chunk_rows: int = 100_000,
+    workers: int = None,
+    compression: str = "snappy"
+) -> Dict[str, Any]:
+    """Generate `num_rows` rows as shards in `output_dir` and write a manifest.json describing the run."""
+    os.makedirs(output_dir, exist_ok=True)
+    num_shards = max(1, -(-num_rows // rows_per_shard))
+    seed_sequences = np.random.SeedSequence(seed).spawn(num_shards)
+    workers = workers or os.cpu_count() or 1
+    extension = EXTENSIONS[output_format]
+
+    logger.info("=" * 50)
+    logger.info(
+        f"Generating {num_rows:,} rows as {num_shards} {output_format} shard(s) in {output_dir} "
+        f"(seed {seed}, {workers} workers)"
+    )
+    start = time.perf_counter()
+    shards = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = []
+        for shard_index in range(num_shards):
+            shard_rows = min(rows_per_shard, num_rows - shard_index * rows_per_shard)
+            path = os.path.join(output_dir, f"part-{shard_index:05d}{extension}")
+            futures.append(pool.submit(
+                generate_shard, shard_index, shard_rows, seed_sequences[shard_index],
+                path, output_format, chunk_rows, compression
+            ))
+        rows_done = 0
+        for future in as_completed(futures):
+            shard = future.result()
+            shards.append(shard)
+            rows_done += shard["rows"]
+            elapsed = time.perf_counter() - start
+            logger.info(
+                f"Shard {shard['shard']:05d}: {shard['rows']:,} rows in {shard['seconds']:.2f}s; "
+                f"{rows_done:,}/{num_rows:,} total, {rows_done / elapsed:,.0f} rows/sec"
+            )
+
+    seconds = time.perf_counter() - start
+    shards.sort(key=lambda s: s["shard"])
+    manifest = {
+        "created_at": datetime.now().isoformat(),
+        "format": output_format,
+        "rows": num_rows,
+        "seed": seed,
+        "rows_per_shard": rows_per_shard,
+        "chunk_rows": chunk_rows,
+        "workers": workers,
+        "seconds": round(seconds, 3),
+        "rows_per_sec": round(num_rows / seconds, 1) if seconds > 0 else None,
+        "bytes": sum(s["bytes"] for s in shards),
+        "shards": [dict(s, path=os.path.basename(s["path"])) for s in shards],
+    }
+    with open(os.path.join(output_dir, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+
+    logger.info(
+        f"Wrote {num_rows:,} rows ({manifest['bytes'] / 1024 ** 2:,.1f} MB) in {seconds:.2f}s: "
+        f"{manifest['rows_per_sec']:,.0f} rows/sec"
+    )
+    logger.info("=" * 50)
+    return manifest
+
+
+def parse_args():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description="Generate a large synthetic village instruction dataset")
+    parser.add_argument("--rows", type=int, default=1_000_000, help="Total number of rows")
+    parser.add_argument("--format", type=str, choices=sorted(EXTENSIONS), default="jsonl")
+    parser.add_argument("--output_dir", type=str, default="village_dataset")
+    parser.add_argument("--seed", type=int, default=0, help="Master seed; shard seeds are spawned from it")
+    parser.add_argument("--rows_per_shard", type=int, default=1_000_000, help="Rows per output file")
+    parser.add_argument("--chunk_rows", type=int, default=100_000, help="Rows drawn and written per chunk")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: CPU count)")
+    parser.add_argument("--compression", type=str, default="snappy", help="Parquet compression codec")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    generate_dataset(
+        num_rows=args.rows,
+        output_dir=args.output_dir,
+        output_format=args.format,
+        seed=args.seed,
+        rows_per_shard=args.rows_per_shard,
+        chunk_rows=args.chunk_rows,
+        workers=args.workers,
+        compression=args.compression
+    )
@@ -91,13 +91,15 @@ def generate_village_data_json():
     data = generate_village_name()
     # print(data)
     try:
-        with open("./village_data.json"+datetime.now().strftime("%Y-%m-%d_%H-%M-%S"), "w") as f:
+        with open("./village_data_"+datetime.now().strftime("%Y-%m-%d_%H-%M-%S")+".json", "w") as f:
              json.dump(data, f, ensure_ascii=False, indent=4)
     except Exception as e:
         print(f"Error generating village data: {e}")
 
 
-generate_village_data_json()
+if __name__ == "__main__":
+    # village_dataset_generator.py imports the vocabularies above
+    generate_village_data_json()
    
 
 
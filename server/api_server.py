@@ -3,13 +3,29 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel, ValidationError
 from typing import Optional, List
-import subprocess
-import json
 import logging
+import os
 import sys
 import traceback
 from datetime import datetime
 
+# ollama_client, response_cache and single_flight live in python/llama7b-chat and are
+# shared with the llama server. They are stdlib + aiohttp only: deploy them on
+# PYTHONPATH, or keep this checkout layout and they are found next to this directory.
+SHARED_MODULES_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "python", "llama7b-chat"))
+try:
+    import ollama_client  # noqa: F401
+except ImportError:
+    if not os.path.isfile(os.path.join(SHARED_MODULES_DIR, "ollama_client.py")):
+        raise ImportError(
+            "api_server needs ollama_client.py, response_cache.py and single_flight.py from "
+            f"python/llama7b-chat; put them on PYTHONPATH (not found in {SHARED_MODULES_DIR})"
+        )
+    sys.path.append(SHARED_MODULES_DIR)
+from ollama_client import OllamaClient, OllamaError, attach_to_app
+from response_cache import ResponseCache, cache_from_env
+from single_flight import SingleFlight
+
 # Configure logging with more detailed format
 logging.basicConfig(
     level=logging.INFO,
@@ -24,6 +40,15 @@ logger = logging.getLogger(__name__)
 
 app = FastAPI()
 
+# Shared Ollama connection pool, opened on startup and closed on shutdown
+ollama = attach_to_app(app, OllamaClient())
+
+# Opt-in exact-match cache (RESPONSE_CACHE_ENABLED=1), None when disabled
+response_cache = cache_from_env()
+
+# Identical concurrent generations share one upstream Ollama call
+single_flight = SingleFlight()
+
 # Configure CORS
 app.add_middleware(
     CORSMiddleware,
@@ -71,42 +96,30 @@ def build_prompt(request: GenerationRequest) -> str:
         logger.error(f"Error building prompt: {str(e)}")
         raise HTTPException(status_code=400, detail="Failed to build prompt")
 
-def call_ollama(prompt: str) -> str:
-    """Call Ollama API using curl command"""
+async def call_ollama(prompt: str) -> str:
+    """Call Ollama API through the pooled async client"""
     try:
+        # No explicit options: Ollama's defaults apply, including a random seed
+        request_key = ResponseCache.make_key(prompt, "llama2", None)
+        use_cache = response_cache is not None and response_cache.is_cacheable(None)
+        if use_cache:
+            cached = response_cache.get(request_key)
+            if cached is not None:
+                logger.info("Serving response from cache")
+                return cached
+
         logger.info("Preparing to call Ollama API")
-        # Prepare the curl command
-        curl_command = [
-            "curl",
-            "-X",
-            "POST",
-            "http://localhost:11434/api/generate",
-            "-d",
-            json.dumps({
-                "model": "llama2",
-                "prompt": prompt,
-                "stream": False
-            })
-        ]
-
-        logger.debug(f"Executing curl command: {' '.join(curl_command)}")
-        # Execute the command
-        result = subprocess.run(curl_command, capture_output=True, text=True)
-
-        if result.returncode != 0:
-            error_msg = f"Ollama API error: {result.stderr}"
-            logger.error(error_msg)
-            raise HTTPException(status_code=500, detail=error_msg)
-
-        # Parse the response
-        response = json.loads(result.stdout)
+        response = await single_flight.do(request_key, lambda: ollama.generate(prompt, model="llama2"))
         logger.info("Successfully received response from Ollama")
-        return response.get("response", "")
+        response_text = response.get("response", "")
+        if use_cache:
+            response_cache.put(request_key, response_text)
+        return response_text
 
-    except json.JSONDecodeError as e:
-        error_msg = f"Failed to parse Ollama response: {str(e)}"
+    except OllamaError as e:
+        error_msg = f"Ollama API error: {str(e)}"
         logger.error(error_msg)
-        raise HTTPException(status_code=500, detail=error_msg)
+        raise HTTPException(status_code=e.status_code, detail=error_msg)
     except Exception as e:
         error_msg = f"Error calling Ollama: {str(e)}"
         logger.error(f"{error_msg}\n{traceback.format_exc()}")
@@ -122,7 +135,7 @@ async def generate_content(request: GenerationRequest):
         prompt = build_prompt(request)
 
         # Call Ollama
-        response = call_ollama(prompt)
+        response = await call_ollama(prompt)
 
         logger.info("Successfully generated content")
         return {
@@ -141,6 +154,34 @@ async def generate_content(request: GenerationRequest):
         logger.error(f"{error_msg}\n{traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=error_msg)
 
+@app.get("/cache/stats")
+async def cache_stats():
+    """Response cache and request coalescing counters"""
+    return {
+        "response_cache": {"enabled": False} if response_cache is None else {"enabled": True, **response_cache.stats()},
+        "single_flight": single_flight.stats()
+    }
+
+@app.get("/health")
+async def health_check():
+    """Health check endpoint"""
+    try:
+        ollama_version = await ollama.version()
+        return {
+            "status": "healthy",
+            "ollama_running": True,
+            "ollama_version": ollama_version,
+            "timestamp": datetime.now().isoformat()
+        }
+    except OllamaError as e:
+        logger.warning(f"Ollama health probe failed: {str(e)}")
+        return {
+            "status": "unhealthy",
+            "ollama_running": False,
+            "error": str(e),
+            "timestamp": datetime.now().isoformat()
+        }
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)